@@ -0,0 +1,627 @@
+#!/usr/bin/python3
+
+"""
+    an asyncio (ASGI) variant of nullboard_backup_srv.py : the same routes, protocol and files,
+    but one event loop serves every client, and the filesystem work runs in a bounded thread pool
+
+        python3 nullboard_backup_asgi.py
+        uvicorn nullboard_backup_asgi:app --port 20002
+
+    all the settings are the same as for nullboard_backup_srv.py, plus ASYNC_IO_THREADS
+"""
+
+import sys
+import os
+import re
+import json
+import time
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import nullboard_backup_srv as srv
+from nullboard_backup_srv import log, Dbg
+
+
+# ---------------------------------------------------------------------
+# constants, globals, etc
+
+# // the most filesystem operations running at once ; the rest wait in the pool queue, not on the event loop
+ASYNC_IO_THREADS = max( 1, int(os.environ.get('ASYNC_IO_THREADS', '8')) )
+
+_io_pool = ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix='nullboard-io')
+
+srv.Gauge( 'nullboard_io_queue', 'Filesystem operations waiting for a thread of the I/O pool', lambda: _io_pool._work_queue.qsize() )
+
+
+# // the route of a request picked for profiling, see srv.PROFILE
+_profiled_route = contextvars.ContextVar('profiled_route', default=None)
+
+
+def run_profiled(route, func, *args):
+
+    with srv.profiler.profile(route):
+        return func(*args)
+
+
+async def run_io(func, *args):
+    """ runs a blocking func(*args) in the I/O pool -- under the profiler, if the request is profiled """
+
+    route = _profiled_route.get()
+    if route is not None:
+        func = functools.partial(run_profiled, route, func)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor( _io_pool, functools.partial(func, *args) )
+
+
+# ---------------------------------------------------------------------
+# requests and responses
+
+class HttpError(Exception):
+    """ ends a request with 'status', like flask.abort() """
+
+    def __init__(self, status, headers=()):
+        super().__init__(status)
+        self.status  = status
+        self.headers = list(headers)
+
+
+class AsyncRequest:
+    """
+        just as much of a flask.Request as the server code needs : method, headers, mimetype, remote_addr, form ... ;
+        the body is read by read_body(), or by read_form() for a streamed board save
+    """
+
+    def __init__(self, scope):
+        self.scope   = scope
+        self.method  = scope['method']
+        self.path    = scope['path']
+        # // header names are lower case in ASGI
+        self.headers = { name.decode('latin-1') : value.decode('latin-1') for name, value in scope['headers'] }
+        self.body    = b''
+        # // the Flask rule of the route, see match_route()
+        self.rule    = 'unknown'
+        # // set when the body is left for read_form()
+        self.receive = None
+
+        self._form = None
+
+    @property
+    def remote_addr(self):
+        client = self.scope.get('client')
+        return client[0] if client else None
+
+    @property
+    def host(self):
+        return self.headers.get('host', '')
+
+    @property
+    def origin(self):
+        return self.headers.get('origin', None)
+
+    @property
+    def url(self):
+        query = self.scope.get('query_string', b'').decode('latin-1')
+        return f"{self.scope.get('scheme', 'http')}://{self.host}{self.path}" + (f"?{query}" if query else '')
+
+    @property
+    def args(self):
+        """ the query string, the first value of a repeated parameter """
+
+        args = {}
+        for name, value in parse_qsl(self.scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True):
+            args.setdefault(name, value)
+        return args
+
+    @property
+    def mimetype(self):
+        return self.headers.get('content-type', '').split(';', 1)[0].strip().lower()
+
+    @property
+    def content_length(self):
+        length = self.headers.get('content-length', None)
+        return int(length) if length and length.isdigit() else None
+
+    async def read_body(self, receive, limit):
+
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise HttpError(400)
+
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > limit:
+                raise HttpError(413)
+            chunks.append(chunk)
+
+            if not message.get('more_body', False):
+                break
+
+        self.body = b''.join(chunks)
+
+        # // see srv.DecompressRequest
+        encoding = self.headers.get('content-encoding', '')
+        if encoding.strip().lower() not in ('', 'identity'):
+            try:
+                self.body = srv.decompress_body(self.body, encoding, limit)
+            except srv.HTTPException as e:
+                raise HttpError(e.code)
+
+    async def read_form(self, limit):
+        """ the body => srv.FormSpooler as it comes in, see srv.StreamedPayload ; the spool files are written in the I/O pool """
+
+        encoding = self.headers.get('content-encoding', '')
+        try:
+            decoder = srv.BodyDecoder(encoding, limit) if encoding.strip().lower() not in ('', 'identity') else None
+        except srv.HTTPException as e:
+            raise HttpError(e.code)
+
+        form = srv.FormSpooler()
+        size = 0
+        try:
+            while True:
+                message = await self.receive()
+                if message['type'] == 'http.disconnect':
+                    raise HttpError(400)
+
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if size > limit:
+                    raise HttpError(413)
+                if chunk:
+                    await run_io( srv.feed_form, form, decoder, chunk )
+
+                if not message.get('more_body', False):
+                    break
+
+            await run_io( srv.feed_form, form, decoder, None )
+
+        except srv.HTTPException as e:
+            form.remove()
+            raise HttpError(e.code)
+        except BaseException:
+            form.remove()
+            raise
+
+        return form
+
+    @property
+    def form(self):
+        """ the form fields ; the first value of a repeated one, as MultiDict.to_dict() does """
+
+        if self._form is None:
+            self._form = {}
+            if self.mimetype == 'application/x-www-form-urlencoded':
+                with srv.measure('form'):
+                    for name, value in parse_qsl(self.body.decode('utf-8'), keep_blank_values=True):
+                        self._form.setdefault(name, value)
+
+        return self._form
+
+    def get_json(self):
+        return json.loads(self.body) if self.body else None
+
+    def get_data(self, as_text=False):
+        return self.body.decode('utf-8') if as_text else self.body
+
+
+def get_request_data( request ):
+    """ see srv.get_request_data() """
+
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        return request.form
+    elif request.mimetype in ('application/json', 'text/javascript'):
+        return request.get_json()
+
+    return None
+
+
+def get_json_data( request ):
+    """ see srv.get_json_data() """
+
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        json_as_text = request.form.get('data', '{}')
+        with srv.measure('decode'):
+            return json.loads(json_as_text) if json_as_text else {}
+
+    return get_request_data(request)
+
+
+def format_board( request, json_data ):
+    """ see srv.format_board() """
+
+    if json_data is None:
+        return None
+
+    if srv.SAVE_FORMAT == 'verbatim':
+        text = srv.get_board_text(request)
+        if text is not None:
+            return text
+
+    return srv.format_json(json_data)
+
+
+# // what Flask-CORS does with its default settings
+CORS_ALLOW_METHODS = 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+def cors_headers(request):
+
+    origin = request.origin
+    if origin is None:
+        return [ ('Access-Control-Allow-Origin', '*') ]
+
+    headers = [ ('Access-Control-Allow-Origin', origin) ]
+
+    # // a preflight request
+    if request.method == 'OPTIONS' and 'access-control-request-method' in request.headers:
+        allow_headers = request.headers.get('access-control-request-headers', '')
+        allow_headers = sorted( h.strip() for h in allow_headers.split(',') if h.strip() )
+        if allow_headers:
+            headers.append( ('Access-Control-Allow-Headers', ', '.join(allow_headers)) )
+        headers.append( ('Access-Control-Allow-Methods', CORS_ALLOW_METHODS) )
+
+    headers.append( ('Vary', 'Origin') )
+    return headers
+
+
+async def send_response(send, request, result, retcode, headers=()):
+    """ a str result is sent as text/html, anything else as json -- the same as Flask does """
+
+    if isinstance(result, (str, bytes)) or result is None:
+        content_type = 'text/html; charset=utf-8'
+        body = result or ''
+    else:
+        content_type = 'application/json'
+        body = json.dumps(result) + '\n'
+
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+
+    headers = list(headers)
+    # // a 304 has no body to describe
+    if retcode != srv.RETURN_304_NOT_MODIFIED:
+        if not any( name.lower() == 'content-type' for name, _ in headers ):
+            headers.insert( 0, ('Content-Type', content_type) )
+        headers = headers + [ ('Content-Length', str(len(body))) ]
+    headers = headers + cors_headers(request)
+
+    await send({ 'type' : 'http.response.start', 'status' : retcode
+               , 'headers' : [ (name.encode('latin-1'), value.encode('latin-1')) for name, value in headers ] })
+    await send({ 'type' : 'http.response.body', 'body' : body if request.method != 'HEAD' else b'' })
+
+
+# ---------------------------------------------------------------------
+# handlers
+
+async def handle_board_request(request, board_id):
+    """ see srv.handle_board_request() """
+
+    _dbg = Dbg(request)
+
+    if request.method == 'PUT':
+        assert request.mimetype == 'application/x-www-form-urlencoded'
+
+        # // see srv.save_streamed_board()
+        if request.receive is not None:
+            form = await request.read_form(srv.MAX_CONTENT_LENGTH)
+            payload = srv.StreamedPayload( board_id, srv.get_host_name(request), form )
+            try:
+                srv.check_board_id( board_id, await run_io(payload.header) )
+                await run_io( srv.store_board, payload, _dbg )
+            finally:
+                await run_io( payload.close )
+
+            return '{}', srv.RETURN_200_UPDATED
+
+        payload = srv.BoardPayload( board_id, srv.get_host_name(request), request.form )
+        srv.check_board_id( board_id, payload.header() )
+
+        if srv.WRITE_BEHIND and srv.write_behind.put(payload):
+            _dbg( "[write-behind] queued revision %r of board %s", payload.header().get('revision'), board_id )
+        else:
+            await run_io( srv.store_board, payload, _dbg )
+
+        return '{}', srv.RETURN_200_UPDATED
+
+    elif request.method == 'DELETE':
+        _dbg( "[delete] ignoring delete request for board %s", board_id )
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_batch_request(request, board_id=None):
+    """ see srv.store_board_batch() """
+
+    if request.method == 'PUT':
+        return await run_io( srv.store_board_batch, srv.get_host_name(request), get_request_data(request) )
+
+    return srv.handle_dummy_request(request)
+
+
+def stash_board(board_id, request):
+    """ see srv.save_stashed_board() ; the whole board is parsed and formatted, so it runs in the I/O pool """
+
+    json_data = get_json_data(request)
+    srv.stash_board( board_id, srv.get_host_name(request), json_data, format_board(request, json_data) )
+
+
+async def handle_stash_request(request, board_id):
+
+    if request.method == 'PUT':
+        await run_io( stash_board, board_id, request )
+        return '{}', srv.RETURN_200_UPDATED
+
+    return srv.handle_dummy_request(request)
+
+
+def conditional(request, result, retcode):
+    """ see srv.board_response() """
+
+    if retcode != srv.RETURN_200_OK:
+        return result, retcode
+
+    return srv.conditional_reply( result, retcode, request.headers.get('if-none-match', None) )
+
+
+async def handle_unstash_request(request, board_id=None):
+
+    if request.method in ('GET', 'HEAD'):
+        return conditional( request, *await run_io( srv.load_stashed_board ) )
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_revisions_request(request, board_id, revision=None):
+
+    if request.method in ('GET', 'HEAD'):
+        if revision is None:
+            return await run_io( srv.catalog_request, srv.list_board_revisions, board_id, request.args )
+        return conditional( request, *await run_io( srv.catalog_request, srv.load_board_revision, board_id, revision, request.args ) )
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_merge_request(request, board_id):
+
+    if request.method in ('GET', 'HEAD'):
+        return await run_io( srv.catalog_request, srv.merge_board_revisions, board_id, request.args )
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_replicate_request(request, board_id=None):
+    """ see srv.apply_replicated() and srv.replication_status() """
+
+    if request.method == 'PUT':
+        return await run_io( srv.apply_replicated, get_request_data(request) )
+
+    if request.method in ('GET', 'HEAD'):
+        return await run_io( srv.replication_status )
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_search_request(request, board_id=None):
+
+    if request.method in ('GET', 'HEAD'):
+        return await run_io( srv.catalog_request, srv.search_notes, request.args )
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_other_requests(request, board_id=None, case='config'):
+    """ see srv.handle_other_requests() """
+
+    if request.method == 'PUT':
+        return await run_io( srv.store_other_data, board_id, case, srv.get_host_name(request), get_request_data(request) )
+
+    elif request.method == 'DELETE':
+        # // nothing to save, and so whatever the Flask route answers
+        return srv.handle_other_requests(request, case, board_id)
+
+    return srv.handle_dummy_request(request)
+
+
+async def handle_profile_request(request, board_id=None):
+    """ see srv.read_profile() and srv.configure_profile() """
+
+    if request.method == 'GET' or request.method == 'HEAD':
+        result, retcode = srv.read_profile(request.args)
+        return result, retcode, [ ('Content-Type', 'text/plain; charset=utf-8') ]
+
+    if request.method == 'PUT':
+        return srv.configure_profile( get_request_data(request) )
+
+    return srv.reset_profile()
+
+
+async def handle_metrics_request(request, board_id=None):
+
+    if not srv.METRICS:
+        return '', srv.RETURN_404_NOT_FOUND
+
+    return srv.render_metrics(), srv.RETURN_200_OK, [ ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8') ]
+
+
+# // ( Flask rule, case, handler, methods ) -- the same as the Flask routes
+ROUTES = [ ( '/board/<id>',                      'board',     handle_board_request,     ('PUT', 'DELETE', 'OPTIONS') )
+         , ( '/board/<id>/revisions',            'revisions', handle_revisions_request, ('GET', 'HEAD', 'OPTIONS') )
+         , ( '/board/<id>/revisions/<revision>', 'revisions', handle_revisions_request, ('GET', 'HEAD', 'OPTIONS') )
+         , ( '/board/<id>/merge',                'merge',     handle_merge_request,     ('GET', 'HEAD', 'OPTIONS') )
+         , ( '/boards',                          'batch',     handle_batch_request,     ('PUT', 'OPTIONS') )
+         , ( '/search',                          'search',    handle_search_request,    ('GET', 'HEAD', 'OPTIONS') )
+         , ( '/stash-board/<id>',                'stash',     handle_stash_request,     ('PUT', 'DELETE', 'OPTIONS') )
+         , ( '/unstash-board',                   'unstash',   handle_unstash_request,   ('GET', 'HEAD', 'OPTIONS') )
+         , ( '/config',                          'config',    functools.partial(handle_other_requests, case='config'), ('PUT', 'DELETE', 'OPTIONS') )
+         , ( '/profile',                         'profile',   handle_profile_request,   ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS') )
+         , ( '/replicate',                       'replicate', handle_replicate_request, ('PUT', 'GET', 'HEAD', 'OPTIONS') )
+         , ( '/metrics',                         'metrics',   handle_metrics_request,   ('GET', 'HEAD') )
+         ]
+
+def route_regex(rule):
+    """ '/board/<id>' -> '/board/(?P<board_id>[^/]+)' """
+
+    return re.compile( re.sub( r'<(\w+)>', lambda m: f"(?P<{'board_id' if m[1] == 'id' else m[1]}>[^/]+)", rule ) )
+
+_route_regexes = [ route_regex(rule) for rule, *_ in ROUTES ]
+
+
+def match_route(path):
+    """ ( rule, case, handler, methods, { 'board_id' : ..., ... } ), or None """
+
+    for regex, (rule, case, handler, methods) in zip(_route_regexes, ROUTES):
+        match = regex.fullmatch(path)
+        if match is not None:
+            return rule, case, handler, methods, match.groupdict()
+
+    return None
+
+
+async def handle_any_request(request, receive):
+    """ see srv.handle_any_request() ; returns ( result, retcode, extra headers ) """
+
+    route = match_route(request.path)
+    if route is None:
+        raise HttpError(srv.RETURN_404_NOT_FOUND)
+
+    request.rule, case, handler, methods, params = route
+    allow = [ ('Allow', ', '.join(methods)) ]
+
+    if request.method not in methods:
+        raise HttpError(405, allow)
+
+    # // Flask answers OPTIONS by itself (provide_automatic_options)
+    if request.method == 'OPTIONS':
+        return '', srv.RETURN_200_OK, allow
+
+    _dbg = Dbg(request)
+
+    if request.content_length is not None and request.content_length > srv.MAX_CONTENT_LENGTH:
+        raise HttpError(413)
+
+    ip_filter = srv.app.config.get('ip_filter', lambda _ : True)
+    if not ip_filter( request.remote_addr ):
+        raise HttpError(srv.RETURN_403_FORBIDDEN)
+
+    if srv.BACKUP_VERIFY_TOKEN:
+        access_token = request.headers.get('x-access-token', None)
+        # // see srv.access_token_accepted()
+        authorization = request.headers.get('authorization', None) if case == 'metrics' else None
+        if not srv.access_token_accepted(access_token, authorization):
+            log.warning("[warning] => got access token %r different from what we expected!", access_token)
+            raise HttpError(srv.RETURN_403_FORBIDDEN)
+
+    # // as in Flask, where /metrics does not go through handle_any_request()
+    if case == 'metrics':
+        return await handler(request)
+
+    if case == 'board' and request.method == 'PUT' and srv.stream_board(request.mimetype, request.content_length):
+        # // left for handle_board_request(), see srv.StreamedPayload
+        request.receive = receive
+    else:
+        await request.read_body(receive, srv.MAX_CONTENT_LENGTH)
+
+    if _dbg.enabled():
+        _dbg( "[data] %s...", request.body[:150] )
+
+    # // only the work done in the I/O pool is profiled, the event loop is shared by every request
+    if srv.profiler.rate and request.rule not in srv.PROFILE_SKIP and srv.profiler.sampled():
+        _profiled_route.set(request.rule)
+
+    response = await handler(request, **params)
+    # // Flask takes a view that returns no body for an error, and answers a 500
+    if response[0] is None:
+        raise TypeError(f"the handler of {request.method} {request.rule} did not return a valid response")
+    if len(response) == 2:
+        response += ( [], )
+
+    return response
+
+
+# ---------------------------------------------------------------------
+# the ASGI application
+
+async def lifespan(receive, send):
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            # // see srv.CATALOG
+            srv.start_catalog()
+            # // see srv.SEARCH
+            srv.start_search()
+            # // see srv.RETENTION
+            srv.start_retention()
+            # // see srv.REPLICATE_TO
+            srv.start_replicator()
+            await send({ 'type' : 'lifespan.startup.complete' })
+
+        elif message['type'] == 'lifespan.shutdown':
+            # // nothing shall be left in the write-behind buffer
+            if srv.WRITE_BEHIND:
+                await run_io( srv.write_behind.drain )
+            _io_pool.shutdown(wait=True)
+            await send({ 'type' : 'lifespan.shutdown.complete' })
+            return
+
+
+async def app(scope, receive, send):
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] != 'http':
+        return
+
+    request = AsyncRequest(scope)
+    started = time.perf_counter()
+
+    try:
+        result, retcode, headers = await handle_any_request(request, receive)
+
+    except HttpError as e:
+        result, retcode, headers = '', e.status, e.headers
+
+    except Exception:
+        log.exception( "[error] %s %s", request.method, request.path )
+        result, retcode, headers = '', 500, []
+
+    if Dbg.enabled():
+        srv._debug( " <= status: %s", retcode )
+
+    await send_response(send, request, result, retcode, headers)
+
+    if srv.METRICS:
+        srv.count_request( request.rule, request.method, retcode, time.perf_counter() - started, len(request.body) )
+
+
+# ---------------------------------------------------------------------
+# main
+
+def run_server(host=srv.SERVER_LISTEN_ON_ALL_INTERFACES, port=srv.SERVER_PORT):
+    """ runs the app under uvicorn ; returns False if uvicorn is not installed """
+
+    try:
+        # [ https://www.uvicorn.org/deployment/#running-programmatically ]
+        import uvicorn
+    except ImportError:
+        log.error("# nb: uvicorn is not installed ('pip3 install uvicorn')")
+        return False
+
+    uvicorn.run( app, host=host, port=port
+               , timeout_keep_alive = srv.KEEPALIVE
+               , log_level = 'debug' if srv._DEBUG else 'info'
+               )
+    return True
+
+
+if __name__ == '__main__':
+    if not run_server():
+        sys.exit(1)
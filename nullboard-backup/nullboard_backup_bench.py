@@ -0,0 +1,1049 @@
+#!/usr/bin/python3
+
+"""
+    benchmarks for nullboard_backup_srv.py, with a scratch BACKUP_DIR ;
+    'durability' runs the app in-process, 'throughput' starts the servers and talks to them over http,
+    'load' replays Nullboard traffic either way
+
+        python3 nullboard_backup_bench.py load --clients 8 --requests 200 --transport inprocess
+        python3 nullboard_backup_bench.py load --clients 8 --requests 200 --transport socket --server asgi
+        python3 nullboard_backup_bench.py durability --saves 200 --threads 8
+        python3 nullboard_backup_bench.py compression --saves 100
+        python3 nullboard_backup_bench.py batch --boards 200 --servers flask asgi
+        python3 nullboard_backup_bench.py large --sizes 1 8 32
+        python3 nullboard_backup_bench.py throughput --servers flask gunicorn asgi --clients 32
+        python3 nullboard_backup_bench.py catalog --revisions 500000
+        python3 nullboard_backup_bench.py reads --queries 500
+        python3 nullboard_backup_bench.py merge --history 10 1000 --diverged 1 10
+        python3 nullboard_backup_bench.py search --saves 500 --notes 200
+        python3 nullboard_backup_bench.py replication --servers flask asgi --clients 8
+        python3 nullboard_backup_bench.py config --saves 1000 --change-every 1 10 0
+        python3 nullboard_backup_bench.py shards --roots 1 2 4 8 --points 16 128
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import random
+import resource
+import gzip
+import tracemalloc
+import socket
+import subprocess
+import http.client
+from urllib.parse import urlencode
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-bench-')
+os.environ['BACKUP_DIR'] = _SCRATCH_ROOT
+os.environ.setdefault('DEBUG', '0')
+# // the catalog, GET /board/<id>/revisions and the like are measured too
+os.environ.setdefault('CATALOG', '1')
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _HERE)
+import nullboard_backup_srv as srv
+
+
+# ---------------------------------------------------------------------
+# synthetic boards
+
+NB_BLOB_VERSION = 20190412
+
+# // what BackupAgent.saveBoard() sends as 'self'
+NB_SELF = 'file:///home/user/nullboard.html'
+
+# // the ids of lists and notes, see idgen in nullboard.html
+_next_id = iter(range(1, 1 << 62)).__next__
+
+LOREM = ( 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+          'et dolore magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris ' )
+
+def make_note(text):
+    """ see Note() in nullboard.html """
+
+    return { 'text' : text, 'raw' : False, 'min' : False, 'old' : False, 'marked' : False, 'new' : False, 'id' : _next_id() }
+
+
+LOREM_WORDS = LOREM.split()
+
+def make_text(size, rng=None):
+    """ the same lorem ipsum every time, or random words of it with 'rng' """
+
+    if rng is None:
+        return (LOREM * (size // len(LOREM) + 1))[:size]
+
+    words = []
+    length = 0
+    while length < size:
+        words.append( rng.choice(LOREM_WORDS) )
+        length += len(words[-1]) + 1
+
+    return ' '.join(words)[:size]
+
+
+def make_board(board_id, revision=1, lists=4, notes=20, note_size=80, rng=None):
+    """ a board as Nullboard would export it ; with 'rng', every note is different """
+
+    text = make_text(note_size)
+
+    board = { 'format'   : NB_BLOB_VERSION
+            , 'id'       : board_id
+            , 'revision' : revision
+            , 'title'    : f"bench board {board_id}"
+            , 'lists'    : [ { 'title' : f"list {i}"
+                             , 'notes' : [ make_note(f"{i}.{j} {make_text(note_size, rng) if rng else text}") for j in range(notes) ]
+                             , 'id'    : _next_id()
+                             }
+                             for i in range(lists)
+                           ]
+            }
+
+    return board
+
+
+def edit_board(board, revision):
+    """ the next revision : one note changed, as it usually happens """
+
+    board = dict(board, revision = revision)
+    lists = board['lists'] = list(board['lists'])
+    i = revision % len(lists)
+    notes = list(lists[i]['notes'])
+    if notes:
+        j = revision % len(notes)
+        notes[j] = dict(notes[j], text = notes[j]['text'] + f" (rev {revision})")
+    lists[i] = dict(lists[i], notes = notes)
+
+    return board
+
+
+def board_meta(board, history=None):
+    """ see BoardMeta() in nullboard.html """
+
+    return { 'title' : board['title'], 'current' : board['revision'], 'ui_spot' : 0
+           , 'history' : history or [ board['revision'] ], 'backupStatus' : {} }
+
+
+def board_form(board, meta=None):
+    """ the form fields of BackupAgent.saveBoard() """
+
+    meta = meta or board_meta(board)
+
+    return { 'self' : NB_SELF
+           , 'data' : json.dumps(board, separators=(',', ':'))
+           , 'meta' : json.dumps(meta, separators=(',', ':'))
+           }
+
+
+# ---------------------------------------------------------------------
+# helpers
+
+def scratch_dir(name):
+    """ a fresh BACKUP_DIR for a run """
+
+    directory = tempfile.mkdtemp(prefix=f"{name}-", dir=_SCRATCH_ROOT)
+    srv.BACKUP_DIRECTORY = directory
+    if srv.CATALOG:
+        # // what the server does in the background as it starts
+        srv.build_catalog()
+
+    return directory
+
+
+def run_threads(threads, worker):
+    """ runs worker(thread number) in parallel ; returns the elapsed time """
+
+    pool = [ threading.Thread(target=worker, args=(n,)) for n in range(threads) ]
+
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    return time.perf_counter() - started
+
+
+def percentile(values, p):
+
+    values = sorted(values)
+    if not values:
+        return 0.0
+
+    return values[ min(len(values) - 1, int(len(values) * p / 100)) ]
+
+
+# // how to start every server we compare, see bench_throughput()
+SERVERS = { 'flask'    : ( 'nullboard_backup_srv.py',  { 'SERVER' : 'dev' } )
+          , 'gunicorn' : ( 'nullboard_backup_srv.py',  { 'SERVER' : 'gunicorn', 'WORKERS' : '1' } )
+          , 'asgi'     : ( 'nullboard_backup_asgi.py', {} )
+          }
+
+def free_port():
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(name, backup_dir, env=None, timeout=30):
+    """ starts one of SERVERS ; returns ( process, port ) once it accepts connections """
+
+    script, server_env = SERVERS[name]
+    port = free_port()
+
+    env = dict(os.environ, **server_env, **(env or {}), BACKUP_DIR=backup_dir, PORT=str(port), DEBUG='0')
+    process = subprocess.Popen( [sys.executable, os.path.join(_HERE, script)], env=env
+                              , stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} server exited with {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError(f"{name} server did not start in {timeout}s")
+
+
+def stop_server(process):
+
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def report(rows, columns):
+
+    widths = [ max(len(str(c)), *(len(str(r[i])) for r in rows)) for i, c in enumerate(columns) ]
+    print( '  '.join(str(c).rjust(w) for c, w in zip(columns, widths)) )
+    for r in rows:
+        print( '  '.join(str(v).rjust(w) for v, w in zip(r, widths)) )
+
+
+# ---------------------------------------------------------------------
+# benchmarks
+
+# ---------------------------------------------------------------------
+# Nullboard traffic
+
+class NullboardClient:
+    """
+        one simulated Nullboard : a few boards it keeps editing and saving, the occasional
+        stash / unstash, and a config save now and then ; reproducible for a given seed
+    """
+
+    def __init__(self, number, args):
+        self.rng  = random.Random(args.seed * 1000 + number)
+        self.args = args
+
+        self.boards = []
+        for i in range(args.boards):
+            board = make_board( 1660000000000 + number * 1000 + i, lists=args.lists, notes=args.notes, note_size=args.note_size )
+            self.boards.append( [ board, [ board['revision'] ] ] )
+
+        self.weights = [ args.mix.get(kind, 0) for kind in REQUEST_KINDS ]
+
+    def edit(self, board):
+        """ what one usually does between two saves : edit, add or delete a note, and sometimes add a list """
+
+        board = dict(board, revision = board['revision'] + 1)
+        lists = board['lists'] = list(board['lists'])
+        i = self.rng.randrange(len(lists))
+        notes = list(lists[i]['notes'])
+
+        action = self.rng.random()
+        if action < 0.6 and notes:
+            j = self.rng.randrange(len(notes))
+            notes[j] = dict(notes[j], text = notes[j]['text'][:self.args.note_size // 2] + make_text(self.args.note_size // 2, self.rng))
+        elif action < 0.8 or not notes:
+            notes.insert( self.rng.randrange(len(notes) + 1), make_note(make_text(self.args.note_size, self.rng)) )
+        elif action < 0.97:
+            del notes[self.rng.randrange(len(notes))]
+        else:
+            lists.append( { 'title' : f"list {len(lists)}", 'notes' : [], 'id' : _next_id() } )
+
+        lists[i] = dict(lists[i], notes = notes)
+        return board
+
+    def next_request(self):
+        """ ( kind, method, path, form fields or None, json body or None ) """
+
+        kind = self.rng.choices(REQUEST_KINDS, self.weights)[0]
+        entry = self.rng.choice(self.boards)
+
+        if kind == 'board':
+            board = entry[0] = self.edit(entry[0])
+            history = entry[1] = ( [ board['revision'] ] + entry[1] )[:50]
+            return kind, 'PUT', f"/board/{board['id']}", board_form(board, board_meta(board, history)), None
+
+        if kind == 'stash':
+            return kind, 'PUT', f"/stash-board/{entry[0]['id']}", None, entry[0]
+
+        if kind == 'unstash':
+            return kind, 'GET', '/unstash-board', None, None
+
+        # // see AppConfig() in nullboard.html
+        conf = { 'verLast' : NB_BLOB_VERSION, 'verSeen' : NB_BLOB_VERSION, 'maxUndo' : 50, 'theme' : None
+               , 'board' : entry[0]['id'], 'backups' : { 'agents' : [ { 'type' : 'simp', 'id' : 'simp-1', 'enabled' : True } ], 'nextId' : 2 } }
+        return kind, 'PUT', '/config', { 'self' : NB_SELF, 'conf' : json.dumps(conf) }, None
+
+
+REQUEST_KINDS = ('board', 'stash', 'unstash', 'config')
+
+
+class InProcessTransport:
+    """ the Flask app through its test client """
+
+    def __init__(self):
+        self.client = srv.app.test_client()
+
+    def request(self, method, path, form=None, body=None):
+
+        response = self.client.open(path, method=method, data=form, json=body)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """ a keep-alive http connection to a server started by start_server() """
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def request(self, method, path, form=None, body=None):
+
+        headers = { 'Origin' : 'null', 'X-Access-Token' : '' }
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=UTF-8'
+        elif body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self.connection.close()
+
+
+def disk_usage(directory):
+    """ bytes allocated under a directory, hard links counted once """
+
+    seen = set()
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add( (st.st_dev, st.st_ino) )
+                total += st.st_blocks * 512
+
+    return total
+
+
+def scrape_metric(port, name):
+
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', '/metrics')
+    for line in connection.getresponse().read().decode('utf-8').splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+
+    return 0.0
+
+
+def bench_load(args):
+    """ replays Nullboard traffic : throughput, p50 / p99 latency, CPU per request and bytes per revision """
+
+    directory = scratch_dir(f"load-{args.transport}")
+
+    if args.transport == 'socket':
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        process, port = start_server(args.server, directory)
+        transport = lambda: SocketTransport(port)
+        written_before = scrape_metric(port, 'nullboard_written_bytes_total')
+    else:
+        cpu_before = time.process_time()
+        transport = InProcessTransport
+        written_before = srv.written_bytes.values.get((), 0)
+
+    results = []
+    def worker(n):
+        client = NullboardClient(n, args)
+        connection = transport()
+        mine = []
+        for _ in range(args.requests):
+            kind, method, path, form, body = client.next_request()
+            started = time.perf_counter()
+            status = connection.request(method, path, form, body)
+            mine.append( (kind, time.perf_counter() - started, status) )
+        connection.close()
+        results.extend(mine)
+
+    try:
+        elapsed = run_threads(args.clients, worker)
+    finally:
+        if args.transport == 'socket':
+            written = scrape_metric(port, 'nullboard_written_bytes_total') - written_before
+            stop_server(process)
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (usage.ru_utime - children.ru_utime) + (usage.ru_stime - children.ru_stime)
+            cpu_note = 'server'
+        else:
+            if srv.WRITE_BEHIND:
+                srv.write_behind.drain()
+            written = srv.written_bytes.values.get((), 0) - written_before
+            cpu = time.process_time() - cpu_before
+            cpu_note = 'server and client'
+
+    rows = []
+    for kind in REQUEST_KINDS + ('all',):
+        mine = [ r for r in results if kind in (r[0], 'all') ]
+        if not mine:
+            continue
+        latencies = [ r[1] for r in mine ]
+        errors = sum( 1 for r in mine if r[2] >= 400 )
+        rows.append( ( kind, len(mine), errors, f"{len(mine) / elapsed:.1f}"
+                     , f"{percentile(latencies, 50) * 1000:.2f}", f"{percentile(latencies, 99) * 1000:.2f}" ) )
+
+    print(f"# {args.transport}{' / ' + args.server if args.transport == 'socket' else ''} : {args.clients} clients x {args.requests} requests"
+          f", {args.boards} boards each ({args.lists} lists x {args.notes} notes of {args.note_size} chars), seed {args.seed}\n")
+    report(rows, ('requests', 'count', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+
+    revisions = sum( 1 for r in results if r[0] == 'board' ) or 1
+    print()
+    print(f"  cpu per request        : {cpu / len(results) * 1000:.2f} ms ({cpu_note})")
+    print(f"  written per revision   : {written / revisions / 1024:.1f} KiB")
+    print(f"  on disk per revision   : {disk_usage(directory) / revisions / 1024:.1f} KiB")
+
+
+def parse_mix(text):
+    """ 'board=90,stash=4,unstash=4,config=2' -> { 'board' : 90, ... } """
+
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown request kind {kind!r}, expected one of {', '.join(REQUEST_KINDS)}")
+        mix[kind.strip()] = float(weight or 1)
+
+    return mix
+
+
+def bench_durability(args):
+    """ board saves per second for every DURABILITY mode """
+
+    rows = []
+    for mode in args.modes:
+        srv.DURABILITY = mode
+        scratch_dir(f"durability-{mode}")
+
+        def worker(n):
+            client = srv.app.test_client()
+            board = make_board(1000 + n, lists=args.lists, notes=args.notes)
+            for revision in range(1, args.saves + 1):
+                board = edit_board(board, revision)
+                response = client.put(f"/board/{board['id']}", data=board_form(board))
+                assert response.status_code == 200, response.status_code
+
+        elapsed = run_threads(args.threads, worker)
+        saves = args.saves * args.threads
+        rows.append( (mode, saves, f"{elapsed:.2f}", f"{saves / elapsed:.1f}", f"{elapsed / saves * 1000:.2f}") )
+
+    report(rows, ('durability', 'saves', 'seconds', 'saves/s', 'ms/save'))
+
+
+def bench_throughput(args):
+    """ requests per second over http, for the Flask app and the ASGI variant side by side """
+
+    headers = { 'Content-Type' : 'application/x-www-form-urlencoded; charset=UTF-8', 'Origin' : 'null' }
+
+    rows = []
+    for name in args.servers:
+        process, port = start_server( name, scratch_dir(f"throughput-{name}"), { 'DURABILITY' : args.durability } )
+        latencies = []
+        errors = []
+
+        def worker(n):
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            board = make_board(2000 + n, lists=args.lists, notes=args.notes)
+            mine = []
+            for revision in range(1, args.saves + 1):
+                board = edit_board(board, revision)
+                body = urlencode(board_form(board))
+
+                started = time.perf_counter()
+                connection.request('PUT', f"/board/{board['id']}", body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                mine.append(time.perf_counter() - started)
+
+                if response.status != 200:
+                    errors.append(response.status)
+            connection.close()
+            latencies.extend(mine)
+
+        try:
+            elapsed = run_threads(args.clients, worker)
+        finally:
+            stop_server(process)
+
+        saves = len(latencies)
+        rows.append( ( name, saves, len(errors), f"{elapsed:.2f}", f"{saves / elapsed:.1f}"
+                     , f"{sum(latencies) / saves * 1000:.2f}", f"{percentile(latencies, 99) * 1000:.2f}" ) )
+
+    report(rows, ('server', 'saves', 'errors', 'seconds', 'saves/s', 'mean ms', 'p99 ms'))
+
+
+def bench_catalog(args):
+    """ GET /board/<id>/revisions latency with a large revision catalog """
+
+    scratch_dir('catalog')
+    client = srv.app.test_client()
+
+    # // a few real revisions to fetch ...
+    board = make_board(3000)
+    for revision in range(1, 6):
+        board = edit_board(board, revision)
+        assert client.put(f"/board/{board['id']}", data=board_form(board)).status_code == 200
+
+    # // ... among a lot of made up ones
+    conn = srv.get_catalog()
+    started = time.perf_counter()
+    rows = ( ( '127.0.0.1', str(10000 + i % args.boards), i // args.boards + 1, 'bench'
+             , time.time(), 'file', f"boards/nbx/made-up/{i}.nbx" )
+             for i in range(args.revisions) )
+    with srv.catalog_transaction(conn):
+        conn.executemany(srv.CATALOG_INSERT, rows)
+    print(f"# {args.revisions} revisions of {args.boards} boards cataloged in {time.perf_counter() - started:.1f}s\n")
+
+    first_page = client.get('/board/10000/revisions?limit=50').get_json()
+    deep = first_page['revisions'][0]['id'] // 2
+
+    queries = [ ( 'first page',            '/board/10000/revisions?limit=50' )
+              , ( 'deep page',             f"/board/10000/revisions?limit=50&before={deep}" )
+              , ( 'page of another host',  '/board/10000/revisions?limit=50&host=10.0.0.1' )
+              , ( 'fetch a revision',      '/board/3000/revisions/3' )
+              , ( 'missing revision',      f"/board/10000/revisions/{args.revisions}" )
+              ]
+
+    rows = []
+    for name, url in queries:
+        latencies = []
+        for _ in range(args.queries):
+            started = time.perf_counter()
+            response = client.get(url)
+            latencies.append(time.perf_counter() - started)
+        rows.append( ( name, response.status_code, f"{sum(latencies) / len(latencies) * 1000:.2f}", f"{percentile(latencies, 99) * 1000:.2f}" ) )
+
+    report(rows, ('query', 'status', 'mean ms', 'p99 ms'))
+
+
+def bench_search(args):
+    """ save latency with and without the search index, early and late in a board history, indexing time, and search latency """
+
+    rows = []
+    for search in (False, True):
+        srv.SEARCH = search
+        scratch_dir(f"search-{int(search)}")
+        client = srv.app.test_client()
+
+        board = make_board(4000, lists=args.lists, notes=args.notes)
+        latencies = []
+        indexing = 0.0
+        for revision in range(1, args.saves + 1):
+            board = edit_board(board, revision)
+            form = board_form(board)
+            started = time.perf_counter()
+            assert client.put(f"/board/{board['id']}", data=form).status_code == 200
+            latencies.append(time.perf_counter() - started)
+
+            if search:
+                # // what the background indexer does in the meantime, see srv.index_search()
+                started = time.perf_counter()
+                srv.index_search()
+                indexing += time.perf_counter() - started
+
+        tenth = max(1, len(latencies) // 10)
+        first, last = latencies[1:tenth + 1], latencies[-tenth:]
+
+        query = ''
+        if search:
+            started = time.perf_counter()
+            for _ in range(args.queries):
+                response = client.get('/search?q=lorem+rev*&limit=20')
+            assert response.status_code == 200
+            query = f"{(time.perf_counter() - started) / args.queries * 1000:.2f}"
+
+        rows.append( ( 'on' if search else 'off', len(latencies)
+                     , f"{sum(first) / len(first) * 1000:.2f}", f"{sum(last) / len(last) * 1000:.2f}"
+                     , f"{percentile(latencies, 99) * 1000:.2f}", f"{indexing / args.saves * 1000:.2f}" if search else '', query ) )
+
+    report(rows, ('search', 'saves', 'first 10% ms', 'last 10% ms', 'p99 ms', 'index ms/save', 'query ms'))
+
+
+def bench_batch(args):
+    """ a re-sync of many boards : one PUT /board/<id> at a time, as Nullboard does, against PUT /boards """
+
+    boards = [ make_board(6000 + i, lists=args.lists, notes=args.notes) for i in range(args.boards) ]
+
+    rows = []
+    for server in args.servers:
+        for batch in [ 1 ] + args.batch:
+            process, port = start_server(server, scratch_dir(f"batch-{server}-{batch}"))
+            try:
+                connection = SocketTransport(port)
+                started = time.perf_counter()
+                for i in range(0, len(boards), batch):
+                    if batch == 1:
+                        status = connection.request('PUT', f"/board/{boards[i]['id']}", board_form(boards[i]))
+                    else:
+                        status = connection.request('PUT', '/boards', body = { 'boards' : [ board_form(board) for board in boards[i:i + batch] ] })
+                    assert status == 200, status
+                elapsed = time.perf_counter() - started
+                connection.close()
+            finally:
+                stop_server(process)
+
+            rows.append( ( server, 'one by one' if batch == 1 else f"{batch} per PUT /boards", len(boards)
+                         , f"{elapsed:.2f}", f"{len(boards) / elapsed:.1f}" ) )
+
+    report(rows, ('server', 'requests', 'boards', 'seconds', 'boards/s'))
+
+
+def kept_files(directory):
+    """ the revisions left in nbx/ after the retention """
+
+    return sum( len(files) for _, _, files in os.walk(os.path.join(directory, 'boards', 'nbx')) )
+
+
+def bench_compression(args):
+    """ CPU time against bytes on disk for every compression level (COMPRESS, COMPRESS_LEVEL), and gzip-ed requests """
+
+    board = make_board(5000, lists=args.lists, notes=args.notes, note_size=args.note_size, rng=random.Random(args.seed))
+    text = srv.format_json(board)
+    body = urlencode( board_form(board) ).encode('utf-8')
+
+    print(f"# a board of {len(text) / 1024:.1f} KiB ({args.lists} lists x {args.notes} notes), saved {args.saves} times\n")
+
+    levels = [ ('none', '') ] + [ ('gzip', str(level)) for level in (1, 6, 9) ]
+    if srv.zstd is not None:
+        levels += [ ('zstd', str(level)) for level in (1, 3, 9, 19) ]
+    else:
+        print("# nb: no zstd here (python 3.14 or 'pip3 install zstandard')\n")
+
+    rows = []
+    for compress, level in levels:
+        srv.COMPRESS, srv.COMPRESS_LEVEL = compress, level
+
+        started = time.process_time()
+        for _ in range(args.repeat):
+            content = srv.compress_text(text)
+        compress_ms = (time.process_time() - started) / args.repeat * 1000
+
+        directory = scratch_dir(f"compression-{compress}{level}")
+        sample = os.path.join(directory, 'sample.json' + srv.compressed_suffix())
+        with open(sample, 'wb') as f:
+            f.write(content)
+        started = time.process_time()
+        for _ in range(args.repeat):
+            srv.read_text(sample)
+        decompress_ms = (time.process_time() - started) / args.repeat * 1000
+        os.unlink(sample)
+
+        client = srv.app.test_client()
+        latencies = []
+        cpu = time.process_time()
+        for revision in range(1, args.saves + 1):
+            board = edit_board(board, revision)
+            started = time.perf_counter()
+            assert client.put(f"/board/{board['id']}", data=board_form(board)).status_code == 200
+            latencies.append(time.perf_counter() - started)
+        cpu = time.process_time() - cpu
+
+        rows.append( ( compress, level or '-', f"{len(text) / len(content):.1f}x", f"{compress_ms:.2f}", f"{decompress_ms:.2f}"
+                     , f"{cpu / args.saves * 1000:.2f}", f"{percentile(latencies, 50) * 1000:.2f}"
+                     , f"{disk_usage(os.path.join(directory, 'boards', 'nbx')) / max(1, kept_files(directory)) / 1024:.1f}" ) )
+
+    report(rows, ('compress', 'level', 'ratio', 'compress ms', 'decompress ms', 'cpu/save ms', 'p50 save ms', 'disk KiB/rev'))
+
+    print()
+    for level in (1, 6, 9):
+        compressed = gzip.compress(body, level)
+        print(f"  request body : {len(body) / 1024:.1f} KiB, {len(compressed) / 1024:.1f} KiB with Content-Encoding: gzip (level {level})")
+
+
+def bench_large(args):
+    """ peak memory of a save against the size of the board, parsed in memory or streamed to disk (STREAM_THRESHOLD) """
+
+    largest = max(args.sizes) << 20
+    srv.MAX_CONTENT_LENGTH = srv.app.config['MAX_CONTENT_LENGTH'] = srv.app.config['MAX_FORM_MEMORY_SIZE'] = 4 * largest
+
+    rows = []
+    for size in args.sizes:
+        notes = max( 1, (size << 20) // args.note_size // args.lists )
+        board = make_board(7000 + size, lists=args.lists, notes=notes, note_size=args.note_size, rng=random.Random(args.seed))
+        body = urlencode( board_form(board) ).encode('utf-8')
+        del board
+
+        for mode, threshold in ( ('in memory', 0), ('streamed', 1) ):
+            srv.STREAM_THRESHOLD = threshold
+            scratch_dir(f"large-{size}-{threshold}")
+            client = srv.app.test_client()
+
+            def save():
+                status = client.put( f"/board/{7000 + size}", data=body, content_type='application/x-www-form-urlencoded' ).status_code
+                assert status == 200, status
+
+            started = time.perf_counter()
+            save()
+            elapsed = time.perf_counter() - started
+
+            # // tracemalloc slows everything down, hence a second save
+            tracemalloc.start()
+            save()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            rows.append( ( f"{len(body) / (1 << 20):.1f}", mode, f"{elapsed * 1000:.0f}", f"{peak / (1 << 20):.1f}"
+                         , f"{peak / len(body):.2f}" ) )
+
+    report(rows, ('body MiB', 'save', 'ms', 'peak MiB', 'peak / body'))
+
+
+def bench_reads(args):
+    """ GET /board/<id>/revisions/<revision> and /unstash-board : from disk, from the read cache (READ_CACHE_SIZE), and as a 304 """
+
+    scratch_dir('reads')
+    client = srv.app.test_client()
+
+    board = make_board(8000, lists=args.lists, notes=args.notes, note_size=args.note_size, rng=random.Random(args.seed))
+    for revision in range(1, 4):
+        board = edit_board(board, revision)
+        assert client.put(f"/board/{board['id']}", data=board_form(board)).status_code == 200
+    assert client.put(f"/stash-board/{board['id']}", data=board_form(board)).status_code == 200
+
+    cache = srv.read_cache
+    def from_disk():
+        srv.read_cache = srv.ReadCache(0)
+        srv._latest_stash.clear()
+
+    rows = []
+    for name, url in ( ('revision', f"/board/{board['id']}/revisions/{board['revision']}"), ('unstash', '/unstash-board') ):
+        etag = client.get(url).headers['ETag']
+        for mode, headers, before in ( ('from disk', {}, from_disk), ('cached', {}, None), ('304', { 'If-None-Match' : etag }, None) ):
+            latencies = []
+            for _ in range(args.queries):
+                if before is not None:
+                    before()
+                started = time.perf_counter()
+                response = client.get(url, headers=headers)
+                latencies.append(time.perf_counter() - started)
+            srv.read_cache = cache
+
+            rows.append( ( name, mode, response.status_code, f"{len(response.data) / 1024:.1f}"
+                         , f"{sum(latencies) / len(latencies) * 1000:.2f}", f"{percentile(latencies, 99) * 1000:.2f}" ) )
+
+    report(rows, ('GET', 'served', 'status', 'KiB', 'mean ms', 'p99 ms'))
+
+
+def bench_merge(args):
+    """ GET /board/<id>/merge latency against the length of the common history, and how far the two hosts went apart """
+
+    # // all of them in one 10-minute interval, which would otherwise keep just the last few
+    srv.KEEP_REVISIONS = 0
+
+    rows = []
+    for history in args.history:
+        for diverged in args.diverged:
+            scratch_dir(f"merge-{history}-{diverged}")
+            client = srv.app.test_client()
+
+            def save(board, host):
+                status = client.put( f"/board/{board['id']}", data=board_form(board), environ_base={ 'REMOTE_ADDR' : host } ).status_code
+                assert status == 200, status
+
+            board = make_board(9000, lists=args.lists, notes=args.notes, rng=random.Random(args.seed))
+            for revision in range(1, history + 1):
+                board = edit_board(board, revision)
+                save(board, '10.0.0.1')
+
+            # // the other host pulls it, and both go on with their own edits (of different notes)
+            save(board, '10.0.0.2')
+            ours = theirs = board
+            for revision in range(history + 1, history + diverged + 1):
+                ours = edit_board(ours, revision)
+                save(ours, '10.0.0.1')
+                theirs = edit_board(theirs, revision + 1)
+                theirs['revision'] = revision
+                save(theirs, '10.0.0.2')
+
+            url = f"/board/9000/merge?a={history + diverged}&host_a=10.0.0.1&b={history + diverged}&host_b=10.0.0.2"
+            latencies = []
+            for _ in range(args.queries):
+                srv.read_cache = srv.ReadCache(0)
+                started = time.perf_counter()
+                response = client.get(url)
+                latencies.append(time.perf_counter() - started)
+            result = response.get_json()
+            assert response.status_code == 200 and result['base']['revision'] == history, result.get('base')
+
+            rows.append( ( history, diverged, len(result['conflicts'])
+                         , f"{sum(latencies) / len(latencies) * 1000:.2f}", f"{percentile(latencies, 99) * 1000:.2f}" ) )
+
+    report(rows, ('history', 'diverged', 'conflicts', 'mean ms', 'p99 ms'))
+
+
+def bench_replication(args):
+    """ PUT /board/<id> latency with and without REPLICATE_TO, and how long the peer takes to catch up """
+
+    headers = { 'Content-Type' : 'application/x-www-form-urlencoded; charset=UTF-8', 'Origin' : 'null' }
+
+    rows = []
+    for name in args.servers:
+        for replicated in (False, True):
+            peer, peer_port = start_server( name, scratch_dir(f"replication-{name}-peer") )
+            env = { 'REPLICATE_TO' : f"http://127.0.0.1:{peer_port}" } if replicated else {}
+            process, port = start_server( name, scratch_dir(f"replication-{name}-{int(replicated)}"), env )
+            latencies = []
+
+            def worker(n):
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                board = make_board(2500 + n, lists=args.lists, notes=args.notes)
+                mine = []
+                for revision in range(1, args.saves + 1):
+                    board = edit_board(board, revision)
+                    body = urlencode(board_form(board))
+
+                    started = time.perf_counter()
+                    connection.request('PUT', f"/board/{board['id']}", body=body, headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    mine.append(time.perf_counter() - started)
+                    assert response.status == 200, response.status
+                connection.close()
+                latencies.extend(mine)
+
+            try:
+                run_threads(args.clients, worker)
+
+                # // from the last save until the outbox is empty
+                started = time.perf_counter()
+                status = { 'pending' : 0, 'lag' : 0 }
+                while replicated:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                    connection.request('GET', '/replicate')
+                    status = json.loads( connection.getresponse().read() )
+                    connection.close()
+                    if status['pending'] == 0:
+                        break
+                    time.sleep(0.01)
+                caught_up = time.perf_counter() - started
+
+                connection = http.client.HTTPConnection('127.0.0.1', peer_port, timeout=60)
+                connection.request('GET', '/replicate')
+                received = sum( replica['applied'] for replica in json.loads( connection.getresponse().read() )['replicas'].values() )
+                connection.close()
+            finally:
+                stop_server(process)
+                stop_server(peer)
+
+            saves = len(latencies)
+            rows.append( ( name, 'on' if replicated else 'off', saves, received
+                         , f"{sum(latencies) / saves * 1000:.2f}", f"{percentile(latencies, 99) * 1000:.2f}"
+                         , f"{caught_up:.2f}" if replicated else '-' ) )
+
+    report(rows, ('server', 'replication', 'saves', 'on the peer', 'mean ms', 'p99 ms', 'catch-up s'))
+
+
+def bench_config(args):
+    """ PUT /config : files and disk space kept, and save latency, against how often the config actually changes """
+
+    rows = []
+    for every in args.change_every:
+        directory = scratch_dir(f"config-{every}")
+        def make_config(version):
+            return { 'conf' : json.dumps( { 'theme' : 'dark', 'fontSize' : 13, 'version' : version, 'board' : '1660000000000'
+                                          , 'boards' : { str(1660000000000 + i) : { 'collapsed' : [] } for i in range(args.boards) } } ) }
+
+        # // one save per 10-minute interval, so none of them overwrites another
+        started_at = time.time() - args.saves * 600
+        latencies = []
+        for i in range(args.saves):
+            config = make_config( i // every if every else 0 )
+            started = time.perf_counter()
+            srv.store_other_data( None, 'config', '127.0.0.1', config, srv.localtime(started_at + i * 600) )
+            latencies.append(time.perf_counter() - started)
+
+        files = sum( len(names) for _, _, names in os.walk(os.path.join(directory, 'config')) )
+        rows.append( ( every or 'never', args.saves, files, f"{disk_usage(os.path.join(directory, 'config')) / 1024:.0f}"
+                     , f"{sum(latencies) / len(latencies) * 1000:.3f}", f"{percentile(latencies, 99) * 1000:.3f}" ) )
+
+    report(rows, ('changed every', 'saves', 'files', 'KiB', 'mean ms', 'p99 ms'))
+
+
+def bench_shards(args):
+    """ SHARDS : how many boards a root added to n others moves, against the 1/(n+1) that is the least possible, and how even the roots are """
+
+    points = srv.SHARD_POINTS
+    rows = []
+    board_ids = [ 1000000000000 + i * 7919 for i in range(args.boards) ]
+    for shard_points in args.points:
+        srv.SHARD_POINTS = shard_points
+        srv._shard_rings.clear()
+        for count in args.roots:
+            roots = [ f"/mnt/disk{i}" for i in range(1, count + 1) ]
+            before = { board_id : srv.shard_root(board_id, roots) for board_id in board_ids }
+
+            started = time.perf_counter()
+            after = { board_id : srv.shard_root(board_id, roots + [ f"/mnt/disk{count + 1}" ]) for board_id in board_ids }
+            elapsed = time.perf_counter() - started
+
+            moved = sum( 1 for board_id in board_ids if before[board_id] != after[board_id] )
+            # // boards per root after, against an even share
+            shares = [ sum( 1 for root in after.values() if root == name ) * (count + 1) / len(board_ids) for name in set(after.values()) ]
+            rows.append( ( shard_points, f"{count} -> {count + 1}", f"{moved / len(board_ids):.1%}", f"{1 / (count + 1):.1%}"
+                         , f"{min(shares):.2f}", f"{max(shares):.2f}", f"{elapsed / len(board_ids) * 1e6:.2f}" ) )
+
+    srv.SHARD_POINTS = points
+    srv._shard_rings.clear()
+    report(rows, ('points', 'roots', 'moved', 'ideal', 'min share', 'max share', 'us per board'))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('load', help=bench_load.__doc__)
+    cmd.add_argument('--transport', default='inprocess', choices=['inprocess', 'socket'])
+    cmd.add_argument('--server', default='flask', choices=list(SERVERS), help='for --transport socket')
+    cmd.add_argument('--clients', type=int, default=8)
+    cmd.add_argument('--requests', type=int, default=200, help='requests per client')
+    cmd.add_argument('--boards', type=int, default=3, help='boards per client')
+    cmd.add_argument('--lists', type=int, default=5)
+    cmd.add_argument('--notes', type=int, default=15, help='notes per list')
+    cmd.add_argument('--note-size', type=int, default=120)
+    cmd.add_argument('--mix', type=parse_mix, default='board=90,stash=4,unstash=4,config=2')
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.set_defaults(func=bench_load)
+
+    cmd = commands.add_parser('batch', help=bench_batch.__doc__)
+    cmd.add_argument('--servers', nargs='+', default=['flask'], choices=list(SERVERS))
+    cmd.add_argument('--boards', type=int, default=200)
+    cmd.add_argument('--batch', type=int, nargs='+', default=[20, 200], help='boards per PUT /boards')
+    cmd.add_argument('--lists', type=int, default=5)
+    cmd.add_argument('--notes', type=int, default=15, help='notes per list')
+    cmd.set_defaults(func=bench_batch)
+
+    cmd = commands.add_parser('large', help=bench_large.__doc__)
+    cmd.add_argument('--sizes', type=int, nargs='+', default=[1, 8, 32], help='board sizes, in MiB')
+    cmd.add_argument('--lists', type=int, default=10)
+    cmd.add_argument('--note-size', type=int, default=400)
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.set_defaults(func=bench_large)
+
+    cmd = commands.add_parser('compression', help=bench_compression.__doc__)
+    cmd.add_argument('--saves', type=int, default=100)
+    cmd.add_argument('--repeat', type=int, default=20, help='compressions and decompressions of a board per level')
+    cmd.add_argument('--lists', type=int, default=8)
+    cmd.add_argument('--notes', type=int, default=40, help='notes per list')
+    cmd.add_argument('--note-size', type=int, default=200)
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.set_defaults(func=bench_compression)
+
+    cmd = commands.add_parser('durability', help=bench_durability.__doc__)
+    cmd.add_argument('--modes', nargs='+', default=['none', 'batch', 'always'])
+    cmd.add_argument('--saves', type=int, default=100, help='saves per thread')
+    cmd.add_argument('--threads', type=int, default=8)
+    cmd.add_argument('--lists', type=int, default=4)
+    cmd.add_argument('--notes', type=int, default=20)
+    cmd.set_defaults(func=bench_durability)
+
+    cmd = commands.add_parser('throughput', help=bench_throughput.__doc__)
+    cmd.add_argument('--servers', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+    cmd.add_argument('--saves', type=int, default=50, help='saves per client')
+    cmd.add_argument('--clients', type=int, default=16)
+    cmd.add_argument('--durability', default='batch', choices=['none', 'batch', 'always'])
+    cmd.add_argument('--lists', type=int, default=4)
+    cmd.add_argument('--notes', type=int, default=20)
+    cmd.set_defaults(func=bench_throughput)
+
+    cmd = commands.add_parser('catalog', help=bench_catalog.__doc__)
+    cmd.add_argument('--revisions', type=int, default=300000)
+    cmd.add_argument('--boards', type=int, default=100)
+    cmd.add_argument('--queries', type=int, default=200, help='requests per query')
+    cmd.set_defaults(func=bench_catalog)
+
+    cmd = commands.add_parser('reads', help=bench_reads.__doc__)
+    cmd.add_argument('--queries', type=int, default=200, help='requests per row')
+    cmd.add_argument('--lists', type=int, default=8)
+    cmd.add_argument('--notes', type=int, default=100, help='notes per list')
+    cmd.add_argument('--note-size', type=int, default=300)
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.set_defaults(func=bench_reads)
+
+    cmd = commands.add_parser('merge', help=bench_merge.__doc__)
+    cmd.add_argument('--history', type=int, nargs='+', default=[10, 1000], help='revisions before the two hosts went apart')
+    cmd.add_argument('--diverged', type=int, nargs='+', default=[1, 10], help='revisions of each host since')
+    cmd.add_argument('--lists', type=int, default=8)
+    cmd.add_argument('--notes', type=int, default=50, help='notes per list')
+    cmd.add_argument('--queries', type=int, default=50, help='merges per row, from disk')
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.set_defaults(func=bench_merge)
+
+    cmd = commands.add_parser('replication', help=bench_replication.__doc__)
+    cmd.add_argument('--servers', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+    cmd.add_argument('--saves', type=int, default=50, help='saves per client')
+    cmd.add_argument('--clients', type=int, default=8)
+    cmd.add_argument('--lists', type=int, default=4)
+    cmd.add_argument('--notes', type=int, default=20)
+    cmd.set_defaults(func=bench_replication)
+
+    cmd = commands.add_parser('search', help=bench_search.__doc__)
+    cmd.add_argument('--saves', type=int, default=300)
+    cmd.add_argument('--lists', type=int, default=8)
+    cmd.add_argument('--notes', type=int, default=50)
+    cmd.add_argument('--queries', type=int, default=100)
+    cmd.set_defaults(func=bench_search)
+
+    cmd = commands.add_parser('config', help=bench_config.__doc__)
+    cmd.add_argument('--saves', type=int, default=1000)
+    cmd.add_argument('--change-every', type=int, nargs='+', default=[1, 10, 0], help='saves per config change, 0 for never')
+    cmd.add_argument('--boards', type=int, default=20, help='boards in the config')
+    cmd.set_defaults(func=bench_config)
+
+    cmd = commands.add_parser('shards', help=bench_shards.__doc__)
+    cmd.add_argument('--roots', type=int, nargs='+', default=[1, 2, 4, 8], help='roots before one more is added')
+    cmd.add_argument('--points', type=int, nargs='+', default=[16, 128], help='SHARD_POINTS')
+    cmd.add_argument('--boards', type=int, default=20000)
+    cmd.set_defaults(func=bench_shards)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+"""
+    folds the 10-minute buckets of past days under boards/full and boards/nbx into one pack per board per day
+    (or month), see srv.compact_buckets() ; the recent buckets are left as they are, and so is the server,
+    which can keep running -- e.g. from cron, with the same BACKUP_DIR as the server
+
+        python3 nullboard_backup_compact.py --older-than 30
+        python3 nullboard_backup_compact.py --older-than 90 --by month
+        python3 nullboard_backup_compact.py --show boards/nbx/<hostname>/2022-08-05.<board_id>.pack.zip
+        python3 nullboard_backup_compact.py --show boards/nbx/<hostname>/2022-08-05.<board_id>.pack.zip --revision 17
+"""
+
+import sys
+import os
+import argparse
+
+import nullboard_backup_srv as srv
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def show_pack(fullname, revision=None):
+    """ the revisions in a pack, or the text of one of them """
+
+    if revision is None:
+        for revision, member in sorted( srv.pack_index(fullname).items(), key = lambda item: str(item[0]).zfill(20) ):
+            print( f"{revision}\t{member}" )
+        return 0
+
+    text = srv.read_packed_revision( fullname, int(revision) if revision.isdigit() else revision )
+    if text is None:
+        print( f"# nb: no revision {revision} in {fullname!r}", file=sys.stderr )
+        return 1
+
+    print(text)
+    return 0
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--older-than', type=int, default=30, help='days ; the buckets of the last days stay as they are')
+    parser.add_argument('--by', default='day', choices=srv.PACK_PERIODS, help='one pack per board per day, or per month')
+    parser.add_argument('--trees', nargs='+', default=['full', 'nbx'], choices=['full', 'nbx'])
+    parser.add_argument('--show', metavar='PACK', help='list the revisions in a pack (relative to BACKUP_DIR, or not)')
+    parser.add_argument('--revision', help='with --show : print this revision')
+    parser.add_argument('--verbose', '-v', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.show:
+        fullname = args.show if os.path.isfile(args.show) else os.path.join(srv.BACKUP_DIRECTORY, args.show)
+        return show_pack(fullname, args.revision)
+
+    lock_name = os.path.join(srv.BACKUP_DIRECTORY, 'boards', 'locks', 'compact.lock')
+    os.makedirs(os.path.dirname(lock_name), exist_ok = True)
+    with open(lock_name, 'a+b') as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                print( "# nb: another compaction is running", file=sys.stderr )
+                return 1
+
+        stats = srv.compact_buckets( older_than=args.older_than, period=args.by, trees=args.trees, verbose=args.verbose )
+
+    print( f"# {stats['files']} files ({stats['bytes'] / 1024:.1f} KiB) folded into {stats['packs']} packs"
+           + ( f", {stats['skipped']} left as they were" if stats['skipped'] else '' ) )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+"""
+    moves every board that is not under the root SHARDS gives it (see srv.shard_root()) over to that root -- e.g. once
+    a root has been added to SHARDS and the server restarted with it ; a dry-run report of what would move by default ;
+    with the same BACKUP_DIR and SHARDS as the server, which can keep running : a board is moved under its lock, and
+    its catalog rows follow it
+
+        CATALOG=1 SHARDS=/mnt/disk1,/mnt/disk2,/mnt/disk3 python3 nullboard_backup_rebalance.py
+        CATALOG=1 SHARDS=/mnt/disk1,/mnt/disk2,/mnt/disk3 python3 nullboard_backup_rebalance.py --move --verbose
+"""
+
+import sys
+import os
+import glob
+import argparse
+import itertools
+from collections import Counter
+
+import nullboard_backup_srv as srv
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def moved_name(fullname, root, target):
+    """ the same pathname under another root """
+
+    return os.path.join( target, os.path.relpath(os.path.abspath(fullname), root) )
+
+
+def board_moves(rows, target):
+    """
+        the catalog rows of a board => ( [ (source, target), ... ] of its 'nbx' and 'full' files and packs,
+        [ delta chain directories ] ) that are under another root than 'target'
+    """
+
+    moves = []
+    chains = []
+    for row in rows:
+        fullname = os.path.join(srv.BACKUP_DIRECTORY, row['location'])
+        root = srv.root_of(fullname)
+        if root == target:
+            continue
+
+        if row['storage'] == 'delta':
+            if os.path.dirname(fullname) not in chains:
+                chains.append( os.path.dirname(fullname) )
+            continue
+
+        for name in ( fullname, srv.full_twin(fullname) ):
+            if os.path.isfile(name):
+                moves.append( (name, moved_name(name, root, target)) )
+
+    return moves, chains
+
+
+def chain_moves(hostname, board_id, directories, target):
+    """
+        the chains of a board in other roots go before those it has under 'target' (they are older), and so
+        the latter are renumbered => ( [ (source, target), ... ] to rename in place, [ (source, target), ... ] to copy )
+    """
+
+    # // the roots the board was in one after the other, going by when they were last written to
+    older = sorted( ( srv.list_delta_chains(directory) for directory in directories ), key = lambda chains: max( os.path.getmtime(name) for _, _, name in chains ) if chains else 0 )
+    older = list( itertools.chain.from_iterable(older) )
+
+    directory = srv.get_delta_dir(hostname, board_id, target)
+    renames = [ ( name, os.path.join(directory, f"{first_rev}.{len(older) + seq}.chain.jsonl") )
+                for seq, first_rev, name in reversed( srv.list_delta_chains(directory) ) if older ]
+    copies = [ ( name, os.path.join(directory, f"{first_rev}.{seq}.chain.jsonl") ) for seq, (_, first_rev, name) in enumerate(older) ]
+
+    return renames, copies
+
+
+def move_board(hostname, board_id, rows, target, verbose=False):
+    """ moves a board to its root ; returns the ( source, target ) pairs """
+
+    moves, directories = board_moves(rows, target)
+    renames, copies = chain_moves(hostname, board_id, directories, target) if directories else ( [], [] )
+
+    for source, name in renames:
+        os.rename(source, name)
+    for source, name in moves + copies:
+        srv.move_saved_file(source, name)
+
+    # // the copies are on disk before the originals go
+    os.sync()
+    srv.relocate_saved(renames + moves + copies)
+
+    for source, _ in moves:
+        srv.unlink_revision(source)
+        tree = 'full' if os.path.relpath(source, srv.root_of(source)).split(os.sep)[1] == 'full' else 'nbx'
+        srv.remove_empty_directories( os.path.dirname(source), os.path.join(srv.root_of(source), 'boards', tree, hostname) )
+    for source, _ in copies:
+        os.unlink(source)
+    for directory in directories:
+        srv.remove_empty_directories( directory, os.path.join(srv.root_of(directory), 'boards', 'delta') )
+
+    # // a server in another process finds out through the board lock
+    srv.forget_board_state( (hostname, str(board_id)) )
+
+    if verbose:
+        for source, name in renames + moves + copies:
+            print( f"{source} -> {name}" )
+
+    return renames + moves + copies
+
+
+def latest_files(root):
+    """ the 'latest-saved.nbx' and stashed files of a root, which the catalog knows nothing about """
+
+    yield from glob.glob( os.path.join(root, 'boards', '*.latest-saved.nbx') )
+    for pattern in srv.saved_file_patterns('*.latest.json'):
+        yield from glob.glob( os.path.join(root, 'boards', 'stashed', pattern) )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--move', action='store_true', help='move the boards, rather than just report them')
+    parser.add_argument('--verbose', '-v', action='store_true', help='every board (and with --move, every file), not just the totals')
+
+    args = parser.parse_args()
+
+    if not srv.CATALOG:
+        parser.error("the boards are found through the catalog : set CATALOG=1")
+
+    lock_name = os.path.join(srv.BACKUP_DIRECTORY, 'boards', 'locks', 'rebalance.lock')
+    os.makedirs(os.path.dirname(lock_name), exist_ok = True)
+    with open(lock_name, 'a+b') as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                print( "# nb: another rebalance is running", file=sys.stderr )
+                return 1
+
+        # // a catalog the server has not built yet
+        srv.build_catalog()
+        conn = srv.get_catalog()
+        rows = conn.execute('SELECT DISTINCT hostname, board_id, storage, location FROM revisions ORDER BY hostname, board_id').fetchall()
+
+        boards = Counter()
+        total = files = 0
+        for (hostname, board_id), board_rows in itertools.groupby( rows, key = lambda row: (row['hostname'], row['board_id']) ):
+            board_rows = list(board_rows)
+            total += 1
+            target = os.path.abspath( srv.shard_root(board_id) )
+
+            moves, directories = board_moves(board_rows, target)
+            if not moves and not directories:
+                continue
+
+            source = srv.root_of( moves[0][0] if moves else directories[0] )
+            boards[ (source, target) ] += 1
+            if args.verbose:
+                print( f"  {hostname} / board {board_id} : {source} -> {target}" )
+
+            if args.move:
+                with srv.board_lock(hostname, board_id):
+                    # // the catalog could have changed since we read it
+                    board_rows = conn.execute( 'SELECT DISTINCT hostname, board_id, storage, location FROM revisions WHERE hostname = ? AND board_id = ?'
+                                             , (hostname, board_id) ).fetchall()
+                    files += len( move_board(hostname, board_id, board_rows, target, args.verbose) )
+
+        # // a save to the new root could have put a newer one there meanwhile, and then the older one just goes
+        latest = Counter()
+        for root in srv.storage_roots():
+            root = os.path.abspath(root)
+            for fullname in latest_files(root):
+                try:
+                    board_id = srv.saved_board_header( srv.read_text(fullname), 'nbx' )['id']
+                except (OSError, ValueError, EOFError, KeyError, TypeError, AttributeError) as e:
+                    print( f"# nb: leaving {fullname!r} as it is : {e}", file=sys.stderr )
+                    continue
+
+                target = os.path.abspath( srv.shard_root(board_id) )
+                if target == root:
+                    continue
+
+                latest[ (root, target) ] += 1
+                if args.move:
+                    srv.move_saved_file( fullname, moved_name(fullname, root, target) )
+                    os.sync()
+                    srv.unlink_revision(fullname)
+
+    for (source, target), count in sorted(boards.items()):
+        print( f"  {source} -> {target} : {count} boards" )
+    for (source, target), count in sorted(latest.items()):
+        print( f"  {source} -> {target} : {count} latest-saved and stashed boards" )
+
+    moved = sum(boards.values())
+    print( f"# {moved} of {total} boards {'moved' if args.move else 'would be moved'}"
+           + ( f" ({moved / total:.1%})" if total else '' ) + ( f", {files} files" if args.move else '' ) )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
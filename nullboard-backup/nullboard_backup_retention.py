@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+"""
+    the tiered retention of nullboard_backup_srv.py (see RETENTION) by hand : a dry-run report of what it would
+    delete, or a run that deletes it all at once ; with the same BACKUP_DIR as the server, which can keep running
+
+        CATALOG=1 RETENTION='24h:all, 30d:1h, 365d:1d, *:1w' python3 nullboard_backup_retention.py
+        CATALOG=1 python3 nullboard_backup_retention.py --tiers '24h:all, 30d:1h, 365d:1d, *:1w' --verbose
+        CATALOG=1 python3 nullboard_backup_retention.py --tiers '24h:all, 30d:1h, 365d:1d, *:1w' --delete
+"""
+
+import sys
+import argparse
+from collections import Counter
+
+import nullboard_backup_srv as srv
+
+
+def tier_name(tiers, tier):
+
+    if tier is None:
+        return 'past the last tier'
+
+    upto, every = tiers[tier]
+    return ( f"up to {srv.format_duration(upto)}" if upto is not None else 'older' ) + \
+           ( f", 1 per {srv.format_duration(every)}" if every is not None else ', all' )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tiers', default=srv.RETENTION, help='RETENTION by default')
+    parser.add_argument('--delete', action='store_true', help='delete what the report says, rather than just report it')
+    parser.add_argument('--verbose', '-v', action='store_true', help='every revision, not just the totals')
+
+    args = parser.parse_args()
+
+    try:
+        tiers = srv.parse_retention(args.tiers)
+    except ValueError as e:
+        parser.error(str(e))
+    if not tiers:
+        parser.error("no tiers : set RETENTION, or use --tiers")
+
+    if not srv.CATALOG:
+        parser.error("the revisions are found through the catalog : set CATALOG=1")
+
+    # // a catalog the server has not built yet
+    srv.build_catalog()
+    conn = srv.get_catalog()
+    total = conn.execute('SELECT count(*) FROM revisions').fetchone()[0]
+
+    # // the same rounds as the server, all in a row
+    retired = []
+    cursor = [ '', '' ]
+    with srv.retention_turn() as turn:
+        if turn is None:
+            print( "# nb: the server is in the middle of a retention round, try again", file=sys.stderr )
+            return 1
+
+        while True:
+            batch = srv.retention_round( cursor, budget=srv.RETENTION_BATCH, dry_run=not args.delete, tiers=tiers )
+            retired += batch
+            # // back at the start, i.e. every board has been seen
+            if not batch and cursor == [ '', '' ]:
+                break
+
+    by_tier = Counter( tier for _, _, tier in retired )
+    by_board = Counter( (hostname, row['board_id']) for hostname, row, _ in retired )
+
+    if args.verbose:
+        for hostname, row, tier in retired:
+            print( f"{hostname}\t{row['board_id']}\t{row['revision']}\t{srv.strftime('%F %T', srv.localtime(row['saved']))}\t{row['location']}" )
+        print()
+
+    for (hostname, board_id), count in sorted(by_board.items()):
+        print( f"  {hostname} / board {board_id} : {count}" )
+    for tier, count in sorted( by_tier.items(), key = lambda item: len(tiers) if item[0] is None else item[0] ):
+        print( f"  {tier_name(tiers, tier)} : {count}" )
+
+    print( f"# {len(retired)} of {total} revisions {'deleted' if args.delete else 'would be deleted'}" )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
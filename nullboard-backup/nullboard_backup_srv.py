@@ -6,18 +6,60 @@ import re # filename filters
 
 from os.path import join as path_join
 import glob # for stashing and unstashing
+import hashlib # content-addressed storage
+import gzip # compressed storage and requests
+import zlib
+import io
+import codecs # streamed board saves
+import tempfile
+import shutil
+import difflib # delta chains
+import threading
+import itertools
+import functools
+import logging
+import time
+import random # request sampling for the profiler
+import signal
+import atexit
+import sqlite3 # revision catalog
+import zipfile # packs of old revisions
+import bisect
+from contextlib import contextmanager, ExitStack
+
+try:
+    # // lock files, see board_lock()
+    import fcntl
+except ImportError:
+    fcntl = None
+from collections import OrderedDict, Counter as StackCounter
+
+try:
+    # // python 3.14+
+    from compression import zstd
+except ImportError:
+    try:
+        # [ https://python-zstandard.readthedocs.io/ ]
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
 
 ## import time
 from time import localtime, strftime
 
 if 1:
-    from flask import Flask, request, jsonify, abort, make_response # , json
+    from flask import Flask, request, jsonify, abort, make_response, g, has_request_context # , json
     import json
 else:
     from flask import Flask, request, json, jsonify, abort, make_response
 
 # [ https://flask-cors.readthedocs.io/en/3.0.10/ ]
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException, BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+from urllib.parse import unquote_to_bytes
+import urllib.request # replication, see REPLICATE_TO
+import urllib.error
 
 ## import socket
 from socket import gethostname, gethostbyaddr
@@ -38,7 +80,10 @@ from ipaddress import ( IPv4Network as ip_network, IPv4Address as ip_address)
 # constants, globals, etc
 
 ## _DEBUG = 1
-_DEBUG = bool( os.environ.get('DEBUG', '0').strip() )
+_DEBUG = os.environ.get('DEBUG', '0').strip() not in ('', '0')
+
+# with DEBUG on, only log every N-th request (handy under load)
+DEBUG_SAMPLE = max( 1, int(os.environ.get('DEBUG_SAMPLE', '1')) )
 if _DEBUG:
     import cgitb
     cgitb.enable(format='text')
@@ -63,9 +108,118 @@ if BACKUP_DIRECTORY in ('.', ''):
 
 BACKUP_VERIFY_TOKEN = os.environ.get('ACCESS_TOKEN', None)
 
+# storage roots to spread the boards over by a hash of the board id, e.g. '/mnt/disk1,/mnt/disk2' ; see shard_root()
+# the catalog, the locks, the outbox and the configs stay under BACKUP_DIR ; empty means BACKUP_DIR alone
+SHARDS = [ root.strip() for root in os.environ.get('SHARDS', '').split(',') if root.strip() ]
+# points of every root on the hash ring ; more of them spread the boards more evenly
+SHARD_POINTS = int( os.environ.get('SHARD_POINTS', '128') )
+
+# 'plain' : every save writes full copies to 'latest-saved.nbx', 'full/' and 'nbx/' (the original behaviour)
+# 'dedup' : every distinct payload is stored once under 'boards/objects/', and the rest are hard links to it
+# 'delta' : 'nbx/' and 'full/' are replaced by per-board chains of a snapshot plus deltas under 'boards/delta/'
+BOARD_STORAGE = os.environ.get('BOARD_STORAGE', 'plain').strip().lower()
+
+# 'pretty'   : indented json with sorted keys (the original behaviour)
+# 'compact'  : the same json, but without whitespace
+# 'verbatim' : boards are saved exactly as the client has sent them, and anything else as 'compact'
+SAVE_FORMAT = os.environ.get('SAVE_FORMAT', 'pretty').strip().lower()
+
+# write-behind: acknowledge board saves right away, and only save the latest revision of every board
+# once in WRITE_BEHIND_INTERVAL seconds, or once it has been updated WRITE_BEHIND_REVISIONS times ;
+# when more than WRITE_BEHIND_MAX_PENDING boards are waiting, new ones are saved right away
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0').strip() not in ('', '0')
+WRITE_BEHIND_INTERVAL = float( os.environ.get('WRITE_BEHIND_INTERVAL', '10') )
+WRITE_BEHIND_REVISIONS = int( os.environ.get('WRITE_BEHIND_REVISIONS', '20') )
+WRITE_BEHIND_MAX_PENDING = int( os.environ.get('WRITE_BEHIND_MAX_PENDING', '1000') )
+
+# every file is written to a temporary name and renamed into place once its data is on disk ;
+# 'batch'  : the files, and then their directories, are fsync()-ed in rounds shared by all saves waiting at the time,
+#            see GroupCommit ; FSYNC_BATCH_WINDOW seconds (0 by default) lets more saves join a round
+# 'always' : every file is fsync()-ed on its own, as well as its directory
+# 'none'   : the OS syncs whenever it sees fit -- fastest, but a crash could still leave an empty file behind
+DURABILITY = os.environ.get('DURABILITY', 'batch').strip().lower()
+FSYNC_BATCH_WINDOW = float( os.environ.get('FSYNC_BATCH_WINDOW', '0') )
+
+# how many revisions of a board to keep in every 10-minute directory of 'full/' and 'nbx/'
+KEEP_REVISIONS = int( os.environ.get('KEEP_REVISIONS', '5') )
+
+# thin old revisions out in the background, e.g. '24h:all, 30d:1h, 365d:1d, *:1w' (see parse_retention()) ; needs CATALOG
+RETENTION = os.environ.get('RETENTION', '').strip()
+# seconds between two rounds of the retention, each looking at RETENTION_BATCH boards and deleting as many revisions at most
+RETENTION_INTERVAL = float( os.environ.get('RETENTION_INTERVAL', '60') )
+RETENTION_BATCH = int( os.environ.get('RETENTION_BATCH', '200') )
+# only log what the retention would delete
+RETENTION_DRY_RUN = os.environ.get('RETENTION_DRY_RUN', '0').strip() not in ('', '0')
+
+# 'none' : the 'full/', 'nbx/' and 'stashed/' files are plain json (the original behaviour)
+# 'gzip' : they are saved as .gz files
+# 'zstd' : they are saved as .zst files -- needs python 3.14 or the zstandard package, and is 'gzip' otherwise
+# files are read back whatever they were saved with, so this can be changed at any time
+COMPRESS = os.environ.get('COMPRESS', 'none').strip().lower()
+# 1 (fastest) .. 9 for gzip, 1 .. 19 for zstd ; empty for the default (6 and 3)
+COMPRESS_LEVEL = os.environ.get('COMPRESS_LEVEL', '').strip()
+if COMPRESS == 'zstd' and zstd is None:
+    print("# nb: COMPRESS=zstd needs python 3.14 or 'pip3 install zstandard', falling back to gzip")
+    COMPRESS = 'gzip'
+
+# 'delta' storage: start a new snapshot after this many deltas
+DELTA_CHAIN_MAX = int( os.environ.get('DELTA_CHAIN_MAX', '50') )
+
+# 'dev'      : Flask / Werkzeug development server (the original behaviour)
+# 'gunicorn' : a production server with WORKERS processes of THREADS threads each
+SERVER = os.environ.get('SERVER', 'dev').strip().lower()
+SERVER_PORT = int( os.environ.get('PORT', '20002') )
+WORKERS = int( os.environ.get('WORKERS', '2') )
+THREADS = int( os.environ.get('THREADS', '8') )
+KEEPALIVE = int( os.environ.get('KEEPALIVE', '5') )
+# requests larger than that, once decompressed, are rejected with a 413
+MAX_CONTENT_LENGTH = int( os.environ.get('MAX_CONTENT_LENGTH', str(16 * 1024 * 1024)) )
+# board saves larger than that (or of unknown length) are spooled to disk as they come in, see StreamedPayload ;
+# 0 turns it off
+STREAM_THRESHOLD = int( os.environ.get('STREAM_THRESHOLD', str(1024 * 1024)) )
+# the most boards a PUT /boards saves at once
+BATCH_MAX = int( os.environ.get('BATCH_MAX', '1000') )
+
+# a catalog of every saved revision in boards/catalog.sqlite, for GET /board/<id>/revisions ; off by default, since
+# the first start with it reads every saved revision (in a background thread, see build_catalog())
+CATALOG = os.environ.get('CATALOG', '0').strip() not in ('', '0')
+# the most revisions GET /board/<id>/revisions returns at once
+CATALOG_PAGE_MAX = int( os.environ.get('CATALOG_PAGE_MAX', '1000') )
+# bytes of the boards last saved or read that GET /board/<id>/revisions/<revision> serves from memory ; 0 turns it off
+READ_CACHE_SIZE = int( os.environ.get('READ_CACHE_SIZE', str(32 * 1024 * 1024)) )
+# full-text search over the notes of every saved revision, for GET /search ; needs CATALOG, off by default
+SEARCH = os.environ.get('SEARCH', '0').strip() not in ('', '0')
+# seconds between the rounds of the background search indexer, see index_search()
+SEARCH_INTERVAL = float( os.environ.get('SEARCH_INTERVAL', '1') )
+
+# another server like this one to copy every save to, e.g. 'http://backup2:20002' ; empty turns it off
+REPLICATE_TO = os.environ.get('REPLICATE_TO', '').strip().rstrip('/')
+# the X-Access-Token of that server, if it wants one
+REPLICATE_TOKEN = os.environ.get('REPLICATE_TOKEN', '')
+# the most saves sent at once, and the seconds to wait for the peer to take them
+REPLICATE_BATCH = int( os.environ.get('REPLICATE_BATCH', '100') )
+REPLICATE_TIMEOUT = float( os.environ.get('REPLICATE_TIMEOUT', '30') )
+# seconds between two tries after a failure, doubled with every failure in a row up to REPLICATE_BACKOFF_MAX
+REPLICATE_RETRY = float( os.environ.get('REPLICATE_RETRY', '1') )
+REPLICATE_BACKOFF_MAX = float( os.environ.get('REPLICATE_BACKOFF_MAX', '300') )
+
+# request counters and latency histograms, for GET /metrics
+METRICS = os.environ.get('METRICS', '1').strip() not in ('', '0')
+
+# profile this fraction of the requests (0 .. 1) with a stack sampler, see GET /profile ; 0 turns it off
+PROFILE = float( os.environ.get('PROFILE', '0') )
+# seconds between two samples of the stack of a profiled request
+PROFILE_INTERVAL = float( os.environ.get('PROFILE_INTERVAL', '0.001') )
+# the profiles are written there as <route>.<pid>.folded on exit, or on PUT /profile with 'dump'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '') or path_join(BACKUP_DIRECTORY, 'profiles')
+
 app = Flask(__name__)
 CORS(app)
 
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# // a board comes in a single form field, which newer Flask versions would otherwise limit to 500K
+app.config['MAX_FORM_MEMORY_SIZE'] = MAX_CONTENT_LENGTH
+
 
 # [ https://stackoverflow.com/questions/14853694/python-jsonify-dictionary-in-utf-8/39561607#39561607 ]
 ## app.config['JSON_AS_ASCII'] = False
@@ -114,11 +268,70 @@ BACKUP_LOGIC_DESCRIPTION = """
 # ---------------------------------------------------------------------
 # quick debug prints
 
-# // of course there is logging, but I have no time for this 
+log = logging.getLogger('nullboard_backup')
+if not log.handlers:
+    _log_handler = logging.StreamHandler(sys.stderr)
+    _log_handler.setFormatter( logging.Formatter('%(message)s') )
+    log.addHandler(_log_handler)
+    log.propagate = False
+log.setLevel( logging.DEBUG if _DEBUG else logging.INFO )
+
+# // every DEBUG_SAMPLE-th request, see before()
+_request_counter = itertools.count()
+
+
+class _DebugLine:
+    """ the "# origin => host : method : url : message" text, only built if it is actually logged """
+
+    __slots__ = ('request', 'fmt', 'args')
+
+    def __init__(self, request, fmt, args):
+        self.request = request
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        request = self.request
+        if request is None:
+            # // e.g. the write-behind thread
+            logline = f"[{threading.current_thread().name}]"
+        else:
+            logline = f"{request.origin} => {request.host} : {request.method.lower()} : {request.url!r}"
+
+        message = DebugOutput.format(self.fmt, *self.args)
+        text = f"# {logline} : {message}"
+
+        # memorize last '\n'
+        end = ''
+        if text.endswith('\n'):
+            text = text[:-1]
+            end = '\n'
+
+        return '# ' + '\n# '.join(text.split('\n')) + end
+
+
 class DebugOutput:
+    """
+        debug prints of a request, on top of 'logging' ;
+        a disabled call does not format anything, so one can leave them in the hot path
+    """
+
+    __slots__ = ('request',)
 
     def __init__(self, request):
-        self.logline = f"{request.origin} => {request.host} : {request.method.lower()} : {request.url!r}"
+        self.request = request
+
+    @staticmethod
+    def enabled():
+        """ True if debugging is on and the current request is one of the sampled ones """
+
+        if not log.isEnabledFor(logging.DEBUG):
+            return False
+
+        if has_request_context():
+            return g.get('debug', True)
+
+        return True
 
     @classmethod
     def format(cls, fmt, *args):
@@ -132,27 +345,17 @@ class DebugOutput:
 
 
     @classmethod
-    def output(cls, fmt, *args, **kwargs):
-        """ uses f"" for keyword arguments, % for *args, and **kwrags to control print() """
-        if _DEBUG:
-            text = cls.format(fmt, *args)
-            print( text, file=sys.stderr, **kwargs )
+    def output(cls, fmt, *args):
+        """ uses % for *args, lazily """
+        if cls.enabled():
+            log.debug(fmt, *args)
 
     # a shorter alias
     out = output
 
-    def _dbg(self, fmt, *args, **kwargs):
-        message = self.format(fmt, *args)
-        text = f"# {self.logline} : {message}"
-
-        # memorize last '\n'
-        end = ''
-        if text.endswith('\n'):
-            text = text[:-1]
-            end = '\n'
-
-        formatted = '# ' + '\n# '.join(text.split('\n')) + end
-        self.output( formatted, **kwargs )
+    def _dbg(self, fmt, *args):
+        if self.enabled():
+            log.debug( '%s', _DebugLine(self.request, fmt, args) )
 
     # a shortcut
     __call__ = _dbg
@@ -164,6 +367,456 @@ Dbg = DebugOutput
 # another alias )
 _debug = DebugOutput.output
 
+# ---------------------------------------------------------------------
+# metrics, in the Prometheus text format
+
+# // every metric is a dict under its own lock, so counting is an addition and an uncontended lock ;
+# // with WORKERS > 1 every worker process counts its own requests, and the counts are added up, see share_metrics()
+
+# [ https://prometheus.io/docs/instrumenting/exposition_formats/ ]
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+
+
+def _label_value(value):
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+
+    labels = [ f'{name}="{_label_value(value)}"' for name, value in zip(names, values) ]
+    if extra:
+        labels.append(extra)
+
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock   = threading.Lock()
+
+        _metrics.append(self)
+
+    def snapshot(self):
+        """ { labels : value } as they are now """
+
+        with self.lock:
+            return { k : list(v) if isinstance(v, list) else v for k, v in self.values.items() }
+
+    def lines(self, values=None):
+        """ 'values' : see snapshot(), this process' own by default """
+
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+        for labels, value in sorted( (values if values is not None else self.snapshot()).items() ):
+            yield from self.format(labels, value)
+
+    def format(self, labels, value):
+
+        yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+
+        if METRICS:
+            with self.lock:
+                self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+
+        if not METRICS:
+            return
+
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels, None)
+            if entry is None:
+                # // [ count per bucket ..., count above the last one, sum ]
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[i] += 1
+            entry[-1] += value
+
+    def format(self, labels, value):
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), value):
+            cumulative += count
+            le = 'le="%s"' % bound
+            yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(self.labels, labels)} {value[-1]}"
+        yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauge(Metric):
+    """ a value read when the metrics are, e.g. a queue length """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self.read = read
+
+    def lines(self, values=None):
+
+        # // of this process only, see share_metrics()
+        self.values = { () : self.read() }
+        return super().lines()
+
+
+requests_total   = Counter( 'nullboard_requests_total', 'Requests by route, method and status code', ('route', 'method', 'status') )
+request_seconds  = Histogram( 'nullboard_request_seconds', 'Request latency by route', ('route',) )
+request_bytes    = Counter( 'nullboard_request_bytes_total', 'Request body bytes received by route', ('route',) )
+phase_seconds    = Histogram( 'nullboard_phase_seconds', 'Time spent in each phase of a request (phases may nest, e.g. fsync in write)', ('phase',) )
+written_bytes    = Counter( 'nullboard_written_bytes_total', 'Bytes written to board, stash and config files' )
+pruned_revisions = Counter( 'nullboard_pruned_revisions_total', 'Old revisions deleted by the retention' )
+replicated_total = Counter( 'nullboard_replicated_total', 'Saves sent to REPLICATE_TO, or taken from another server', ('direction',) )
+replication_failures = Counter( 'nullboard_replication_failures_total', 'Failed tries to send a batch to REPLICATE_TO' )
+read_cache_total = Counter( 'nullboard_read_cache_total', 'Boards unstashed or read by revision, from memory (hit) or from disk (miss)', ('result',) )
+other_saves_total = Counter( 'nullboard_config_saves_total', 'PUT /config (and such) saved, or skipped as the same as the last one', ('dir', 'result') )
+
+
+@contextmanager
+def measure(phase):
+    """ with measure('write'): ... -- adds the time spent to the 'phase' histogram """
+
+    if not METRICS:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_seconds.observe( time.perf_counter() - started, phase )
+
+
+# // with several gunicorn workers, a scrape would get the counts of whichever worker answers it ; so every worker
+# // writes its counters and histograms to boards/metrics/<pid>.json every METRICS_SHARE_INTERVAL seconds (and as it
+# // answers /metrics), and /metrics adds up those of all workers -- including the ones that are gone, so that the
+# // totals never go down while the server runs ; gauges are those of the worker that answers
+
+METRICS_SHARE_INTERVAL = 5
+
+# // set by run_production_server() for WORKERS > 1, before the workers are forked
+_metrics_shared = False
+_metrics_thread = None
+_metrics_thread_lock = threading.Lock()
+
+
+def get_metrics_dir():
+
+    return path_join(BACKUP_DIRECTORY, 'boards', 'metrics')
+
+
+def share_metrics():
+    """ writes the counts of this process for the others to add up """
+
+    values = { metric.name : [ [ list(labels), value ] for labels, value in metric.snapshot().items() ]
+               for metric in _metrics if not isinstance(metric, Gauge) }
+
+    fullname = path_join( get_metrics_dir(), f"{os.getpid()}.json" )
+    os.makedirs(os.path.dirname(fullname), exist_ok = True)
+    # // nothing to sync : they are gone with the server anyway
+    with open(temp_name(fullname), 'w', encoding='utf-8') as f:
+        json.dump(values, f)
+    os.replace(temp_name(fullname), fullname)
+
+
+def shared_metrics():
+    """ { metric name : { labels : value } } added up over every worker """
+
+    totals = {}
+    for fullname in glob.glob( path_join(get_metrics_dir(), '*.json') ):
+        try:
+            with open(fullname, 'rt', encoding='utf-8') as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        for name, entries in values.items():
+            metric_totals = totals.setdefault(name, {})
+            for labels, value in entries:
+                labels = tuple(labels)
+                if isinstance(value, list):
+                    total = metric_totals.get(labels, None) or [0] * len(value)
+                    metric_totals[labels] = [ a + b for a, b in zip(total, value) ]
+                else:
+                    metric_totals[labels] = metric_totals.get(labels, 0) + value
+
+    return totals
+
+
+def run_metrics_sharer():
+
+    while True:
+        time.sleep(METRICS_SHARE_INTERVAL)
+        try:
+            share_metrics()
+        except Exception:
+            log.exception( "[error] failed to share the metrics" )
+
+
+def start_metrics_sharer():
+    """ starts sharing the metrics of this worker, if there are several ; cheap to call again """
+
+    global _metrics_thread
+
+    if _metrics_thread is not None or not _metrics_shared or not METRICS:
+        return
+
+    with _metrics_thread_lock:
+        if _metrics_thread is None:
+            _metrics_thread = threading.Thread(target=run_metrics_sharer, name='metrics', daemon=True)
+            _metrics_thread.start()
+            atexit.register(share_metrics)
+
+
+def render_metrics():
+
+    totals = None
+    if _metrics_shared:
+        start_metrics_sharer()
+        share_metrics()
+        totals = shared_metrics()
+
+    lines = []
+    for metric in _metrics:
+        values = totals.get(metric.name, {}) if totals is not None and not isinstance(metric, Gauge) else None
+        lines.extend( metric.lines(values) )
+
+    return '\n'.join(lines) + '\n'
+
+
+def access_token_accepted(access_token, authorization=None):
+    """
+        True unless ACCESS_TOKEN is set and the client has not sent it, as X-Access-Token ; for /metrics it could
+        also come as 'Authorization: Bearer <token>', which is what Prometheus sends
+    """
+
+    if not BACKUP_VERIFY_TOKEN:
+        return True
+
+    if access_token is None and authorization and authorization.startswith('Bearer '):
+        access_token = authorization[len('Bearer '):].strip()
+
+    return access_token == BACKUP_VERIFY_TOKEN
+
+
+# ---------------------------------------------------------------------
+# profiling
+
+# // these are not profiled
+PROFILE_SKIP = ('/profile', '/metrics')
+
+_frame_names = {}
+
+
+def frame_name(code):
+    """ 'function (file.py:line)', as py-spy names them """
+
+    name = _frame_names.get(code, None)
+    if name is None:
+        name = _frame_names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    return name
+
+
+def collapse_stack(frame):
+    """ 'outermost;...;innermost' """
+
+    names = []
+    while frame is not None:
+        names.append( frame_name(frame.f_code) )
+        frame = frame.f_back
+
+    return ';'.join( reversed(names) )
+
+
+class StackSampler:
+    """
+        a sampling profiler : while a profiled request runs, a background thread looks at the stack
+        of the thread serving it every 'interval' seconds, and counts the stacks it sees per route ;
+        the counts are the "collapsed stacks" that flamegraph.pl, inferno or speedscope load
+    """
+
+    def __init__(self, rate, interval):
+        self.rate     = rate
+        self.interval = interval
+
+        self.stacks = {}    # // route -> { stack : samples }
+        self.active = {}    # // thread id -> route
+        self.lock   = threading.Lock()
+        self.wake   = threading.Event()
+        self.thread = None
+
+    def sampled(self):
+        """ shall this request be profiled ? """
+
+        return self.rate > 0 and random.random() < self.rate
+
+    def start(self, route):
+
+        with self.lock:
+            self.active[threading.get_ident()] = route
+            # // started on first use, so that every gunicorn worker has its own
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='nullboard-profiler', daemon=True)
+                self.thread.start()
+
+        self.wake.set()
+
+    def stop(self):
+
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    @contextmanager
+    def profile(self, route):
+        """ with profiler.profile(route): ... -- profiles the current thread """
+
+        self.start(route)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def run(self):
+
+        while True:
+            self.wake.wait()
+
+            with self.lock:
+                active = list(self.active.items())
+                if not active:
+                    self.wake.clear()
+                    continue
+
+            frames = sys._current_frames()
+            stacks = [ (route, collapse_stack(frames[ident])) for ident, route in active if ident in frames ]
+            del frames
+
+            with self.lock:
+                for route, stack in stacks:
+                    self.stacks.setdefault(route, StackCounter())[stack] += 1
+
+            time.sleep(self.interval)
+
+    def reset(self):
+
+        with self.lock:
+            self.stacks = {}
+
+    def samples(self):
+        """ { route : samples } """
+
+        with self.lock:
+            return { route : sum(counts.values()) for route, counts in self.stacks.items() }
+
+    def folded(self, route=None):
+        """ the collapsed stacks of a route, or of every route with the route as the outermost frame """
+
+        with self.lock:
+            if route is not None:
+                items = list( self.stacks.get(route, {}).items() )
+            else:
+                items = [ (f"{r};{stack}", n) for r, counts in self.stacks.items() for stack, n in counts.items() ]
+
+        return ''.join( f"{stack} {n}\n" for stack, n in sorted(items) )
+
+    def dump(self, directory=None):
+        """ writes e.g. board-id.<pid>.folded for '/board/<id>' into PROFILE_DIR ; returns the file names """
+
+        directory = directory or PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+
+        names = []
+        for route in sorted( self.samples() ):
+            name = re.sub(r'[^\w.]+', '-', route).strip('-') or 'root'
+            fullname = path_join( directory, f"{name}.{os.getpid()}.folded" )
+            with open(fullname, 'w', encoding='utf-8') as f:
+                f.write( self.folded(route) )
+            names.append(fullname)
+
+        return names
+
+
+profiler = StackSampler(PROFILE, PROFILE_INTERVAL)
+
+
+@atexit.register
+def _dump_profiles():
+
+    if profiler.samples():
+        for fullname in profiler.dump():
+            log.info("# profile: %s", fullname)
+
+
+def read_profile(args):
+    """ GET /profile : the collapsed stacks, of every route or of ?route=/board/<id> """
+
+    return profiler.folded( args.get('route') or None ), RETURN_200_OK
+
+
+def profile_status():
+
+    return { 'rate' : profiler.rate, 'interval' : profiler.interval, 'samples' : profiler.samples() }
+
+
+def configure_profile(data):
+    """ PUT /profile : 'rate' (0 .. 1) sets the fraction of the requests profiled, 'reset' and 'dump' do what they say """
+
+    data = data or {}
+
+    if data.get('rate', '') != '':
+        try:
+            rate = float( data.get('rate') )
+        except (TypeError, ValueError):
+            rate = -1
+        if not 0 <= rate <= 1:
+            return { 'error' : "'rate' shall be a number between 0 and 1" }, RETURN_400_BAD_REQUEST
+        profiler.rate = rate
+
+    if str( data.get('reset', '') ).strip() not in ('', '0', 'false', 'False'):
+        profiler.reset()
+
+    result = profile_status()
+    if str( data.get('dump', '') ).strip() not in ('', '0', 'false', 'False'):
+        result['files'] = profiler.dump()
+
+    return result, RETURN_200_OK
+
+
+def reset_profile():
+    """ DELETE /profile """
+
+    profiler.reset()
+    return profile_status(), RETURN_200_OK
+
+
 # ---------------------------------------------------------------------
 # code ))
 
@@ -211,18 +864,25 @@ def get_request_data( request ):
 def get_json_data( request ):
     """
         get the .data part of the board
+        
+        nb: parsed once per request, see 'g.board_data'
     """
-    
+
+    if 'board_data' in g:
+        return g.board_data
+
     _dbg = Dbg(request)
     
     json_data = None
     if request.mimetype == 'application/x-www-form-urlencoded':
-        data = request.form
+        with measure('form'):
+            data = request.form
         if getattr(data, '__getitem__', None) is not None:
             ## print(f"get_json_data() => {data}", file=sys.stderr)
             ## json_data = json.loads(data.get('data', '{}'))
             json_as_text = data.get('data', '{}')
-            json_data = json.loads(json_as_text) if json_as_text else {}
+            with measure('decode'):
+                json_data = json.loads(json_as_text) if json_as_text else {}
 
     elif request.mimetype in ('application/json', 'text/javascript'):
         # [ https://stackoverflow.com/questions/20001229/how-to-get-posted-json-in-flask ]
@@ -230,8 +890,9 @@ def get_json_data( request ):
         json_data = request.get_json()
 
     else:
-        _dbg(f"[dbg] unexpected request type: {request.mimetype!r}")
+        _dbg("[dbg] unexpected request type: %r", request.mimetype)
 
+    g.board_data = json_data
     return json_data
     
 
@@ -246,175 +907,3962 @@ def get_request_board_data( request ):
     return data
 
 
-# ---------------------------------------------------------------------
+def get_board_text( request ):
+    """
+        the board exactly as it was sent by the client, or None
+    """
 
-def time_to_subpath(t_tuple):
-    """ "2021-12-31 18:12" -> '2021-12-31/18/10'  """
+    text = None
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        text = request.form.get('data', None)
+    elif request.mimetype in ('application/json', 'text/javascript'):
+        text = request.get_data(as_text=True)
 
-    minutes = ( t_tuple.tm_min // 10 ) * 10   
-    datedir = strftime('%F/%H')
-    
-    result = path_join(datedir, str(minutes))
-    
-    return result
+    return text or None
 
 
-def time_to_filename( t_tuple ):
-    """ add the current date / time to the filename """
+# // Nullboard sends its boards as {"format":...,"id":...,"revision":...,"title":...,"lists":[...]},
+# // so everything we need for the filenames comes before "lists"
+RE_BOARD_LISTS_KEY = re.compile( r'[{,]\s*"lists"\s*:' )
 
-    # just use the current date for now )
-    datestamp = strftime('%F', t_tuple)
-    return datestamp
+def scan_board_header( text, whole=True ):
+    """
+        '{"id":1,"title":"x","lists":[...]}' -> {'id': 1, 'title': 'x'}, or None if it does not look like that ;
+        never mistakes a nested "lists" for the top-level one, since a cut inside a nested value does not parse ;
+        'whole=False' : 'text' is just the start of the board, see StreamedPayload
+    """
 
+    match = RE_BOARD_LISTS_KEY.search(text)
+    if match is None or ( whole and not text.rstrip().endswith('}') ):
+        return None
 
-def get_host_name(request):
+    try:
+        header = json.loads( text[:match.start()] + '}' )
+    except ValueError:
+        return None
 
-    hostname = None
-    if request is not None:
-        # [ https://werkzeug.palletsprojects.com/en/2.0.x/wrappers/#werkzeug.wrappers.Request.remote_addr ]
-        ip_addr = request.remote_addr
-        #hostname = gethostbyaddr(ip_addr)[0]
-        #hostname = HOST_ALIASES.get(hostname, hostname).lower()
-        
-        # Set simply client_ip_addr=hostname cause this was causing problems
-        hostname = ip_addr
+    # // e.g. sorted keys, with "lists" before "revision" and "title" -- the filenames need all three
+    if not isinstance(header, dict) or not all( key in header for key in ('id', 'revision', 'title') ):
+        return None
+
+    return header
+
+
+def format_json( data ):
+    """ the text we save, see SAVE_FORMAT """
+
+    with measure('encode'):
+        if SAVE_FORMAT == 'pretty':
+            # [ https://stackoverflow.com/questions/14853694/python-jsonify-dictionary-in-utf-8/39561607 ]
+            return json.dumps(data, indent=4, sort_keys=True, ensure_ascii=False)
+
+        return json.dumps(data, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+
+
+def format_board( request ):
+    """ the board text we save, see SAVE_FORMAT ; None if there is no board """
+
+    if SAVE_FORMAT == 'verbatim':
+        text = get_board_text(request)
+        if text is not None:
+            return text
+
+    data = get_json_data(request)
+    if data is None:
+        return None
+
+    return format_json(data)
+
+
+class BoardPayload:
+    """
+        a board save detached from its request, so that it could also be stored later (see WRITE_BEHIND) ;
+        'fields' are the form fields as sent by Nullboard : 'self', 'data' and 'meta'
+    """
+
+    # // see StreamedPayload
+    streamed = False
+    # // taken from another server, see apply_replicated() -- and so not to be sent on
+    replica = False
+
+    def __init__(self, board_id, hostname, fields, t_now=None):
+        self.board_id = board_id
+        self.hostname = hostname
+        self.fields   = fields
+        self.t_now    = t_now if t_now is not None else localtime()
+
+        self._board  = None
+        self._header = None
+
+    @classmethod
+    def from_request(cls, board_id, request):
+
+        with measure('form'):
+            fields = request.form.to_dict()
+
+        payload = cls( board_id, get_host_name(request), fields )
+        if 'board_data' in g:
+            payload._board = g.board_data
+
+        return payload
+
+    def board_text(self):
+        """ the board exactly as it was sent by the client, or None """
+
+        return self.fields.get('data', None) or None
+
+    def board(self):
+        """ the whole board, parsed once """
+
+        if self._board is None:
+            text = self.board_text()
+            with measure('decode'):
+                self._board = json.loads(text) if text else {}
+
+        return self._board
+
+    def header(self):
+        """
+            just enough of the board to check its id and name the files : 'id', 'title', 'revision' ;
+            does not parse the whole board if it can be helped
+        """
+
+        if self._header is None:
+            text = self.board_text()
+            if self._board is None and text is not None:
+                with measure('decode'):
+                    self._header = scan_board_header(text)
+
+            if self._header is None:
+                self._header = self.board()
+
+        return self._header
+
+    def format_board(self):
+        """ the board text we save, see SAVE_FORMAT """
+
+        if SAVE_FORMAT == 'verbatim' and self.board_text() is not None:
+            return self.board_text()
+
+        return format_json(self.board())
+
+    def format_full(self):
+        """ everything we have been sent """
+
+        return format_json(self.fields)
+
+    def field(self, name):
+        """ a form field as text, or None """
+
+        return self.fields.get(name, None)
+
+
+# ---------------------------------------------------------------------
+# streamed board saves, see STREAM_THRESHOLD
+
+# // how much of a streamed request is read, decompressed or parsed at a time
+STREAM_CHUNK = 64 * 1024
+
+def get_spool_dir():
+
+    return path_join(BACKUP_DIRECTORY, 'boards', 'spool')
+
+
+def stream_board(mimetype, content_length):
+    """ shall this board save be spooled to disk as it comes in, see StreamedPayload """
+
+    return ( STREAM_THRESHOLD > 0 and mimetype == 'application/x-www-form-urlencoded'
+             and ( content_length is None or content_length > STREAM_THRESHOLD ) )
+
+
+class SpooledFile:
+    """ a text too large to be kept in memory, in a file under boards/spool/ ; could also be its compressed bytes """
+
+    def __init__(self, compressed=False):
+
+        directory = get_spool_dir()
+        os.makedirs(directory, exist_ok = True)
+        fd, self.fullname = tempfile.mkstemp(dir=directory, suffix='.spool')
+
+        self.file       = os.fdopen(fd, 'wb')
+        self.compressed = compressed
+        self.size       = 0
+
+        self._sha256 = None
+        self._compressed_copy = None
+
+    def write(self, text):
+
+        self.file.write( text.encode('utf-8') )
+
+    def finish(self):
+        """ no more writes """
+
+        if not self.file.closed:
+            self.size = self.file.tell()
+            self.file.close()
+
+        return self
+
+    def chunks(self):
+
+        with open(self.fullname, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+    def text_chunks(self):
+
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for chunk in self.chunks():
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+
+    def sha256(self):
+
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            for chunk in self.chunks():
+                digest.update(chunk)
+            self._sha256 = digest.hexdigest()
+
+        return self._sha256
+
+    def compressed_copy(self):
+        """ a SpooledFile of this one compressed as COMPRESS says, removed along with it """
+
+        if self._compressed_copy is None:
+            copy = SpooledFile(compressed=True)
+            try:
+                with measure('compress'):
+                    writer = compressing_writer(copy.file, self.size)
+                    for chunk in self.chunks():
+                        writer.write(chunk)
+                    writer.close()
+                copy.finish()
+            except BaseException:
+                copy.remove()
+                raise
+            self._compressed_copy = copy
+
+        return self._compressed_copy
+
+    def remove(self):
+
+        if self._compressed_copy is not None:
+            self._compressed_copy.remove()
+
+        self.file.close()
+        try:
+            os.unlink(self.fullname)
+        except FileNotFoundError:
+            pass
+
+
+# // the '=' or '&' that ends a field name
+RE_FORM_NAME_END = re.compile( rb'[=&]' )
+
+class FormSpooler:
+    """
+        parses an 'application/x-www-form-urlencoded' body as it comes in, see feed() :
+        'data' and 'meta' go to SpooledFile-s, the other fields stay in memory (up to STREAM_CHUNK bytes each) ;
+        the start and the end of 'data' are kept as well, for scan_board_header()
+    """
+
+    SPOOLED = ('data', 'meta')
+
+    def __init__(self):
+        self.fields = {}
+        self.spools = {}
+        self.head   = ''
+        self.tail   = ''
+
+        self._pending  = b''        # // a '%XX' cut between two chunks
+        self._name     = b''
+        self._in_value = False
+        self._field    = None
+        self._sink     = None       # // a SpooledFile, a list of texts, or None for a field we ignore
+        self._decoder  = None
+
+    def feed(self, data):
+
+        data = self._pending + data
+
+        # // '...%4' + '1...' : the escape waits for the next chunk
+        cut = data.find( b'%', max(0, len(data) - 2) )
+        if cut != -1:
+            data, self._pending = data[:cut], data[cut:]
+        else:
+            self._pending = b''
+
+        self._parse(data)
+
+    def close(self):
+        """ the body is over """
+
+        # // not an escape after all
+        data, self._pending = self._pending, b''
+        self._parse(data)
+
+        if self._in_value:
+            self._end_value()
+        elif self._name:
+            self._start_value()
+            self._end_value()
+
+        return self
+
+    def remove(self):
+
+        for spool in self.spools.values():
+            spool.remove()
+
+    def _parse(self, data):
+
+        pos = 0
+        while pos < len(data):
+            if not self._in_value:
+                match = RE_FORM_NAME_END.search(data, pos)
+                end = match.start() if match else len(data)
+                self._name += data[pos:end]
+                if len(self._name) > STREAM_CHUNK:
+                    raise RequestEntityTooLarge()
+                if match is None:
+                    return
+
+                # // '&&' is no field at all, as for request.form
+                if self._name or match.group() == b'=':
+                    self._start_value()
+                    if match.group() == b'&':
+                        self._end_value()
+            else:
+                end = data.find(b'&', pos)
+                if end == -1:
+                    end = len(data)
+                if end > pos:
+                    self._write( self._decoder.decode( unquote_to_bytes( data[pos:end].replace(b'+', b' ') ) ) )
+                if end == len(data):
+                    return
+
+                self._end_value()
+
+            pos = end + 1
+
+    def _start_value(self):
+
+        name = unquote_to_bytes( self._name.replace(b'+', b' ') ).decode('utf-8', 'replace')
+        self._name     = b''
+        self._in_value = True
+        self._field    = name
+        self._decoder  = codecs.getincrementaldecoder('utf-8')('replace')
+
+        # // the first one wins, as with request.form.to_dict()
+        if name in self.fields or name in self.spools:
+            self._sink = None
+        elif name in self.SPOOLED:
+            self._sink = self.spools[name] = SpooledFile()
+        else:
+            self._sink = []
+
+    def _write(self, text):
+
+        sink = self._sink
+        if isinstance(sink, SpooledFile):
+            sink.write(text)
+            if self._field == 'data':
+                if len(self.head) < STREAM_CHUNK:
+                    self.head += text[:STREAM_CHUNK - len(self.head)]
+                self.tail = (self.tail + text)[-16:]
+
+        elif sink is not None:
+            sink.append(text)
+            if sum( len(t) for t in sink ) > STREAM_CHUNK:
+                raise RequestEntityTooLarge()
+
+    def _end_value(self):
+
+        self._write( self._decoder.decode(b'', final=True) )
+
+        if isinstance(self._sink, SpooledFile):
+            self._sink.finish()
+        elif self._sink is not None:
+            self.fields[self._field] = ''.join(self._sink)
+
+        self._in_value = False
+        self._sink     = None
+
+
+def feed_form(form, decoder, chunk):
+    """ a chunk of a request body (None at its end) => FormSpooler, decompressed by 'decoder' if not None """
+
+    if chunk is None:
+        if decoder is not None:
+            decoder.close()
+        form.close()
+        return
+
+    for data in ( decoder.feed(chunk) if decoder is not None else (chunk,) ):
+        form.feed(data)
+
+
+class StreamedPayload(BoardPayload):
+    """
+        a board save too large to be kept in memory, see STREAM_THRESHOLD : 'data' and 'meta' are spooled to disk,
+        and only the header of the board is parsed ; saved as it was sent, whatever SAVE_FORMAT says
+    """
+
+    streamed = True
+
+    def __init__(self, board_id, hostname, form, t_now=None):
+        super().__init__( board_id, hostname, form.fields, t_now )
+        self.form  = form
+        self._full = None
+
+    @classmethod
+    def from_stream(cls, board_id, hostname, stream, decoder=None):
+
+        form = FormSpooler()
+        try:
+            with measure('form'):
+                for chunk in iter( functools.partial(stream.read, STREAM_CHUNK), b'' ):
+                    feed_form(form, decoder, chunk)
+                feed_form(form, decoder, None)
+        except BaseException:
+            form.remove()
+            raise
+
+        return cls(board_id, hostname, form)
+
+    def board_text(self):
+        """ never kept in memory, see format_board() """
+
+        return None
+
+    def board(self):
+        """ the whole board, parsed from its spool file -- only for what cannot do without it (BOARD_STORAGE=delta) """
+
+        if self._board is None:
+            spool = self.form.spools.get('data', None)
+            with measure('decode'):
+                self._board = json.loads( ''.join(spool.text_chunks()) ) if spool is not None and spool.size else {}
+
+        return self._board
+
+    def header(self):
+
+        if self._header is None:
+            if self.form.tail.rstrip().endswith('}'):
+                with measure('decode'):
+                    self._header = scan_board_header(self.form.head, whole=False)
+
+            if self._header is None:
+                self._header = self.board()
+
+        return self._header
+
+    def format_board(self):
+        """ the spooled board, exactly as it was sent """
+
+        spool = self.form.spools.get('data', None)
+        if spool is None or not spool.size:
+            return None
+
+        return spool
+
+    def format_full(self):
+        """ everything we have been sent, spooled as format_json() would have formatted it """
+
+        if self._full is not None:
+            return self._full
+
+        names = sorted( set(self.fields) | set(self.form.spools) )
+        pretty = SAVE_FORMAT == 'pretty'
+
+        spool = self._full = SpooledFile()
+        with measure('encode'):
+            spool.write( '{\n' if pretty and names else '{' )
+            for i, name in enumerate(names):
+                if i:
+                    spool.write( ',\n' if pretty else ',' )
+                spool.write( ('    ' if pretty else '') + json.dumps(name, ensure_ascii=False) + (': "' if pretty else ':"') )
+
+                # // a string escapes the same way a piece at a time
+                source = self.form.spools.get(name, None)
+                for text in ( source.text_chunks() if source is not None else (self.fields[name],) ):
+                    spool.write( json.dumps(text, ensure_ascii=False)[1:-1] )
+                spool.write('"')
+            spool.write( '\n}' if pretty and names else '}' )
+        spool.finish()
+
+        return spool
+
+    def field(self, name):
+
+        spool = self.form.spools.get(name, None)
+        if spool is not None:
+            return ''.join( spool.text_chunks() )
+
+        return super().field(name)
+
+    def close(self):
+        """ removes the spool files """
+
+        self.form.remove()
+        if self._full is not None:
+            self._full.remove()
+
+
+# ---------------------------------------------------------------------
+
+def time_to_subpath(t_tuple):
+    """ "2021-12-31 18:12" -> '2021-12-31/18/10'  """
+
+    minutes = ( t_tuple.tm_min // 10 ) * 10   
+    datedir = strftime('%F/%H', t_tuple)
+    
+    result = path_join(datedir, str(minutes))
+    
+    return result
+
+
+def time_to_filename( t_tuple ):
+    """ add the current date / time to the filename """
+
+    # just use the current date for now )
+    datestamp = strftime('%F', t_tuple)
+    return datestamp
+
+
+def get_host_name(request):
+
+    hostname = None
+    if request is not None:
+        # [ https://werkzeug.palletsprojects.com/en/2.0.x/wrappers/#werkzeug.wrappers.Request.remote_addr ]
+        ip_addr = request.remote_addr
+        #hostname = gethostbyaddr(ip_addr)[0]
+        #hostname = HOST_ALIASES.get(hostname, hostname).lower()
+        
+        # Set simply client_ip_addr=hostname cause this was causing problems
+        hostname = ip_addr
+
+    return hostname
+
+
+def sanitize_filename(filename, _re_filter = RE_SPECIAL):
+
+    result = _re_filter.sub('_', filename)
+    return result
+
+def check_board_id( board_id, json_data ):
+    """ the board id from the request path shall be the same as the one in the board """
+
+    if json_data and board_id:
+        _board_id = int(board_id)
+        board_id_ = json_data.get('id', -1)
+        ## _dbg(f"[dbg] board_id (path) {board_id!r} ({_board_id!r}) == board_id (data) {board_id_!r} ?")
+        assert _board_id == board_id_
+
+
+# // makes a list of essential filename parts from available components (board data, time, string prefix/suffix parts)
+def make_filename_parts( board_id, json_data=None, t_tuple=None, prefix=None, suffix=None, use_rev = True ):
+    """ ( ... , 'data latest nbx'.split() ) => [ hostname, board_name, {datestamp}, data.latest.nbx ] """
+
+    _dbg = Dbg(request)
+
+    ## # this is expected to come from a "/board/<id>" route and shall not be None ))
+    ## assert board_id
+
+    board_name = None
+    board_rev = None
+    if json_data:
+        check_board_id( board_id, json_data )
+
+        board_name = json_data.get('title', '').strip()
+        board_name = sanitize_filename( board_name )
+        # remove spaces
+        # board_name = '.'.join(board_name.split())
+        board_name = '_'.join(board_name.split())
+        
+        if use_rev:
+            board_rev = json_data.get('revision', None)
+        else:
+            board_rev = ''
+
+    timestamp = None
+    if t_tuple is not None:
+        timestamp = time_to_filename( t_tuple )
+
+    parts = (prefix, board_name, board_id, board_rev, timestamp, suffix)
+    parts = [ str(p) for p in parts if p ]
+
+    return parts
+
+
+def make_filename( board_id, json_data=None, t_tuple=None, prefix=None, suffix=None, use_rev = True ):
+    """ ( ... , 'data latest nbx'.split() ) => hostname.board_name.{datestamp}.data.latest.nbx """
+
+    parts = make_filename_parts( board_id=board_id, json_data=json_data, t_tuple=t_tuple, prefix=prefix, suffix=suffix, use_rev = use_rev )
+
+    filename = '.'.join(parts)
+
+    return filename
+
+
+# ---------------------------------------------------------------------
+# crash-safe writes, see DURABILITY
+
+class GroupCommit:
+    """
+        makes the files of every waiting writer durable together : the first one to wait (the leader) syncs the files
+        and directories that all of them have asked for so far, and those that come meanwhile wait for the next round ;
+        so there is one round at a time, rather than a sync per save -- and only our own files are synced, unlike with
+        os.sync(), which flushes every filesystem on the host
+    """
+
+    def __init__(self, window=0):
+        self.window    = window             # // seconds the leader waits for more writers to join a round
+        self.condition = threading.Condition()
+        self.queued    = OrderedDict()      # // the pathnames of the next round
+        self.syncing   = False
+        self.requested = 0      # the number of the round that the latest writer waits for
+        self.finished  = 0      # rounds finished so far
+        self.failures  = {}     # round => { pathname : OSError }
+
+    def wait(self, pathnames):
+        """ blocks until the files and directories in 'pathnames' are on disk ; raises OSError if one could not be synced """
+
+        if not pathnames:
+            return
+
+        with self.condition:
+            self.queued.update( (pathname, None) for pathname in pathnames )
+            # // the round in progress, if any, started without these
+            target = self.finished + ( 2 if self.syncing else 1 )
+            self.requested = max(self.requested, target)
+
+            while self.finished < target:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+
+                # // we lead this round
+                self.syncing = True
+                self.condition.release()
+                try:
+                    if self.window:
+                        time.sleep(self.window)
+                    with self.condition:
+                        batch, self.queued = list(self.queued), OrderedDict()
+                    failures = sync_paths(batch)
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.finished += 1
+                    self.failures[self.finished] = failures
+                    self.failures.pop(self.finished - 100, None)
+                    self.condition.notify_all()
+
+            failures = self.failures.get(target, {})
+            for pathname in pathnames:
+                if pathname in failures:
+                    raise failures[pathname]
+
+
+def sync_paths(pathnames):
+    """ fsync()s every file and directory => { pathname : OSError } for those that failed """
+
+    failures = {}
+    for pathname in pathnames:
+        try:
+            fd = os.open(pathname, os.O_RDONLY)
+        except FileNotFoundError:
+            # // e.g. an empty directory the retention has just removed
+            continue
+        except OSError as e:
+            if os.path.isdir(pathname):
+                # // a directory that cannot be opened (e.g. on Windows)
+                continue
+            failures[pathname] = e
+            continue
+
+        try:
+            if hasattr(os, 'fdatasync') and not os.path.isdir(pathname):
+                os.fdatasync(fd)
+            else:
+                os.fsync(fd)
+        except OSError as e:
+            log.error( "[error] fsync(%r) failed : %s", pathname, e )
+            failures[pathname] = e
+        finally:
+            os.close(fd)
+
+    return failures
+
+
+group_commit = GroupCommit(FSYNC_BATCH_WINDOW)
+
+
+def temp_name(fullname, seq=None):
+
+    if seq is not None:
+        return f"{fullname}.{os.getpid()}.{threading.get_ident()}.{seq}.tmp"
+
+    return f"{fullname}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def fsync_directory(directory):
+    """ makes a rename durable ; a no-op where directories cannot be opened (e.g. Windows) """
+
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# // saving many boards at once (see PUT /boards), their files are synced once, and renamed into place
+# // together at the end ; so that a crash still leaves either the old files or the new ones,
+# // what comes after the rename (deleting old revisions, the catalog) waits until then, see after_commit()
+
+class PendingCommit:
+    """ the files written but not renamed into place yet, and what is to be done once they are """
+
+    def __init__(self):
+        self.renames     = OrderedDict()    # // fullname -> temporary name
+        self.superseded  = []               # // temporary names of files written again since, deleted with the commit
+        self.appended    = OrderedDict()    # // the files appended to, to be synced too
+        self.directories = set()
+        self.callbacks   = []
+        self.sequence    = itertools.count(1)
+
+    def temp_name(self, fullname):
+        """ a temporary name that no other file of the commit has -- one written earlier could still be needed, see rollback() """
+
+        return temp_name( fullname, next(self.sequence) )
+
+    def add(self, fullname, tmpname):
+        """ 'tmpname' is to be renamed to 'fullname' """
+
+        if fullname in self.renames:
+            self.superseded.append( self.renames[fullname] )
+        self.renames[fullname] = tmpname
+
+    def savepoint(self):
+        """ => what rollback() goes back to """
+
+        return OrderedDict(self.renames), len(self.superseded), len(self.callbacks)
+
+    def rollback(self, savepoint):
+        """ drops the files written since savepoint(), and what was to be done once they are in place """
+
+        renames, superseded, callbacks = savepoint
+
+        kept = set( renames.values() )
+        for tmpname in list( self.renames.values() ) + self.superseded[superseded:]:
+            if tmpname not in kept and os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+        self.renames = renames
+        del self.superseded[superseded:]
+        del self.callbacks[callbacks:]
+
+    def discard(self, tmpnames):
+        for tmpname in tmpnames:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+_pending = threading.local()
+
+
+def pending_commit():
+
+    return getattr(_pending, 'commit', None)
+
+
+def current_name(fullname):
+    """ where the file is right now -- its temporary name, if it waits for the commit """
+
+    commit = pending_commit()
+    if commit is None:
+        return fullname
+
+    return commit.renames.get(fullname, fullname)
+
+
+def ensure_directory(directory):
+    """ os.makedirs(), once per commit """
+
+    commit = pending_commit()
+    if commit is not None and directory in commit.directories:
+        return
+
+    os.makedirs(directory, exist_ok = True)
+    if commit is not None:
+        commit.directories.add(directory)
+
+
+def after_commit(callback):
+    """ calls callback() once the files written so far are in place -- right away, unless within single_commit() """
+
+    commit = pending_commit()
+    if commit is None:
+        callback()
+    else:
+        commit.callbacks.append(callback)
+
+
+@contextmanager
+def single_commit():
+    """ with single_commit(): ... -- one sync and one pass of renames for every file written inside """
+
+    if pending_commit() is not None:
+        yield
+        return
+
+    commit = _pending.commit = PendingCommit()
+    try:
+        yield
+    except BaseException:
+        commit.discard( list( commit.renames.values() ) + commit.superseded )
+        raise
+    finally:
+        _pending.commit = None
+
+    if DURABILITY == 'batch':
+        with measure('fsync'):
+            group_commit.wait( list( commit.renames.values() ) + list(commit.appended) )
+
+    with measure('write'):
+        for fullname, tmpname in commit.renames.items():
+            os.replace(tmpname, fullname)
+        commit.discard(commit.superseded)
+
+        directories = OrderedDict.fromkeys( os.path.dirname(fullname) for fullname in list(commit.renames) + list(commit.appended) )
+        if DURABILITY == 'always':
+            for directory in directories:
+                fsync_directory(directory)
+        elif DURABILITY == 'batch':
+            with measure('fsync'):
+                group_commit.wait( list(directories) )
+
+    for callback in commit.callbacks:
+        callback()
+
+
+def write_files(files):
+    """
+        [ (pathname, text or bytes), ... ] -- writes every file to a temporary name first,
+        and renames them into place once their data is on disk, see DURABILITY ;
+        so a crash leaves either the old file or the new one, and never a truncated one
+    """
+
+    with measure('write'):
+        _write_files(files)
+
+
+def _write_files(files):
+
+    commit = pending_commit()
+
+    renames = []
+    try:
+        for fullname, content in files:
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+
+            tmpname = temp_name(fullname) if commit is None else commit.temp_name(fullname)
+            renames.append( (tmpname, fullname) )
+            with open(tmpname, 'wb') as f:
+                if isinstance(content, SpooledFile):
+                    for chunk in content.chunks():
+                        f.write(chunk)
+                else:
+                    f.write(content)
+                if DURABILITY == 'always':
+                    f.flush()
+                    os.fsync(f.fileno())
+            written_bytes.inc( amount = content.size if isinstance(content, SpooledFile) else len(content) )
+
+        # // the sync and the renames are up to single_commit()
+        if commit is not None:
+            for tmpname, fullname in renames:
+                commit.add(fullname, tmpname)
+            return
+
+        # // one wait for all files of a save
+        if renames and DURABILITY == 'batch':
+            with measure('fsync'):
+                group_commit.wait( [ tmpname for tmpname, _ in renames ] )
+
+        for tmpname, fullname in renames:
+            os.replace(tmpname, fullname)
+
+    except BaseException:
+        for tmpname, fullname in renames:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+        raise
+
+    directories = OrderedDict.fromkeys( os.path.dirname(fullname) for _, fullname in renames )
+    if DURABILITY == 'always':
+        for directory in directories:
+            fsync_directory(directory)
+    elif renames and DURABILITY == 'batch':
+        with measure('fsync'):
+            group_commit.wait( list(directories) )
+
+
+def write_file(fullname, content):
+
+    write_files( [ (fullname, content) ] )
+
+
+def append_file(fullname, content):
+    """ appends to a file, as durably as DURABILITY says ; a crash could leave a partial last line """
+
+    content = content.encode('utf-8')
+    commit = pending_commit()
+    with measure('write'):
+        with open(current_name(fullname), 'ab') as f:
+            f.write(content)
+            if DURABILITY == 'always':
+                f.flush()
+                os.fsync(f.fileno())
+        written_bytes.inc( amount = len(content) )
+
+        if commit is not None:
+            commit.appended[fullname] = None
+        elif DURABILITY == 'batch':
+            with measure('fsync'):
+                # // a new chain is a new name in its directory too
+                group_commit.wait( [ fullname, os.path.dirname(fullname) ] )
+
+
+# ---------------------------------------------------------------------
+# compression, see COMPRESS
+
+COMPRESSED_SUFFIXES = { 'gzip' : '.gz', 'zstd' : '.zst' }
+
+
+def compressed_suffix():
+    """ what COMPRESS adds to the file names, e.g. '.gz' """
+
+    return COMPRESSED_SUFFIXES.get(COMPRESS, '')
+
+
+def compress_text(text):
+    """ the bytes we save for a text, see COMPRESS ; a SpooledFile gets a compressed SpooledFile """
+
+    if isinstance(text, SpooledFile):
+        return text.compressed_copy() if COMPRESS in COMPRESSED_SUFFIXES else text
+
+    content = text.encode('utf-8')
+    if COMPRESS not in COMPRESSED_SUFFIXES:
+        return content
+
+    with measure('compress'):
+        if COMPRESS == 'zstd':
+            return zstd.compress( content, int(COMPRESS_LEVEL or 3) )
+
+        # // mtime=0 : the same text is always the same bytes, see BOARD_STORAGE=dedup
+        return gzip.compress( content, int(COMPRESS_LEVEL or 6), mtime=0 )
+
+
+def compressing_writer(f, size=-1):
+    """ a file object that writes into 'f' what is written to it, compressed as COMPRESS says ; closing it leaves 'f' open """
+
+    level = COMPRESS_LEVEL
+    if COMPRESS == 'zstd':
+        if hasattr(zstd, 'ZstdFile'):
+            return zstd.ZstdFile( f, 'w', level=int(level or 3) )
+        # // with its size, the same frame as zstd.compress()
+        return zstd.ZstdCompressor( level=int(level or 3) ).stream_writer( f, size=size, closefd=False )
+
+    return gzip.GzipFile( fileobj=f, mode='wb', compresslevel=int(level or 6), mtime=0 )
+
+
+def read_text(fullname):
+    """ a saved file as text, decompressed if its name says so """
+
+    with open(fullname, 'rb') as f:
+        return decode_saved( f.read(), fullname )
+
+
+def decode_saved(content, fullname):
+    """ the bytes of a saved file => its text ; its name tells if it is compressed """
+
+    if fullname.endswith('.gz'):
+        with measure('decompress'):
+            content = gzip.decompress(content)
+
+    elif fullname.endswith('.zst'):
+        if zstd is None:
+            raise ValueError(f"{fullname!r} is zstd-compressed, which needs python 3.14 or the zstandard package")
+        with measure('decompress'):
+            content = zstd.decompress(content)
+
+    return content.decode('utf-8')
+
+
+def saved_file_patterns(pattern):
+    """ '*.nbx' -> [ '*.nbx', '*.nbx.gz', '*.nbx.zst' ] """
+
+    return [ pattern ] + [ pattern + suffix for suffix in COMPRESSED_SUFFIXES.values() ]
+
+
+class BodyDecoder:
+    """
+        decompresses a request body sent with 'Content-Encoding: gzip' (or 'deflate') as it comes in, see feed() ;
+        raises a 400 if it does not decompress, a 413 once it gets larger than 'limit'
+    """
+
+    def __init__(self, encoding, limit=MAX_CONTENT_LENGTH):
+
+        encoding = encoding.strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self.wbits = 16 + zlib.MAX_WBITS
+        elif encoding == 'deflate':
+            # // decided by the first byte, see feed()
+            self.wbits = None
+        else:
+            raise UnsupportedMediaType(f"unsupported content encoding {encoding!r}")
+
+        self.encoding = encoding
+        self.limit    = limit
+        self.size     = 0
+        self.decompressor = None
+
+    def feed(self, data):
+        """ yields the decompressed body, STREAM_CHUNK bytes at most at a time, whatever the ratio """
+
+        if self.decompressor is None:
+            if not data:
+                return
+            # // zlib-wrapped, as the RFC says, or raw deflate, as some clients send it
+            wbits = self.wbits or ( zlib.MAX_WBITS if data[:1] == b'\x78' else -zlib.MAX_WBITS )
+            self.decompressor = zlib.decompressobj(wbits)
+
+        try:
+            while True:
+                with measure('decompress'):
+                    chunk = self.decompressor.decompress(data, STREAM_CHUNK)
+                self.size += len(chunk)
+                if self.size > self.limit:
+                    raise RequestEntityTooLarge()
+
+                if chunk:
+                    yield chunk
+
+                # // a full chunk could leave more output behind, even with no input left
+                data = self.decompressor.unconsumed_tail
+                if not data and len(chunk) < STREAM_CHUNK:
+                    break
+
+        except zlib.error as e:
+            raise BadRequest(f"bad {self.encoding} body: {e}")
+
+    def close(self):
+        """ the body is over : raises a 400 if it is cut short """
+
+        if self.decompressor is None or not self.decompressor.eof:
+            raise BadRequest(f"truncated {self.encoding} body")
+
+
+def decompress_body(body, encoding, limit=MAX_CONTENT_LENGTH):
+    """
+        a request body sent with 'Content-Encoding: gzip' (or 'deflate') -> the body itself ;
+        raises a 400 if it does not decompress, a 413 if it is larger than 'limit' once it does
+    """
+
+    if encoding.strip().lower() in ('', 'identity'):
+        return body
+
+    decoder = BodyDecoder(encoding, limit)
+    content = b''.join( decoder.feed(body) )
+    decoder.close()
+
+    return content
+
+
+class DecodedStream(io.RawIOBase):
+    """ the decompressed body of a WSGI request, see BodyDecoder ; never more than STREAM_CHUNK bytes of it in memory """
+
+    def __init__(self, environ, encoding):
+        self.stream = environ['wsgi.input']
+        length = environ.get('CONTENT_LENGTH', '').strip()
+        # // chunked, or up to the end of the stream
+        self.remaining = int(length) if length.isdigit() else None
+        if self.remaining is None and not environ.get('wsgi.input_terminated', False):
+            self.remaining = 0
+
+        self.decoder = BodyDecoder(encoding)
+        self.chunks  = iter(())
+        self.buffer  = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+
+        while not self.buffer:
+            self.buffer = next(self.chunks, b'')
+            if self.buffer:
+                break
+
+            if self.remaining == 0:
+                self.decoder.close()
+                return 0
+
+            data = self.stream.read( STREAM_CHUNK if self.remaining is None else min(STREAM_CHUNK, self.remaining) )
+            if not data:
+                self.remaining = 0
+                continue
+            if self.remaining is not None:
+                self.remaining -= len(data)
+
+            self.chunks = self.decoder.feed(data)
+
+        size = min( len(b), len(self.buffer) )
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+
+        return size
+
+
+class DecompressRequest:
+    """ WSGI middleware : Flask gets the body of a 'Content-Encoding: gzip' (or 'deflate') request decompressed """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '')
+        if encoding.strip().lower() not in ('', 'identity'):
+            try:
+                stream = DecodedStream(environ, encoding)
+            except HTTPException as e:
+                return e(environ, start_response)
+
+            # // decompressed as it is read -- its length is only known at the end
+            environ['wsgi.input'] = io.BufferedReader(stream, STREAM_CHUNK)
+            environ.pop('CONTENT_LENGTH', None)
+            environ['wsgi.input_terminated'] = True
+            del environ['HTTP_CONTENT_ENCODING']
+
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = DecompressRequest(app.wsgi_app)
+
+
+# ---------------------------------------------------------------------
+# storage roots, see SHARDS
+
+# // every root has a 'boards/' tree of its own -- 'latest-saved.nbx', 'full/', 'nbx/', 'delta/', 'objects/' and 'stashed/' ;
+# // a board goes to the root that comes next after the hash of its id on a ring of SHARD_POINTS points per root,
+# // so that a new root takes over about 1/n of the boards, from all of the others (see nullboard_backup_rebalance.py) ;
+# // the catalog keeps the pathnames under another root absolute, see catalog_location()
+
+# { tuple of roots : ( sorted points, the root of every point ) }
+_shard_rings = {}
+
+
+def shard_roots():
+    """ the roots new saves go to """
+
+    return [ os.path.abspath(root) for root in SHARDS ] if SHARDS else [ BACKUP_DIRECTORY ]
+
+
+def storage_roots():
+    """ every root that could hold boards : shard_roots(), and BACKUP_DIR, where they were before SHARDS """
+
+    roots = shard_roots()
+    if not any( os.path.abspath(root) == os.path.abspath(BACKUP_DIRECTORY) for root in roots ):
+        roots.append(BACKUP_DIRECTORY)
+
+    return roots
+
+
+def shard_hash(key):
+
+    return int.from_bytes( hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big' )
+
+
+def shard_root(board_id, roots=None):
+    """ the root a board is saved under """
+
+    roots = tuple(roots or shard_roots())
+    if len(roots) == 1:
+        return roots[0]
+
+    ring = _shard_rings.get(roots, None)
+    if ring is None:
+        points = sorted( ( shard_hash(f"{root}#{i}"), root ) for root in roots for i in range(SHARD_POINTS) )
+        ring = _shard_rings[roots] = ( [ point for point, _ in points ], [ root for _, root in points ] )
+
+    points, owners = ring
+    # // the same key as the board's directories and lock file
+    return owners[ bisect.bisect( points, shard_hash(sanitize_filename(str(board_id))) ) % len(points) ]
+
+
+def root_of(fullname):
+    """ the (absolute) root a saved file is under -- one of storage_roots(), or one that is no longer in SHARDS """
+
+    fullname = os.path.abspath(fullname)
+    for root in sorted( ( os.path.abspath(root) for root in storage_roots() ), key = len, reverse = True ):
+        if fullname.startswith( path_join(root, '') ):
+            return root
+
+    head, boards, _ = fullname.rpartition( os.sep + 'boards' + os.sep )
+    return head if boards else os.path.abspath(BACKUP_DIRECTORY)
+
+
+def move_saved_file(source, target):
+    """
+        copies a saved file to where it is under another root, keeping its time -- or links it to a stored object there,
+        if it is one (see BOARD_STORAGE) ; unless there is a file by that name already, as a save could have put it there
+        meanwhile ; returns True if it has been copied -- the source is up to the caller, once the copy is synced
+    """
+
+    if os.path.exists(target):
+        return False
+
+    ensure_directory(os.path.dirname(target))
+
+    st = os.stat(source)
+    tmpname = temp_name(target)
+    if BOARD_STORAGE == 'dedup' and st.st_nlink > 1:
+        digest, suffix = object_digest(source)
+        object_name = object_path( digest, suffix, root_of(target) )
+        if not os.path.isfile(object_name):
+            ensure_directory(os.path.dirname(object_name))
+            shutil.copyfile(source, object_name)
+        os.link(object_name, tmpname)
+    else:
+        shutil.copyfile(source, tmpname)
+        os.utime(tmpname, ns = (st.st_atime_ns, st.st_mtime_ns))
+
+    try:
+        # // never over a file that a save has just written
+        os.link(tmpname, target)
+    except FileExistsError:
+        return False
+    finally:
+        os.unlink(tmpname)
+
+    return True
+
+
+def relocate_saved(moved):
+    """ [ (old pathname, new pathname), ... ] => the catalog and the outbox follow the files """
+
+    moved = [ ( catalog_location(source), catalog_location(target) ) for source, target in moved ]
+
+    if CATALOG:
+        conn = get_catalog()
+        with catalog_transaction(conn):
+            conn.executemany( 'UPDATE revisions SET location = ? WHERE location = ?', [ (target, source) for source, target in moved ] )
+
+    if REPLICATE_TO:
+        get_outbox().executemany( 'UPDATE outbox SET location = ? WHERE location = ?', [ (target, source) for source, target in moved ] )
+
+
+# ---------------------------------------------------------------------
+# content-addressed storage, see BOARD_STORAGE
+
+def get_objects_dir(root=None):
+
+    return path_join(root or BACKUP_DIRECTORY, 'boards', 'objects')
+
+
+def object_path(digest, suffix='', root=None):
+    """ 'ab12...' -> boards/objects/ab/12....json, or ....json.gz with suffix='.gz' (see COMPRESS) """
+
+    return path_join(get_objects_dir(root), digest[:2], digest[2:] + '.json' + suffix)
+
+
+def object_digest(fname):
+    """ ( digest, suffix ) of the object a saved file would be a link to """
+
+    suffix = os.path.splitext(fname)[1]
+    with open(fname, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest(), suffix if suffix in COMPRESSED_SUFFIXES.values() else ''
+
+
+def store_objects(texts, root=None):
+    """
+        saves every text once under its sha256 hash, in the 'boards/objects' of 'root' (BACKUP_DIR by default) ;
+        a text could also be bytes, compressed as COMPRESS says, or a SpooledFile ;
+        returns { text : ( object pathname, True if it was actually written ) }
+    """
+
+    result = {}
+    missing = []
+    for text in texts:
+        if text in result:
+            continue
+
+        if isinstance(text, SpooledFile):
+            content, suffix = text, compressed_suffix() if text.compressed else ''
+            digest = text.sha256()
+        else:
+            if isinstance(text, bytes):
+                content, suffix = text, compressed_suffix()
+            else:
+                content, suffix = text.encode('utf-8'), ''
+            digest = hashlib.sha256(content).hexdigest()
+        fullname = object_path( digest, suffix, root )
+
+        if os.path.isfile(current_name(fullname)):
+            # an identical payload is already there -- just mark it as recently saved
+            os.utime(current_name(fullname))
+            result[text] = (fullname, False)
+        else:
+            os.makedirs(os.path.dirname(fullname), exist_ok = True)
+            missing.append( (fullname, content) )
+            result[text] = (fullname, True)
+
+    write_files(missing)
+
+    return result
+
+
+def store_object(text):
+    """ ( object pathname, True if it was actually written ) """
+
+    return store_objects( [text] )[text]
+
+
+def link_object(object_name, fullname):
+    """
+        makes 'fullname' a hard link to a stored object, replacing the older file if any ;
+        returns False if it is already the same file
+    """
+
+    # // either could still wait for single_commit()
+    source = current_name(object_name)
+    target = current_name(fullname)
+
+    if os.path.isfile(target) and os.path.samefile(source, target):
+        return False
+
+    # // never write into an existing name -- it could be a link to some other object
+    commit = pending_commit()
+    tmpname = temp_name(fullname) if commit is None else commit.temp_name(fullname)
+    with measure('write'):
+        try:
+            os.link(source, tmpname)
+        except OSError:
+            # a filesystem without hard links, let us fall back to a copy
+            shutil.copyfile(source, tmpname)
+
+        if commit is not None:
+            commit.add(fullname, tmpname)
+            return True
+
+        if DURABILITY == 'batch':
+            # // a copy needs its data synced, a link costs next to nothing
+            group_commit.wait( [ tmpname ] )
+
+        os.replace(tmpname, fullname)
+
+        if DURABILITY == 'always':
+            fsync_directory( os.path.dirname(fullname) )
+        elif DURABILITY == 'batch':
+            group_commit.wait( [ os.path.dirname(fullname) ] )
+
+    return True
+
+
+def unlink_revision(fname):
+    """ deletes a saved revision, and its stored object if nothing else refers to it """
+
+    object_name = None
+    if BOARD_STORAGE == 'dedup':
+        object_name = object_path( *object_digest(fname), root_of(fname) )
+
+    os.unlink(fname)
+
+    # // the object itself is the only remaining link
+    if object_name and os.path.isfile(object_name) and os.stat(object_name).st_nlink <= 1:
+        os.unlink(object_name)
+
+
+# ---------------------------------------------------------------------
+# delta chains, see BOARD_STORAGE
+
+# // every board has its own directory, boards/delta/<hostname>/<board_id>/,
+# // with a number of "<first revision>.<sequence number>.chain.jsonl" files ;
+# // the first line of a chain is a full snapshot of the board, and every next one
+# // is a delta against the previous line, e.g.
+# //
+# //   {"revision": 7, "time": "...", "meta": "...", "self": "...", "snapshot": {<board>}}
+# //   {"revision": 8, "time": "...", "meta": "...", "self": "...", "delta": {<changes>}}
+# //
+# // a delta is { "set": {<changed top-level keys>}, "del": [<removed keys>], "lists": [<ops>] },
+# // where list ops are ["=", n] (keep n lists), ["-", n] (drop n lists), ["+", [<lists>]] (insert lists)
+# // or ["~", {"title": ..., "del": [<removed keys>], "notes": [<ops>]}] (patch the next list : its changed keys,
+# // the removed ones, and its notes, if it has any), and note ops are the same, minus "~"
+
+# (hostname, board_id) => the last line of the current chain, see get_delta_head()
+_delta_heads = {}
+
+
+def get_delta_dir(hostname, board_id, root=None):
+
+    return path_join(root or shard_root(board_id), 'boards', 'delta', hostname, sanitize_filename(str(board_id)))
+
+
+def list_delta_chains(directory):
+    """ [ (sequence number, first revision, pathname), ... ] sorted by sequence number """
+
+    chains = []
+    for fullname in glob.glob(path_join(directory, '*.chain.jsonl')):
+        first_rev, seq = os.path.basename(fullname).split('.')[:2]
+        chains.append( (int(seq), int(first_rev), fullname) )
+
+    chains.sort()
+    return chains
+
+
+def _sequence_ops(old_items, new_items, patch=None):
+    """ difflib opcodes => our compact ["=", n] / ["-", n] / ["+", [...]] / ["~", ...] ops """
+
+    old_keys = [ json.dumps(x, sort_keys=True) for x in old_items ]
+    new_keys = [ json.dumps(x, sort_keys=True) for x in new_items ]
+
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append( ['=', i2 - i1] )
+            continue
+
+        # // lists replaced in place are patched rather than re-sent -- unless patch() cannot tell the change
+        patched = 0
+        if tag == 'replace' and patch is not None:
+            patched = min(i2 - i1, j2 - j1)
+            for k in range(patched):
+                delta = patch(old_items[i1 + k], new_items[j1 + k])
+                if delta is not None:
+                    ops.append( ['~', delta] )
+                else:
+                    ops += [ ['-', 1], ['+', [ new_items[j1 + k] ]] ]
+
+        if i2 - i1 > patched:
+            ops.append( ['-', i2 - i1 - patched] )
+        if j2 - j1 > patched:
+            ops.append( ['+', new_items[j1 + patched : j2]] )
+
+    return ops
+
+
+def _apply_sequence_ops(old_items, ops, patch=None):
+
+    result = []
+    pos = 0
+    for op, arg in ops:
+        if op == '=':
+            result.extend( old_items[pos : pos + arg] )
+            pos += arg
+        elif op == '-':
+            pos += arg
+        elif op == '+':
+            result.extend( arg )
+        elif op == '~':
+            result.append( patch(old_items[pos], arg) )
+            pos += 1
+
+    return result
+
+
+def _list_delta(old_list, new_list):
+    """ None if the list is to be sent whole : not a list at all, or one with a "del" key of its own """
+
+    if not isinstance(old_list, dict) or not isinstance(new_list, dict) or 'del' in old_list or 'del' in new_list:
+        return None
+    if not isinstance(old_list.get('notes', []), list) or not isinstance(new_list.get('notes', []), list):
+        return None
+
+    delta = {}
+    if 'notes' in new_list:
+        delta['notes'] = _sequence_ops(old_list.get('notes', []), new_list['notes'])
+
+    for key, value in new_list.items():
+        if key != 'notes' and ( key not in old_list or old_list[key] != value ):
+            delta[key] = value
+
+    removed = [ key for key in old_list if key not in new_list ]
+    if removed:
+        delta['del'] = removed
+
+    return delta
+
+
+def _apply_list_delta(old_list, delta):
+
+    new_list = dict(old_list)
+    for key in delta.get('del', []):
+        new_list.pop(key, None)
+    for key, value in delta.items():
+        if key not in ('notes', 'del'):
+            new_list[key] = value
+    # // older chains have "notes" in every list delta
+    if 'notes' in delta:
+        new_list['notes'] = _apply_sequence_ops(old_list.get('notes', []), delta['notes'])
+
+    return new_list
+
+
+def make_board_delta(old_board, new_board):
+    """ a structural delta between two board revisions, see above """
+
+    delta = {}
+
+    changed = { k: v for k, v in new_board.items() if k != 'lists' and ( k not in old_board or old_board[k] != v ) }
+
+    removed = [ k for k in old_board if k not in new_board ]
+    if removed:
+        delta['del'] = removed
+
+    lists = new_board.get('lists', None)
+    if 'lists' in new_board and old_board.get('lists', None) != lists:
+        if isinstance(lists, list) and isinstance(old_board.get('lists', []), list):
+            delta['lists'] = _sequence_ops(old_board.get('lists', []), lists, patch=_list_delta)
+        else:
+            # // not something we could diff
+            changed['lists'] = lists
+
+    if changed:
+        delta['set'] = changed
+
+    return delta
+
+
+def apply_board_delta(old_board, delta):
+
+    new_board = dict(old_board)
+    for key in delta.get('del', []):
+        new_board.pop(key, None)
+    new_board.update(delta.get('set', {}))
+
+    if 'lists' in delta:
+        new_board['lists'] = _apply_sequence_ops(old_board.get('lists', []), delta['lists'], patch=_apply_list_delta)
+
+    return new_board
+
+
+def replay_delta_chain(fullname):
+    """
+        yields every record of a chain, with 'board' in place of 'snapshot' / 'delta' ;
+        the last one gets a 'damaged' key if the chain ends with a line we could not read
+    """
+
+    record = None
+    count = 0
+    with open(fullname, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # // a partial line left by a crash ; whatever follows cannot be trusted
+                log.error( "[error] damaged delta chain %r after %d lines", fullname, count )
+                if record is not None:
+                    record['damaged'] = True
+                break
+            if 'snapshot' in entry:
+                board = entry.pop('snapshot')
+            else:
+                board = apply_board_delta(record['board'], entry.pop('delta'))
+            entry['board'] = board
+
+            if record is not None:
+                yield record
+
+            record = entry
+            count += 1
+
+    if record is not None:
+        yield record
+
+
+def read_delta_chain(fullname, revision=None):
+    """
+        replays a chain up to the given revision (or to its end) ;
+        returns ( the last applied record, with 'board' in place of 'snapshot' / 'delta', number of lines read )
+    """
+
+    record = None
+    count = 0
+    for record in replay_delta_chain(fullname):
+        count += 1
+        if revision is not None and record.get('revision') == revision:
+            break
+
+    return record, count
+
+
+def get_delta_head(hostname, board_id):
+    """ the most recent line of the current chain, or None if there is no chain yet """
+
+    key = (hostname, str(board_id))
+    head = _delta_heads.get(key, None)
+    if head is None:
+        chains = list_delta_chains(get_delta_dir(hostname, board_id))
+        if chains:
+            seq, first_rev, fullname = chains[-1]
+            record, count = read_delta_chain(fullname)
+            if record is not None:
+                if record.pop('damaged', False):
+                    # // do not append after a damaged line, start a new chain instead
+                    count = DELTA_CHAIN_MAX + 1
+                head = { 'seq' : seq, 'filename' : fullname, 'length' : count, 'record' : record }
+                _delta_heads[key] = head
+
+    return head
+
+
+def load_delta_revision(hostname, board_id, revision=None):
+    """
+        reconstructs a saved revision of a board (the most recent one by default) ;
+        returns a record with 'board', 'revision', 'time', 'meta' and 'self' keys, or None
+    """
+
+    if revision is None:
+        head = get_delta_head(hostname, board_id)
+        return head['record'] if head else None
+
+    revision = int(revision)
+
+    # // the newest chain that could contain it
+    for seq, first_rev, fullname in reversed( list_delta_chains(get_delta_dir(hostname, board_id)) ):
+        if first_rev <= revision:
+            record, _ = read_delta_chain(fullname, revision)
+            if record is not None and record.get('revision') == revision:
+                return record
+
+    return None
+
+
+def save_board_delta(board_id, hostname, board, extra=None, t_now=None):
+    """
+        appends a board revision to its chain, starting a new one if needed ;
+        returns False if nothing had to be saved
+    """
+
+    revision = board.get('revision', 0)
+    record = { 'revision' : revision, 'time' : strftime('%F %T', t_now if t_now is not None else localtime()) }
+    record.update(extra or {})
+
+    head = get_delta_head(hostname, board_id)
+    if head is not None:
+        last = head['record']
+        if last['revision'] == revision and last['board'] == board:
+            return False
+
+    line = dict(record)
+    # // a revision that is not newer means that the history has been rewritten (e.g. an imported board)
+    if head is None or head['length'] > DELTA_CHAIN_MAX or revision <= head['record']['revision']:
+        directory = get_delta_dir(hostname, board_id)
+        ensure_directory(directory)
+        seq = head['seq'] + 1 if head else 0
+        fullname = path_join(directory, f"{revision}.{seq}.chain.jsonl")
+        head = { 'seq' : seq, 'filename' : fullname, 'length' : 0 }
+        line['snapshot'] = board
+        mode = 'wt'
+    else:
+        with measure('delta'):
+            line['delta'] = make_board_delta(head['record']['board'], board)
+        mode = 'at'
+
+    text = json.dumps(line, separators=(',', ':'), ensure_ascii=False) + '\n'
+    if mode == 'wt':
+        write_file(head['filename'], text)
+    else:
+        append_file(head['filename'], text)
+
+    record['board'] = board
+    head['record'] = record
+    head['length'] += 1
+    _delta_heads[(hostname, str(board_id))] = head
+
+    return True
+
+
+# ---------------------------------------------------------------------
+# revision index, for the "keep last KEEP_REVISIONS revisions every 10 minutes" rule
+
+# // { pathname mask : OrderedDict( { pathname : None } ) }, oldest revisions first ;
+# // we only keep the current 10-minute bucket here, since older ones never change
+_revision_index = {}
+_revision_index_subdir = None
+# // (hostname, board_id) => the pathname masks of its buckets, see forget_board_state()
+_revision_index_boards = {}
+_revision_index_lock = threading.Lock()
+
+
+def load_bucket_revisions(pathname_mask):
+    """ scans a bucket once, when we see it for the first time """
+
+    # [ https://stackoverflow.com/a/168424 ]
+    files = list(  filter( os.path.isfile, glob.glob(pathname_mask) )  )
+    files.sort(key=lambda x: os.path.getmtime(x))
+
+    return OrderedDict.fromkeys(files)
+
+
+def register_revision(pathname_mask, fullname, time_subdir, board_key=None):
+    """
+        records a freshly saved revision ;
+        returns the list of revisions that are now out of the KEEP_REVISIONS limit, to be deleted
+    """
+
+    global _revision_index_subdir
+
+    expired = []
+    with _revision_index_lock:
+        if time_subdir != _revision_index_subdir:
+            _revision_index.clear()
+            _revision_index_boards.clear()
+            _revision_index_subdir = time_subdir
+
+        revisions = _revision_index.get(pathname_mask, None)
+        if revisions is None:
+            revisions = _revision_index[pathname_mask] = load_bucket_revisions(pathname_mask)
+            if board_key is not None:
+                _revision_index_boards.setdefault(board_key, set()).add(pathname_mask)
+
+        revisions[fullname] = None
+        revisions.move_to_end(fullname)
+
+        # // zero or less means "keep everything"
+        while KEEP_REVISIONS > 0 and len(revisions) > KEEP_REVISIONS:
+            oldest, _ = revisions.popitem(last = False)
+            expired.append(oldest)
+
+    return expired
+
+
+# ---------------------------------------------------------------------
+# per-board locks
+
+# // saves of the same board never overlap -- neither in threads nor in worker processes ;
+# // the latter is done with lock files under boards/locks/, which also tell us if another
+# // process has saved the board since we did, and so our cached state of it is stale
+
+# (hostname, board_id) => threading.Lock()
+_board_locks = {}
+_board_locks_lock = threading.Lock()
+
+# (hostname, board_id) => the stamp we have left in its lock file
+_board_stamps = {}
+_board_stamp_counter = itertools.count(1)
+
+# (hostname, board_id) => the revision saved last, by any process -- also kept in the lock file, see store_board()
+_saved_revisions = {}
+
+
+def get_board_lock_path(hostname, board_id):
+
+    return path_join(BACKUP_DIRECTORY, 'boards', 'locks', hostname, sanitize_filename(str(board_id)) + '.lock')
+
+
+def forget_board_state(board_key):
+    """ drops everything we have cached about a board """
+
+    _delta_heads.pop(board_key, None)
+    _other_heads.pop(board_key, None)
+    _saved_revisions.pop(board_key, None)
+
+    with _revision_index_lock:
+        for pathname_mask in _revision_index_boards.pop(board_key, ()):
+            _revision_index.pop(pathname_mask, None)
+
+
+@contextmanager
+def board_lock(hostname, board_id):
+
+    board_key = (hostname, str(board_id))
+
+    with _board_locks_lock:
+        thread_lock = _board_locks.get(board_key, None)
+        if thread_lock is None:
+            thread_lock = _board_locks[board_key] = threading.Lock()
+
+    started = time.perf_counter()
+    with thread_lock:
+        if fcntl is None:
+            # // no lock files here, so it is one process only
+            phase_seconds.observe( time.perf_counter() - started, 'lock' )
+            yield
+            return
+
+        fullname = get_board_lock_path(hostname, board_id)
+        os.makedirs(os.path.dirname(fullname), exist_ok = True)
+
+        with open(fullname, 'a+b') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            phase_seconds.observe( time.perf_counter() - started, 'lock' )
+            try:
+                f.seek(0)
+                # // '<stamp> <revision saved last>', or only the stamp
+                stamp, _, revision = f.read().decode('ascii', 'replace').partition(' ')
+                if stamp != _board_stamps.get(board_key, None):
+                    forget_board_state(board_key)
+                _saved_revisions[board_key] = int(revision) if revision.isdigit() else None
+
+                yield
+
+                stamp = f"{os.getpid()}.{next(_board_stamp_counter)}"
+                revision = _saved_revisions.get(board_key, None)
+                f.seek(0)
+                f.truncate()
+                f.write( (stamp if revision is None else f"{stamp} {revision}").encode('ascii') )
+                f.flush()
+                _board_stamps[board_key] = stamp
+
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# ---------------------------------------------------------------------
+# packs, see compact_buckets()
+
+# // the 10-minute buckets of a past day (or month) are folded into one zip file per board,
+# // boards/<full|nbx>/<hostname>/<period>.<board_id>.pack.zip ; a member is '<date>/<hour>/<minutes>/<filename>',
+# // the file as it was, and its comment is the revision -- so that the zip directory is an index of revisions
+
+PACK_SUFFIX = '.pack.zip'
+PACK_PERIODS = ('day', 'month')
+
+RE_DAY_BUCKET = re.compile( r'^\d{4}-\d\d-\d\d$' )
+# // a day pack, which a month one could take in
+RE_DAY_PACK = re.compile( r'^(\d{4}-\d\d-\d\d)\.(.+)' + re.escape(PACK_SUFFIX) + '$' )
+
+
+def get_pack_path(directory, period, board_id):
+
+    return path_join(directory, f"{period}.{sanitize_filename(str(board_id))}{PACK_SUFFIX}")
+
+
+def pack_index(fullname):
+    """ { revision : member name } of a pack ; the latest copy of a revision saved more than once """
+
+    index = {}
+    with zipfile.ZipFile(fullname) as pack:
+        for info in sorted( pack.infolist(), key = lambda info: info.date_time ):
+            revision = info.comment.decode('ascii', 'replace')
+            index[ int(revision) if revision.isdigit() else revision ] = info.filename
+
+    return index
+
+
+def read_packed_text(fullname, member):
+
+    with zipfile.ZipFile(fullname) as pack:
+        return decode_saved( pack.read(member), member )
+
+
+def read_packed_revision(fullname, revision):
+    """ the text of a revision in a pack, or None if it is not there """
+
+    member = pack_index(fullname).get(revision, None)
+    if member is None:
+        return None
+
+    return read_packed_text(fullname, member)
+
+
+def saved_board_header(text, tree):
+    """ 'id', 'title' and 'revision' of a saved 'nbx' (or 'full') file """
+
+    if tree == 'full':
+        text = json.loads(text).get('data', None) or '{}'
+
+    return scan_board_header(text) or json.loads(text)
+
+
+def iter_pack_rows(hostname, fullname):
+    """ catalog rows for the revisions in an 'nbx' pack """
+
+    with zipfile.ZipFile(fullname) as pack:
+        for info in pack.infolist():
+            header = saved_board_header( decode_saved(pack.read(info), info.filename), 'nbx' )
+            yield catalog_row( hostname, header.get('id', ''), header, time.mktime(info.date_time + (0, 0, -1)), 'pack', fullname )
+
+
+def write_pack(fullname, entries, packs=()):
+    """
+        [ (member, pathname, revision), ... ] => the pack, together with what it already holds, and with the members
+        of the other 'packs' ; a member that is already there (say, from a compaction cut short) is not added again
+    """
+
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as pack:
+        members = set()
+        for source in [ fullname ] + list(packs):
+            if not os.path.isfile(source):
+                continue
+            with zipfile.ZipFile(source) as old:
+                for info in old.infolist():
+                    if info.filename not in members:
+                        pack.writestr( info, old.read(info) )
+                        members.add(info.filename)
+
+        for member, pathname, revision in entries:
+            if member in members:
+                continue
+            members.add(member)
+
+            info = zipfile.ZipInfo.from_file(pathname, member)
+            # // compressed files stay as they are, see COMPRESS
+            info.compress_type = zipfile.ZIP_STORED if os.path.splitext(member)[1] in COMPRESSED_SUFFIXES.values() else zipfile.ZIP_DEFLATED
+            info.comment = str(revision).encode('ascii', 'replace')
+            with open(pathname, 'rb') as f:
+                pack.writestr( info, f.read() )
+
+    write_file( fullname, content.getvalue() )
+
+
+def remove_empty_directories(directory, top):
+    """ removes 'directory' and its parents up to (not including) 'top', as long as they are empty """
+
+    while os.path.normpath(directory) != os.path.normpath(top):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def compact_buckets(older_than=30, period='day', trees=('full', 'nbx'), verbose=False):
+    """
+        folds the buckets of the days before the last 'older_than' into packs, one per board per 'period' ;
+        monthly packs take in the daily ones as well ;
+        returns { 'packs' : ..., 'files' : ..., 'bytes' : ..., 'skipped' : ... } -- 'bytes' is the size of the packed files
+    """
+
+    assert period in PACK_PERIODS, period
+
+    cutoff = strftime( '%F', localtime(time.time() - older_than * 24 * 3600) )
+    stats = { 'packs' : 0, 'files' : 0, 'bytes' : 0, 'skipped' : 0 }
+
+    host_dirs = [ (tree, host_dir) for root in storage_roots() for tree in trees
+                                   for host_dir in sorted( glob.glob(path_join(root, 'boards', tree, '*', '')) ) ]
+    for tree, host_dir in host_dirs:
+        hostname = os.path.basename( os.path.dirname(host_dir) )
+
+        # // ( period, board_id ) => [ (member, pathname, header), ... ] and [ day pack, ... ]
+        groups = OrderedDict()
+        day_packs = {}
+        for day in sorted( os.listdir(host_dir) ):
+            match = RE_DAY_PACK.match(day)
+            if match and period == 'month' and match.group(1) < cutoff:
+                key = ( match.group(1)[:7], match.group(2) )
+                groups.setdefault(key, [])
+                day_packs.setdefault(key, []).append( path_join(host_dir, day) )
+                continue
+
+            if not RE_DAY_BUCKET.match(day) or day >= cutoff or not os.path.isdir(path_join(host_dir, day)):
+                continue
+
+            for pathname in sorted( glob.glob(path_join(host_dir, day, '*', '*', '*')) ):
+                if pathname.endswith('.tmp') or not os.path.isfile(pathname):
+                    continue
+                try:
+                    header = saved_board_header( read_text(pathname), tree )
+                    board_id = header['id']
+                except (OSError, ValueError, EOFError, KeyError, TypeError, AttributeError) as e:
+                    log.warning( "[warning] compact: leaving %r as it is : %s", pathname, e )
+                    stats['skipped'] += 1
+                    continue
+
+                key = ( day if period == 'day' else day[:7], sanitize_filename(str(board_id)) )
+                groups.setdefault(key, []).append( (os.path.relpath(pathname, host_dir), pathname, header) )
+
+        for (when, board_id), entries in groups.items():
+            pack = get_pack_path(host_dir, when, board_id)
+            merged = day_packs.get( (when, board_id), [] )
+
+            # // not that the server writes to old buckets, but a pack shall not change under its readers
+            with board_lock(hostname, board_id):
+                write_pack( pack, [ (member, pathname, header.get('revision') or 0) for member, pathname, header in entries ], merged )
+
+                if tree == 'nbx':
+                    added = [ catalog_row(hostname, board_id, header, os.path.getmtime(pathname), 'pack', pack) for _, pathname, header in entries ]
+                    if merged:
+                        added += list( iter_pack_rows(hostname, pack) )
+                    catalog_update( added, [ pathname for _, pathname, _ in entries ] + merged )
+
+                for _, pathname, _ in entries:
+                    stats['bytes'] += os.path.getsize(pathname)
+                    unlink_revision(pathname)
+                    remove_empty_directories( os.path.dirname(pathname), host_dir )
+
+                for day_pack in merged:
+                    stats['bytes'] += os.path.getsize(day_pack)
+                    os.unlink(day_pack)
+
+            stats['packs'] += 1
+            stats['files'] += len(entries) + len(merged)
+            if verbose:
+                print( f"{catalog_location(pack)} : {len(entries)} files, {len(merged)} day packs, {os.path.getsize(pack)} bytes" )
+
+    return stats
+
+
+# ---------------------------------------------------------------------
+# tiered retention, see RETENTION
+
+# // on top of the KEEP_REVISIONS rule : '24h:all, 30d:1h, 365d:1d, *:1w' keeps every revision of the last 24 hours,
+# // then the latest one of every hour up to 30 days, of every day up to a year, and of every week after that ;
+# // without a '*' tier, what is older than the last one goes ; the latest revision of a board always stays,
+# // and so does its latest-saved.nbx, which is not a revision ; delta chains are kept whole
+
+RETENTION_UNITS = { 'm' : 60, 'h' : 3600, 'd' : 24 * 3600, 'w' : 7 * 24 * 3600, 'y' : 365 * 24 * 3600 }
+
+RE_DURATION = re.compile( r'^(\d+(?:\.\d+)?)\s*([mhdwy])$' )
+
+
+def parse_duration(text):
+    """ '30d' -> seconds ; '*' -> None, i.e. forever """
+
+    text = text.strip().lower()
+    if text == '*':
+        return None
+
+    match = RE_DURATION.match(text)
+    if match is None:
+        raise ValueError(f"bad duration {text!r}, shall be e.g. '90m', '24h', '30d', '1w' or '1y'")
+
+    return float(match.group(1)) * RETENTION_UNITS[match.group(2)]
+
+
+def format_duration(seconds):
+    """ 86400 -> '1d' """
+
+    for unit in 'ywdhm':
+        if seconds % RETENTION_UNITS[unit] == 0:
+            return f"{int(seconds // RETENTION_UNITS[unit])}{unit}"
+
+    return f"{seconds:g}s"
+
+
+def parse_retention(text):
+    """
+        '24h:all, 30d:1h, *:1w' -> [ (86400, None), (2592000, 3600), (None, 604800) ] :
+        ( up to this age, one revision per that many seconds -- None for all of them ), the youngest first
+    """
+
+    tiers = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        age, _, every = part.partition(':')
+        every = every.strip().lower()
+        tiers.append( ( parse_duration(age), None if every in ('', 'all') else parse_duration(every) ) )
+
+    ages = [ age for age, _ in tiers ]
+    if None in ages[:-1] or ages != sorted(ages, key = lambda age: float('inf') if age is None else age):
+        raise ValueError(f"bad retention {text!r} : the tiers shall go from the youngest to the oldest, and '*' can only be the last one")
+
+    return tiers
+
+
+RETENTION_TIERS = parse_retention(RETENTION)
+
+
+def retention_plan(rows, tiers=None, now=None):
+    """ the catalog rows of a board (from one host) => [ ( row, tier index or None if past the last one ), ... ] to delete """
+
+    tiers = RETENTION_TIERS if tiers is None else tiers
+    now = time.time() if now is None else now
+
+    doomed = []
+    seen = set()
+    # // the latest first, so that it is the one kept in its hour, day or week
+    rows = sorted( rows, key = lambda row: (row['saved'], row['id']), reverse = True )
+    for row in rows[1:]:
+        if row['storage'] == 'delta':
+            continue
+
+        age = now - row['saved']
+        tier = next( ( n for n, (upto, _) in enumerate(tiers) if upto is None or age < upto ), None )
+        if tier is None:
+            doomed.append( (row, None) )
+            continue
+
+        every = tiers[tier][1]
+        if every is None:
+            continue
+
+        # // hours, days and weeks of the local time
+        bucket = ( tier, int( (row['saved'] + localtime(row['saved']).tm_gmtoff) // every ) )
+        if bucket in seen:
+            doomed.append( (row, tier) )
+        else:
+            seen.add(bucket)
+
+    return doomed
+
+
+def full_twin(fullname):
+    """ boards/nbx/<...>/<name>.nbx.gz -> boards/full/<...>/<name>.full.gz ; a pack has the same name in both """
+
+    root = root_of(fullname)
+    relative = os.path.relpath(fullname, path_join(root, 'boards', 'nbx'))
+    return path_join(root, 'boards', 'full', re.sub(r'\.nbx((?:\.gz|\.zst)?)$', r'.full\1', relative))
+
+
+def drop_from_pack(fullname, revisions):
+    """ rewrites a pack without these revisions ; removes it once there is nothing left """
+
+    revisions = set( str(revision) for revision in revisions )
+
+    content = io.BytesIO()
+    kept = 0
+    with zipfile.ZipFile(fullname) as old, zipfile.ZipFile(content, 'w') as pack:
+        for info in old.infolist():
+            if info.comment.decode('ascii', 'replace') not in revisions:
+                pack.writestr( info, old.read(info) )
+                kept += 1
+
+    if kept:
+        write_file( fullname, content.getvalue() )
+    else:
+        os.unlink(fullname)
+
+
+def retire_rows(hostname, rows):
+    """ deletes the revisions of these catalog rows, with their 'full' twins, and forgets them ; under the board lock """
+
+    packs = OrderedDict()
+    for row in rows:
+        fullname = path_join(BACKUP_DIRECTORY, row['location'])
+        if row['storage'] == 'pack':
+            packs.setdefault(fullname, set()).add(row['revision'])
+            continue
+
+        for tree, name in ( ('nbx', fullname), ('full', full_twin(fullname)) ):
+            try:
+                unlink_revision(name)
+            except FileNotFoundError:
+                continue
+            remove_empty_directories( os.path.dirname(name), path_join(root_of(name), 'boards', tree, hostname) )
+
+    for fullname, revisions in packs.items():
+        for name in ( fullname, full_twin(fullname) ):
+            if os.path.isfile(name):
+                drop_from_pack(name, revisions)
+
+    catalog_forget( [ row['id'] for row in rows ] )
+    for row in rows:
+        read_cache.discard( (hostname, row['board_id'], row['revision']) )
+    pruned_revisions.inc( amount = len(rows) )
+
+
+@contextmanager
+def retention_turn():
+    """ one process at a time : yields the ( hostname, board_id ) the last round stopped after, or None if it is not our turn """
+
+    fullname = path_join(BACKUP_DIRECTORY, 'boards', 'locks', 'retention.lock')
+    os.makedirs(os.path.dirname(fullname), exist_ok = True)
+
+    with open(fullname, 'a+') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield None
+                return
+
+        try:
+            f.seek(0)
+            try:
+                cursor = json.loads(f.read() or '["", ""]')
+            except ValueError:
+                cursor = [ '', '' ]
+
+            yield cursor
+
+            # // where the next round starts, whichever process it is
+            f.seek(0)
+            f.truncate()
+            f.write( json.dumps(cursor) )
+            f.flush()
+
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def retention_round(cursor, budget=RETENTION_BATCH, dry_run=RETENTION_DRY_RUN, tiers=None, now=None):
+    """
+        looks at most at 'budget' boards after 'cursor' (a [ hostname, board_id ] list, updated in place),
+        and deletes at most 'budget' revisions ; starts over once it has seen every board ;
+        returns [ ( hostname, row, tier ), ... ] it has deleted -- or would have, with 'dry_run'
+    """
+
+    conn = get_catalog()
+    retired = []
+    looked = 0
+
+    boards = conn.execute( 'SELECT DISTINCT hostname, board_id FROM revisions WHERE (hostname, board_id) > (?, ?)'
+                           ' ORDER BY hostname, board_id LIMIT ?', (cursor[0], cursor[1], budget) ).fetchall()
+    if not boards:
+        cursor[:] = [ '', '' ]
+        return retired
+
+    for hostname, board_id in boards:
+        looked += 1
+        with board_lock(hostname, board_id):
+            rows = conn.execute( 'SELECT * FROM revisions WHERE hostname = ? AND board_id = ?', (hostname, board_id) ).fetchall()
+            doomed = retention_plan(rows, tiers, now)
+
+            left = budget - len(retired)
+            if dry_run:
+                for row, tier in doomed:
+                    log.info( "[retention] would delete revision %s of board %s from %s (%s)", row['revision'], board_id, hostname, row['location'] )
+            elif doomed:
+                retire_rows( hostname, [ row for row, _ in doomed[:left] ] )
+                # // its revision index is out of date
+                forget_board_state( (hostname, str(board_id)) )
+
+        retired += [ (hostname, row, tier) for row, tier in ( doomed if dry_run else doomed[:left] ) ]
+        if len(doomed) > left and not dry_run:
+            # // the rest of this board next time
+            break
+
+        cursor[:] = [ hostname, board_id ]
+        if len(retired) >= budget:
+            break
+
+    return retired
+
+
+_retention_thread = None
+_retention_thread_lock = threading.Lock()
+
+
+def run_retention():
+
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        try:
+            if not catalog_built():
+                continue
+            with retention_turn() as cursor:
+                if cursor is not None:
+                    with measure('retention'):
+                        retention_round(cursor)
+        except Exception:
+            log.exception( "[error] retention round failed" )
+
+
+def start_retention():
+    """ starts the background retention of this process, if RETENTION says so ; cheap to call again """
+
+    global _retention_thread
+
+    if _retention_thread is not None or not RETENTION_TIERS or not CATALOG:
+        return
+
+    with _retention_thread_lock:
+        if _retention_thread is None:
+            _retention_thread = threading.Thread(target=run_retention, name='retention', daemon=True)
+            _retention_thread.start()
+
+
+# ---------------------------------------------------------------------
+# revision catalog
+
+# // one row for every board revision we keep : an 'nbx' file, or a line of a delta chain ;
+# // the files stay the source of truth -- delete boards/catalog.sqlite, and it is rebuilt from them
+
+CATALOG_FILENAME = 'catalog.sqlite'
+
+CATALOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS revisions
+        ( id       INTEGER PRIMARY KEY
+        , hostname TEXT    NOT NULL
+        , board_id TEXT    NOT NULL
+        , revision INTEGER NOT NULL
+        , title    TEXT
+        , saved    REAL    NOT NULL
+        , storage  TEXT    NOT NULL
+        , location TEXT    NOT NULL
+        , UNIQUE (location, revision)
+        );
+    CREATE INDEX IF NOT EXISTS revisions_by_board    ON revisions (board_id);
+    CREATE INDEX IF NOT EXISTS revisions_by_revision ON revisions (board_id, revision);
+    CREATE INDEX IF NOT EXISTS revisions_by_host     ON revisions (board_id, hostname);
+"""
+
+# // the same revision saved again to the same place replaces its row, see catalog_row()
+CATALOG_INSERT = ( 'INSERT OR REPLACE INTO revisions (hostname, board_id, revision, title, saved, storage, location)'
+                   ' VALUES (?, ?, ?, ?, ?, ?, ?)' )
+
+# // a connection for every thread ; ( database path, connection )
+_catalog_local = threading.local()
+
+
+def get_catalog_path():
+
+    return path_join(BACKUP_DIRECTORY, 'boards', CATALOG_FILENAME)
+
+
+def catalog_location(fullname):
+    """ pathnames are kept relative to BACKUP_DIRECTORY, so that one could move it -- and absolute under other roots, see SHARDS """
+
+    location = os.path.relpath(fullname, BACKUP_DIRECTORY)
+    if location.split(os.sep)[0] == os.pardir:
+        return os.path.abspath(fullname)
+
+    return location
+
+
+def get_catalog():
+    """ this thread's connection to the catalog ; creates an empty one if there is none, see build_catalog() """
+
+    path = get_catalog_path()
+    cached = getattr(_catalog_local, 'catalog', None)
+    if cached is not None and cached[0] == path:
+        return cached[1]
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    # // we manage transactions ourselves, see catalog_transaction()
+    conn = sqlite3.connect(path, timeout = 60, isolation_level = None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.row_factory = sqlite3.Row
+
+    # // not a write transaction every time, which would wait for a catalog build
+    if conn.execute("SELECT name FROM sqlite_master WHERE name = 'revisions'").fetchone() is None:
+        with catalog_transaction(conn):
+            execute_script(conn, CATALOG_SCHEMA)
+
+    _catalog_local.catalog = (path, conn)
+    return conn
+
+
+# // the catalogs known to be built, see catalog_built()
+_catalog_built = set()
+
+
+def catalog_built():
+    """ False while the catalog has yet to be filled from the saved revisions, see build_catalog() """
+
+    path = get_catalog_path()
+    if path not in _catalog_built:
+        if get_catalog().execute('PRAGMA user_version').fetchone()[0] < 1:
+            return False
+        _catalog_built.add(path)
+
+    return True
+
+
+@contextmanager
+def process_turn(name, wait=True):
+    """ one process at a time, through boards/locks/<name>.lock : yields True when it is our turn ; or False at once, unless 'wait' """
+
+    fullname = path_join(BACKUP_DIRECTORY, 'boards', 'locks', name + '.lock')
+    os.makedirs(os.path.dirname(fullname), exist_ok = True)
+
+    with open(fullname, 'a+b') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | ( 0 if wait else fcntl.LOCK_NB ))
+            except OSError:
+                yield False
+                return
+
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def build_catalog(wait=True):
+    """
+        fills the catalog from the saved revisions if it has never been, and brings it up to date (see upgrade_catalog()) ;
+        from a background thread of the server (see start_catalog()), or from the command line tools that need it --
+        the requests that need it get a 503 meanwhile, and the saves go on ; returns False if another process is at it
+    """
+
+    with process_turn('catalog', wait) as turn:
+        if not turn:
+            return False
+
+        conn = get_catalog()
+        if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+            count = rebuild_catalog(conn)
+            log.info( "# catalog: %s revisions found in %r", count, BACKUP_DIRECTORY )
+
+        with catalog_transaction(conn):
+            upgrade_catalog(conn)
+
+    return True
+
+
+_catalog_thread = None
+_catalog_thread_lock = threading.Lock()
+
+
+def run_catalog_build():
+
+    try:
+        build_catalog()
+    except Exception:
+        log.exception( "[error] failed to build the revision catalog" )
+
+
+def start_catalog():
+    """ builds the catalog in a background thread of this process, if CATALOG says so ; cheap to call again """
+
+    global _catalog_thread
+
+    if _catalog_thread is not None or not CATALOG:
+        return
+
+    with _catalog_thread_lock:
+        if _catalog_thread is None:
+            _catalog_thread = threading.Thread(target=run_catalog_build, name='catalog', daemon=True)
+            _catalog_thread.start()
+
+
+def catalog_request(handler, *args):
+    """
+        handler(*args) => ( result, retcode ) for the requests the catalog answers, or a 503 while it is being built
+        (see build_catalog()), or while it stays locked for longer than the sqlite timeout
+    """
+
+    try:
+        if CATALOG and not catalog_built():
+            return { 'error' : 'the revision catalog is being built, try again later' }, RETURN_503_UNAVAILABLE
+
+        return handler(*args)
+
+    except sqlite3.OperationalError as e:
+        if 'locked' not in str(e) and 'busy' not in str(e):
+            raise
+        log.warning( "[warning] the revision catalog is busy : %s", e )
+        return { 'error' : 'the revision catalog is busy, try again later' }, RETURN_503_UNAVAILABLE
+
+
+def execute_script(conn, script):
+    """ not executescript(), which would commit the transaction first """
+
+    for statement in script.split(';'):
+        conn.execute(statement)
+
+
+def upgrade_catalog(conn):
+    """
+        PRAGMA user_version : 0 -- a brand new catalog (maybe next to years of backups), see rebuild_catalog(),
+        1 -- revisions, 2 -- revisions and the search index (see index_search())
+    """
+
+    version = start = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    if version < 2 and SEARCH:
+        # // empty : index_search() fills it in the background, from the first cataloged revision on
+        execute_script(conn, SEARCH_SCHEMA)
+        conn.execute('INSERT INTO search_progress (last_id) VALUES (0)')
+        version = 2
+
+    if version != start:
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+@contextmanager
+def catalog_transaction(conn):
+    """ BEGIN IMMEDIATE ... COMMIT, so that the worker processes take turns """
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+def catalog_row(hostname, board_id, header, saved, storage, fullname):
+
+    return ( hostname, str(board_id), header.get('revision') or 0, header.get('title', None)
+           , saved, storage, catalog_location(fullname) )
+
+
+def iter_saved_revisions():
+    """ catalog rows for everything already under boards/nbx (packs included) and boards/delta, of every root """
+
+    for root in storage_roots():
+        yield from iter_root_revisions(root)
+
+
+def iter_root_revisions(root):
+
+    nbx_files = itertools.chain.from_iterable( glob.iglob(path_join(root, 'boards', 'nbx', '*', '**', pattern), recursive = True)
+                                               for pattern in saved_file_patterns('*.nbx') )
+    for fullname in nbx_files:
+        hostname = os.path.relpath(fullname, path_join(root, 'boards', 'nbx')).split(os.sep)[0]
+        try:
+            # // not scan_board_header() : with SAVE_FORMAT=pretty, "lists" comes before "revision" and "title"
+            header = json.loads( read_text(fullname) )
+        except (OSError, ValueError, EOFError) as e:
+            log.error( "[error] catalog: skipping %r : %s", fullname, e )
+            continue
+
+        yield catalog_row( hostname, header.get('id', ''), header, os.path.getmtime(fullname), 'file', fullname )
+
+    for fullname in glob.iglob(path_join(root, 'boards', 'nbx', '*', '*' + PACK_SUFFIX)):
+        hostname = os.path.relpath(fullname, path_join(root, 'boards', 'nbx')).split(os.sep)[0]
+        try:
+            yield from iter_pack_rows(hostname, fullname)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            log.error( "[error] catalog: skipping %r : %s", fullname, e )
+
+    for fullname in glob.iglob(path_join(root, 'boards', 'delta', '*', '*', '*.chain.jsonl')):
+        hostname, board_id = os.path.relpath(fullname, path_join(root, 'boards', 'delta')).split(os.sep)[:2]
+        for record in replay_delta_chain(fullname):
+            saved = time.mktime( time.strptime(record['time'], '%Y-%m-%d %H:%M:%S') )
+            yield catalog_row( hostname, board_id, record['board'], saved, 'delta', fullname )
+
+
+def rebuild_catalog(conn):
+    """
+        reads every saved revision, outside of any transaction, then swaps them in for the rows in one short one ;
+        returns the number of revisions
+    """
+
+    rows = list( iter_saved_revisions() )
+    # // the revisions deleted since they were read are not brought back
+    rows = [ row for row in rows if os.path.exists( path_join(BACKUP_DIRECTORY, row[6]) ) ]
+
+    with catalog_transaction(conn):
+        # // the saves in the meantime are cataloged as usual, and kept
+        columns = 'hostname, board_id, revision, title, saved, storage, location'
+        rows += [ tuple(row) for row in conn.execute(f"SELECT {columns} FROM revisions") ]
+        # // oldest first, all of them, so that the row ids follow the save order as they do later on ;
+        # // the latest row of the same revision in the same place, as with CATALOG_INSERT
+        rows.sort(key = lambda row: row[4])
+        rows = sorted( { (row[6], row[2]) : row for row in rows }.values(), key = lambda row: row[4] )
+
+        conn.execute('DELETE FROM revisions')
+        conn.executemany( CATALOG_INSERT, rows )
+        conn.execute('PRAGMA user_version = 1')
+
+    return conn.execute('SELECT count(*) FROM revisions').fetchone()[0]
+
+
+def catalog_update(added=(), removed=()):
+    """ records the revisions we have just saved, and forgets the deleted files, in one transaction ; see also index_search() """
+
+    if not CATALOG:
+        return
+
+    try:
+        with measure('catalog'):
+            conn = get_catalog()
+            with catalog_transaction(conn):
+                conn.executemany( CATALOG_INSERT, added )
+                conn.executemany( 'DELETE FROM revisions WHERE location = ?', ( (catalog_location(f),) for f in removed ) )
+
+    except sqlite3.Error:
+        # // the revisions are saved anyway ; rebuilding the catalog would pick them up
+        log.exception( "[error] failed to update the revision catalog" )
+
+
+def catalog_forget(ids):
+    """ drops these rows from the catalog, e.g. once the tiered retention has deleted their revisions """
+
+    if not CATALOG or not ids:
+        return
+
+    try:
+        with measure('catalog'):
+            conn = get_catalog()
+            with catalog_transaction(conn):
+                conn.executemany( 'DELETE FROM revisions WHERE id = ?', ( (row_id,) for row_id in ids ) )
+
+    except sqlite3.Error:
+        log.exception( "[error] failed to update the revision catalog" )
+
+
+def catalog_entry(row):
+
+    return { 'id'       : row['id']
+           , 'board'    : row['board_id']
+           , 'revision' : row['revision']
+           , 'title'    : row['title']
+           , 'host'     : row['hostname']
+           , 'time'     : int(row['saved'])
+           , 'date'     : strftime('%F %T', localtime(row['saved']))
+           , 'location' : row['location']
+           }
+
+
+def list_board_revisions(board_id, args):
+    """
+        GET /board/<id>/revisions?limit=50&before=<id>&host=<hostname> : the most recent revisions first ;
+        'next' is the 'before' value for the next page, or null on the last one
+    """
+
+    if not CATALOG:
+        return {}, RETURN_404_NOT_FOUND
+
+    try:
+        limit = min( max(1, int(args.get('limit', 50))), CATALOG_PAGE_MAX )
+        before = int(args['before']) if args.get('before') else None
+    except ValueError:
+        return {}, RETURN_400_BAD_REQUEST
+
+    query = 'SELECT * FROM revisions WHERE board_id = ?'
+    params = [ str(board_id) ]
+    if before is not None:
+        query += ' AND id < ?'
+        params.append(before)
+    if args.get('host'):
+        query += ' AND hostname = ?'
+        params.append(args['host'])
+    query += ' ORDER BY id DESC LIMIT ?'
+    # // one more, to know if there is a next page
+    params.append(limit + 1)
+
+    rows = get_catalog().execute(query, params).fetchall()
+
+    revisions = [ catalog_entry(row) for row in rows[:limit] ]
+    result = { 'board'     : str(board_id)
+             , 'revisions' : revisions
+             , 'next'      : revisions[-1]['id'] if len(rows) > limit else None
+             }
+
+    return result, RETURN_200_OK
+
+
+def load_board_revision(board_id, revision, args):
+    """ GET /board/<id>/revisions/<revision>?host=<hostname> : the board as it was saved, the latest copy of it, as a ( body, etag ) reply """
+
+    if not CATALOG:
+        return {}, RETURN_404_NOT_FOUND
+
+    try:
+        revision = int(revision)
+    except ValueError:
+        return {}, RETURN_400_BAD_REQUEST
+
+    row = find_revision(board_id, revision, args.get('host'))
+    if row is None:
+        return {}, RETURN_404_NOT_FOUND
+
+    reply = cataloged_reply(row)
+    if reply is None:
+        return {}, RETURN_404_NOT_FOUND
+
+    return reply, RETURN_200_OK
+
+
+def find_revision(board_id, revision, hostname=None):
+    """ the catalog row of the latest copy of a revision, from any host or from this one ; None if there is none """
+
+    query = 'SELECT * FROM revisions WHERE board_id = ? AND revision = ?'
+    params = [ str(board_id), revision ]
+    if hostname:
+        query += ' AND hostname = ?'
+        params.append(hostname)
+    query += ' ORDER BY id DESC LIMIT 1'
+
+    return get_catalog().execute(query, params).fetchone()
+
+
+def cataloged_reply(row):
+    """ the ( body, etag ) reply for the board of a catalog row, from the read cache if it is there ; None if it is gone """
+
+    key = ( row['hostname'], row['board_id'], row['revision'] )
+    reply = read_cache.get(key)
+    read_cache_total.inc( 'miss' if reply is None else 'hit' )
+    if reply is None:
+        board = read_cataloged_board(row)
+        if board is None:
+            return None
+
+        reply = board_reply(board)
+        read_cache.put(key, reply)
+
+    return reply
+
+
+def read_cataloged_board(row):
+    """ the board of a catalog row, or None if it is gone """
+
+    fullname = path_join(BACKUP_DIRECTORY, row['location'])
+    try:
+        if row['storage'] == 'delta':
+            record, _ = read_delta_chain(fullname, row['revision'])
+            if record is not None and record.get('revision') == row['revision']:
+                return record['board']
+        elif row['storage'] == 'pack':
+            text = read_packed_revision(fullname, row['revision'])
+            if text is not None:
+                return json.loads(text)
+        else:
+            return json.loads( read_text(fullname) )
+    except FileNotFoundError:
+        # // e.g. removed by hand
+        pass
+
+    return None
+
+
+# ---------------------------------------------------------------------
+# three-way merge of diverged revisions, GET /board/<id>/merge
+
+# // two hosts that saved the same board on their own have the same revision numbers for different boards ;
+# // the common ancestor is the latest revision the two of them saved alike (or one saved, and the other never did),
+# // and lists and notes are told apart by their ids, as Nullboard gives them
+
+def merge_board_revisions(board_id, args):
+    """
+        GET /board/<id>/merge?a=<revision>&host_a=<hostname>&b=<revision>&host_b=<hostname>[&base=<revision>&host_base=<hostname>] :
+        { "board" : the merged board, "a", "b", "base" : the revisions merged, "conflicts" : [ ... ] } ;
+        the hosts are optional, as with GET /board/<id>/revisions/<revision>, and so is the base, which is looked for otherwise
+    """
+
+    if not CATALOG:
+        return {}, RETURN_404_NOT_FOUND
+
+    try:
+        a, b = int(args['a']), int(args['b'])
+        base = int(args['base']) if args.get('base') else None
+    except (KeyError, ValueError):
+        return { 'error' : 'expected a=<revision>&b=<revision>' }, RETURN_400_BAD_REQUEST
+
+    ours, theirs = find_revision(board_id, a, args.get('host_a')), find_revision(board_id, b, args.get('host_b'))
+    base_row = None
+    if base is not None:
+        base_row = find_revision(board_id, base, args.get('host_base'))
+        if base_row is None:
+            return {}, RETURN_404_NOT_FOUND
+    elif ours is not None and theirs is not None:
+        with measure('merge'):
+            base_row = find_merge_base(ours, theirs)
+
+    rows = ( ours, theirs, base_row )
+    replies = [ cataloged_reply(row) if row is not None else None for row in rows ]
+    if replies[0] is None or replies[1] is None or ( base_row is not None and replies[2] is None ):
+        return {}, RETURN_404_NOT_FOUND
+
+    boards = [ json.loads(reply[0]) if reply is not None else {} for reply in replies ]
+    with measure('merge'):
+        board, conflicts = merge_boards( boards[2], boards[0], boards[1] )
+
+    result = { 'board'     : board
+             , 'a'         : catalog_entry(ours)
+             , 'b'         : catalog_entry(theirs)
+             , 'base'      : catalog_entry(base_row) if base_row is not None else None
+             , 'conflicts' : conflicts
+             }
+
+    return result, RETURN_200_OK
+
+
+def find_merge_base(ours, theirs):
+    """
+        the catalog row of the latest revision both 'ours' and 'theirs' come from, or None ;
+        walks down from the older of the two, so it only reads the revisions since they went apart
+    """
+
+    conn = get_catalog()
+    earliest = [ conn.execute( 'SELECT min(revision) FROM revisions WHERE board_id = ? AND hostname = ?', ( side['board_id'], side['hostname'] ) ).fetchone()[0]
+                 for side in (ours, theirs) ]
+
+    rows = conn.execute( 'SELECT * FROM revisions WHERE board_id = ? AND revision <= ? ORDER BY revision DESC, id DESC'
+                       , ( ours['board_id'], min(ours['revision'], theirs['revision']) ) )
+
+    for revision, copies in itertools.groupby(rows, key = lambda row: row['revision']):
+        copies = list(copies)
+
+        # // a side is its own copies ; or any copy if its host has none from that far back (say, it was unstashed
+        # // and never saved there before) -- not one it has just skipped, which the other side alone may have edited
+        sides = []
+        for side, first in zip( (ours, theirs), earliest ):
+            if side['revision'] == revision:
+                sides.append( [ side ] )
+            else:
+                own = [ row for row in copies if row['hostname'] == side['hostname'] ]
+                sides.append( own or ( copies if first is None or revision < first else [] ) )
+
+        # // the same copy needs no reading
+        shared = set( row['id'] for row in sides[0] ) & set( row['id'] for row in sides[1] )
+        if shared:
+            return next( row for row in copies if row['id'] in shared )
+
+        etags = set()
+        for row in sides[0]:
+            reply = cataloged_reply(row)
+            if reply is not None:
+                etags.add(reply[1])
+        for row in sides[1]:
+            reply = cataloged_reply(row)
+            if reply is not None and reply[1] in etags:
+                return row
+
+    return None
+
+
+# // a value missing on one side, i.e. deleted there
+_MISSING = object()
+
+def merge_value(base, a, b):
+    """ => ( value, conflict ) ; 'a' wins a conflict """
+
+    if a == b or b == base:
+        return a, False
+    if a == base:
+        return b, False
+
+    return a, True
+
+
+def merge_fields(base, a, b, skip=()):
+    """ a three-way merge of two dicts, key by key => ( dict, [ conflicting keys ] ) ; in the order of 'a' """
+
+    merged = {}
+    conflicts = []
+    for key in list(a) + [ key for key in b if key not in a ]:
+        if key in skip:
+            continue
+        value, conflict = merge_value( base.get(key, _MISSING), a.get(key, _MISSING), b.get(key, _MISSING) )
+        if value is not _MISSING:
+            merged[key] = value
+        if conflict:
+            conflicts.append(key)
+
+    return merged, conflicts
+
+
+def merge_order(base, a, b, keep):
+    """ a three-way merge of the order of keys => [ those in 'keep' ] : the side that reordered them wins, and what is new goes after its neighbour """
+
+    common = set(base) & set(a) & set(b)
+    if [ key for key in a if key in common ] == [ key for key in base if key in common ]:
+        order, other = b, a
+    else:
+        order, other = a, b
+
+    merged = [ key for key in order if key in keep ]
+    placed = set(merged)
+    previous = None
+    for key in list(other) + [ key for key in keep if key not in other ]:
+        if key in keep and key not in placed:
+            merged.insert( merged.index(previous) + 1 if previous is not None else 0, key )
+            placed.add(key)
+        if key in placed:
+            previous = key
+
+    return merged
+
+
+def item_key(item, fallback):
+    """
+        lists and notes go by their ids ; by their title or text, if they have none -- as with Nullboard itself,
+        only the extended fork gives them ids, see pair_unkeyed()
+    """
+
+    if item.get('id', None) is not None:
+        return ( 'id', item['id'] )
+
+    return ( fallback, json.dumps(item.get(fallback, None)) )
+
+
+def index_board(board, base=None):
+    """
+        => ( { list key : list }, [ list keys ], { list key : [ note keys ] }, { note key : ( list key, note ) } ) ;
+        'base' : the index_board() of the common ancestor, see pair_unkeyed()
+    """
+
+    lists, order, notes_order, notes = {}, [], {}, {}
+    for board_list in board.get('lists', None) or []:
+        key = item_key(board_list, 'title')
+        if key in lists:
+            continue
+        lists[key] = board_list
+        order.append(key)
+        notes_order[key] = []
+        for note in board_list.get('notes', None) or []:
+            note_key = item_key(note, 'text')
+            if note_key not in notes:
+                notes[note_key] = ( key, note )
+                notes_order[key].append(note_key)
+
+    if base is not None:
+        return pair_unkeyed(base, lists, order, notes_order, notes)
+
+    return lists, order, notes_order, notes
+
+
+def pair_unkeyed(base, lists, order, notes_order, notes):
+    """
+        lists and notes without ids go by their titles and texts, so an edited one would look deleted, and a new one
+        added in its place ; those are paired up here -- the n-th gone from the base with the n-th new one, of lists,
+        and of the notes of each list -- and the new one gets the key of the old one ; so that an edit on both sides is
+        a conflict rather than two notes, and a note added to a list renamed on the other side goes into that list
+    """
+
+    base_lists, base_order, base_notes_order, base_notes = base
+
+    unkeyed = lambda key: key[0] != 'id'
+    renamed = dict( zip( [ key for key in order if unkeyed(key) and key not in base_lists ]
+                       , [ key for key in base_order if unkeyed(key) and key not in lists ] ) )
+
+    lists = { renamed.get(key, key) : board_list for key, board_list in lists.items() }
+    order = [ renamed.get(key, key) for key in order ]
+    notes_order = { renamed.get(key, key) : keys for key, keys in notes_order.items() }
+    notes = { key : ( renamed.get(list_key, list_key), note ) for key, ( list_key, note ) in notes.items() }
+
+    edited = {}
+    for list_key, keys in notes_order.items():
+        gone = [ key for key in base_notes_order.get(list_key, []) if unkeyed(key) and key not in notes ]
+        new = [ key for key in keys if unkeyed(key) and key not in base_notes ]
+        edited.update( zip(new, gone) )
+
+    if edited:
+        notes_order = { list_key : [ edited.get(key, key) for key in keys ] for list_key, keys in notes_order.items() }
+        notes = { edited.get(key, key) : value for key, value in notes.items() }
+
+    return lists, order, notes_order, notes
+
+
+def merge_items(base, a, b):
+    """ base, a, b : the item on each side or None => ( the item to merge, or None if it is gone, conflict or None ) """
+
+    if a is not None and b is not None:
+        # // with no base, or new on both sides
+        return ( base or {}, a, b ), None
+
+    kept = a if b is None else b
+    if kept is None or kept == base:
+        # // deleted on both sides, or on one and left alone on the other
+        return None, None
+    if base is None:
+        # // new on one side
+        return ( {}, kept, kept ), None
+
+    # // deleted on one side, changed on the other : it stays as it was changed
+    return ( base, kept, kept ), 'b' if b is None else 'a'
+
+
+def merge_boards(base, a, b):
+    """ a three-way merge of boards => ( board, [ conflicts ] ) ; with a conflict, 'a' wins, and 'b' is in the conflict """
+
+    conflicts = []
+    def conflict(kind, what, key, **kwargs):
+        conflicts.append( dict( { 'kind' : kind, 'type' : what, 'id' : key[1] if key[0] == 'id' else None }, **kwargs ) )
+
+    board, keys = merge_fields(base, a, b, skip = ('lists',))
+    for key in keys:
+        if key != 'revision':
+            conflict( 'edit', 'board', ( 'id', None ), field = key, a = a.get(key, None), b = b.get(key, None) )
+
+    base_index = index_board(base)
+    base_lists, base_order, base_notes_order, base_notes = base_index
+    a_lists, a_order, a_notes_order, a_notes = index_board(a, base_index)
+    b_lists, b_order, b_notes_order, b_notes = index_board(b, base_index)
+
+    lists = {}
+    for key in a_order + [ key for key in b_order if key not in a_lists ] + [ key for key in base_order if key not in a_lists and key not in b_lists ]:
+        sides, deleted = merge_items( base_lists.get(key, None), a_lists.get(key, None), b_lists.get(key, None) )
+        if sides is None:
+            continue
+        if deleted:
+            conflict( 'delete', 'list', key, title = sides[1].get('title', None), deleted = deleted )
+
+        merged, fields = merge_fields( *sides, skip = ('notes',) )
+        for field in fields:
+            conflict( 'edit', 'list', key, field = field, a = sides[1].get(field, None), b = sides[2].get(field, None) )
+        lists[key] = merged
+
+    notes = {}
+    for key in list(a_notes) + [ key for key in b_notes if key not in a_notes ] + [ key for key in base_notes if key not in a_notes and key not in b_notes ]:
+        sides, deleted = merge_items( base_notes.get(key, None), a_notes.get(key, None), b_notes.get(key, None) )
+        if sides is None:
+            continue
+        ( base_list, base_note ), ( a_list, a_note ), ( b_list, b_note ) = [ side or ( None, {} ) for side in sides ]
+        if deleted:
+            conflict( 'delete', 'note', key, text = a_note.get('text', None), deleted = deleted )
+
+        if a_note == b_note:
+            # // most of them
+            note = a_note
+        else:
+            note, fields = merge_fields(base_note, a_note, b_note)
+            for field in fields:
+                conflict( 'edit', 'note', key, field = field, a = a_note.get(field, None), b = b_note.get(field, None) )
+
+        list_key, moved = merge_value(base_list, a_list, b_list)
+        if moved:
+            conflict( 'move', 'note', key, text = note.get('text', None), a = a_lists[a_list].get('title', None), b = b_lists[b_list].get('title', None) )
+        if list_key not in lists:
+            # // moved to a list that is gone
+            list_key = next( ( k for k in (a_list, b_list) if k in lists ), None )
+            if list_key is None:
+                conflict( 'delete', 'note', key, text = note.get('text', None), deleted = 'list' )
+                continue
+        notes[key] = ( list_key, note )
+
+    # // the notes of each list, in order
+    by_list = {}
+    for key, ( list_key, _ ) in notes.items():
+        by_list.setdefault(list_key, {})[key] = None
+
+    board['lists'] = []
+    for list_key in merge_order(base_order, a_order, b_order, lists):
+        keep = by_list.get(list_key, {})
+        order = merge_order( base_notes_order.get(list_key, []), a_notes_order.get(list_key, []), b_notes_order.get(list_key, []), keep )
+        board['lists'].append( dict( lists[list_key], notes = [ notes[key][1] for key in order ] ) )
+
+    # // a new revision, unless it is one of the two
+    board['revision'] = max( a.get('revision', None) or 0, b.get('revision', None) or 0 ) + 1
+    for side in (a, b):
+        if dict(board, revision = side.get('revision', None)) == side:
+            board['revision'] = side.get('revision', None)
+            break
+
+    return board, conflicts
+
+
+# ---------------------------------------------------------------------
+# board replies with an ETag, and a cache of them, see READ_CACHE_SIZE
+
+# // a reply is a board as compact json, and its ETag a hash of just that : the same board gets the same ETag
+# // from any worker, either server variant, and after a restart, so an If-None-Match poll gets a 304 from all of them
+
+def board_reply(board):
+    """ a board => ( body, etag ) """
+
+    # // the keys sorted, as SAVE_FORMAT or a delta chain may have reordered them
+    body = ( json.dumps(board, ensure_ascii=False, separators=(',', ':'), sort_keys=True) + '\n' ).encode('utf-8')
+    return body, '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+
+
+def etag_matches(if_none_match, etag):
+    """ an If-None-Match header against an ETag -- the weak comparison, as RFC 9110 has it for If-None-Match """
+
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    return any( tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(',') )
+
+
+def conditional_reply(reply, retcode, if_none_match):
+    """ ( body, etag ) => ( body, retcode, headers ) : a 304 without the body if the client has it already """
+
+    body, etag = reply
+    # // the client may keep it, but shall ask every time
+    headers = [ ('ETag', etag), ('Cache-Control', 'no-cache') ]
+    if etag_matches(if_none_match, etag):
+        return b'', RETURN_304_NOT_MODIFIED, headers
+
+    return body, retcode, [ ('Content-Type', 'application/json') ] + headers
+
+
+def board_response(result, retcode):
+    """ the Flask response for a ( body, etag ) reply of the current request ; anything else is left as it is """
+
+    if retcode != RETURN_200_OK:
+        return result, retcode
+
+    body, retcode, headers = conditional_reply( result, retcode, request.headers.get('If-None-Match', None) )
+    return make_response(body, retcode, headers), retcode
+
+
+class ReadCache:
+    """
+        the replies for the boards last saved or read, ( hostname, board_id, revision ) => ( body, etag ), the least
+        recently used ones dropped past 'size' bytes ; a saved board is kept as its text until it is first read
+    """
+
+    def __init__(self, size):
+        self.size    = size
+        self.used    = 0
+        self.entries = OrderedDict()    # // key -> ( text, None ) or ( None, reply )
+        self.lock    = threading.Lock()
+
+    def get(self, key):
+        """ the reply, or None """
+
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+
+        text, reply = entry
+        if reply is None:
+            # // outside the lock, as if it was read from the disk
+            reply = board_reply( json.loads(text) )
+            with self.lock:
+                # // unless it has been saved again meanwhile
+                if self.entries.get(key, None) is entry:
+                    self._add( key, (None, reply) )
+
+        return reply
+
+    def put(self, key, reply=None, text=None):
+        """ a reply, or the text of a board to make one of """
+
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self._add( key, (text, reply) )
+
+    def discard(self, key):
+
+        with self.lock:
+            self._pop(key)
+
+    def _add(self, key, entry):
+
+        self._pop(key)
+        size = self._size(entry)
+        if size > self.size:
+            return
+
+        self.entries[key] = entry
+        self.used += size
+        while self.used > self.size:
+            _, oldest = self.entries.popitem(last = False)
+            self.used -= self._size(oldest)
+
+    def _pop(self, key):
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= self._size(entry)
+
+    @staticmethod
+    def _size(entry):
+
+        text, reply = entry
+        return len(text) if reply is None else len(reply[0])
+
+
+read_cache = ReadCache(READ_CACHE_SIZE if CATALOG else 0)
+
+
+def cache_saved_board(payload, header, text):
+    """ a board just saved => the read cache, so that reading it back does not need the disk """
+
+    key = ( payload.hostname, str(payload.board_id), header.get('revision') or 0 )
+    # // a streamed board is too large to keep, and would have to be read back for that anyway
+    if payload.streamed or not isinstance(text, str):
+        read_cache.discard(key)
+    else:
+        read_cache.put(key, text = text)
+
+
+# ---------------------------------------------------------------------
+# full-text search
+
+# // every note is indexed once, when it appears, and closed when it is gone :
+# // a row of 'notes' is a note that was there from 'since_revision' to 'until_revision' (NULL while it still is) ;
+# // a note is its list title and text, so editing or moving it to another list makes a new one ;
+# // the saves only catalog their revisions, and a background thread indexes them, in the order of the catalog
+
+SEARCH_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS notes
+        ( id             INTEGER PRIMARY KEY
+        , hostname       TEXT    NOT NULL
+        , board_id       TEXT    NOT NULL
+        , list_title     TEXT    NOT NULL
+        , text           TEXT    NOT NULL
+        , copy           INTEGER NOT NULL
+        , list_index     INTEGER NOT NULL
+        , note_index     INTEGER NOT NULL
+        , since_revision INTEGER NOT NULL
+        , until_revision INTEGER
+        );
+    CREATE INDEX IF NOT EXISTS notes_by_board ON notes (hostname, board_id, until_revision);
+    CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (text, list_title, content='notes', content_rowid='id');
+    CREATE TABLE IF NOT EXISTS search_boards
+        ( hostname TEXT    NOT NULL
+        , board_id TEXT    NOT NULL
+        , revision INTEGER
+        , title    TEXT
+        , PRIMARY KEY (hostname, board_id)
+        );
+    CREATE TABLE IF NOT EXISTS search_progress
+        ( last_id  INTEGER NOT NULL
+        )
+"""
+
+# // the most results GET /search returns at once
+SEARCH_PAGE_MAX = 100
+# // the cataloged revisions indexed in one transaction
+SEARCH_BATCH = 100
+
+
+def fts5_available():
+
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE probe USING fts5 (text)')
+    except sqlite3.OperationalError:
+        return False
+
+    return True
+
+
+if SEARCH and not fts5_available():
+    log.warning( "# nb: no full-text search : this sqlite3 has no FTS5" )
+    SEARCH = False
+
+
+def note_keys(board):
+    """ { (list title, note text, copy) : (list index, note index) } ; 'copy' tells apart the same note repeated in a list """
+
+    keys = {}
+    copies = {}
+    for i, board_list in enumerate(board.get('lists') or []):
+        title = board_list.get('title') or ''
+        for j, note in enumerate(board_list.get('notes') or []):
+            text = note.get('text') or ''
+            copy = copies[(title, text)] = copies.get((title, text), -1) + 1
+            keys[(title, text, copy)] = (i, j)
+
+    return keys
+
+
+def load_search_state(conn, hostname, board_id):
+
+    row = conn.execute( 'SELECT revision FROM search_boards WHERE hostname = ? AND board_id = ?', (hostname, board_id) ).fetchone()
+    notes = conn.execute( 'SELECT id, list_title, text, copy FROM notes WHERE hostname = ? AND board_id = ? AND until_revision IS NULL'
+                        , (hostname, board_id) )
+
+    return { 'revision' : row['revision'] if row else None
+           , 'notes'    : { (n['list_title'], n['text'], n['copy']) : n['id'] for n in notes }
+           }
+
+
+def update_search_index(conn, hostname, board_id, revision, title, new, state=None):
+    """
+        indexes the notes that are new in this revision of the board, and closes the ones that are gone ;
+        'new' : the note_keys() of the revision ; 'state' : what the previous call returned for the board, if any ;
+        returns the new state, { 'revision' : the last indexed one, 'notes' : { (list title, text, copy) : notes.id } }
+    """
+
+    board_id = str(board_id)
+
+    if state is None:
+        state = load_search_state(conn, hostname, board_id)
+
+    old = state['notes']
+
+    notes = {}
+    gone = []
+    for key, note_id in old.items():
+        if key in new:
+            notes[key] = note_id
+        else:
+            gone.append( (state['revision'], note_id) )
+
+    conn.executemany( 'UPDATE notes SET until_revision = ? WHERE id = ?', gone )
+
+    for key, (list_index, note_index) in new.items():
+        if key in old:
+            continue
+        list_title, text, copy = key
+        cursor = conn.execute( 'INSERT INTO notes (hostname, board_id, list_title, text, copy, list_index, note_index, since_revision)'
+                               ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                             , (hostname, board_id, list_title, text, copy, list_index, note_index, revision) )
+        notes[key] = cursor.lastrowid
+        conn.execute( 'INSERT INTO notes_fts (rowid, text, list_title) VALUES (?, ?, ?)', (cursor.lastrowid, text, list_title) )
+
+    conn.execute( 'INSERT OR REPLACE INTO search_boards (hostname, board_id, revision, title) VALUES (?, ?, ?, ?)'
+                , (hostname, board_id, revision, title) )
+
+    return { 'revision' : revision, 'notes' : notes }
+
+
+def read_search_batch(rows):
+    """ catalog rows => [ ( row, note_keys() of its board, board title ), ... ] for the revisions that are still there """
+
+    batch = []
+    # // the revisions of the delta chain we have replayed last
+    chain, chain_boards = None, {}
+
+    for row in rows:
+        if row['storage'] == 'delta':
+            if row['location'] != chain:
+                chain = row['location']
+                try:
+                    chain_boards = { r['revision'] : r['board'] for r in replay_delta_chain(path_join(BACKUP_DIRECTORY, chain)) }
+                except FileNotFoundError:
+                    chain_boards = {}
+            board = chain_boards.get(row['revision'], None)
+        else:
+            board = read_cataloged_board(row)
+
+        if board is not None:
+            batch.append( ( row, note_keys(board), board.get('title', None) ) )
+
+    return batch
+
+
+def index_search():
+    """
+        indexes the revisions cataloged since the last call, SEARCH_BATCH at a time : the boards are read outside of any
+        transaction, and each batch is indexed in a short one ; returns the number of revisions looked at
+    """
+
+    conn = get_catalog()
+    count = 0
+
+    while True:
+        last_id = conn.execute('SELECT last_id FROM search_progress').fetchone()[0]
+        rows = conn.execute( 'SELECT * FROM revisions WHERE id > ? ORDER BY id LIMIT ?', (last_id, SEARCH_BATCH) ).fetchall()
+        if not rows:
+            return count
+
+        batch = read_search_batch(rows)
+
+        with catalog_transaction(conn):
+            # // the revisions of a board come in the order they were saved
+            states = {}
+            for row, keys, title in batch:
+                board_key = ( row['hostname'], row['board_id'] )
+                states[board_key] = update_search_index( conn, *board_key, row['revision'], title, keys, states.get(board_key, None) )
+            conn.execute( 'UPDATE search_progress SET last_id = ?', (rows[-1]['id'],) )
+
+        count += len(rows)
+
+
+def search_ready():
+    """ False until the search index has been created, see upgrade_catalog() """
+
+    return get_catalog().execute('PRAGMA user_version').fetchone()[0] >= 2
+
+
+_search_thread = None
+_search_thread_lock = threading.Lock()
+
+
+def run_search_indexer():
+
+    while True:
+        time.sleep(SEARCH_INTERVAL)
+        try:
+            if not (catalog_built() and search_ready()):
+                continue
+            # // one process at a time, the others have nothing to do
+            with process_turn('search', wait=False) as turn:
+                if turn:
+                    with measure('search'):
+                        index_search()
+        except Exception:
+            log.exception( "[error] search indexing failed" )
+
+
+def start_search():
+    """ starts the background search indexer of this process, if SEARCH says so ; cheap to call again """
+
+    global _search_thread
+
+    if _search_thread is not None or not (CATALOG and SEARCH):
+        return
+
+    with _search_thread_lock:
+        if _search_thread is None:
+            _search_thread = threading.Thread(target=run_search_indexer, name='search', daemon=True)
+            _search_thread.start()
+
+
+def search_query(text):
+    """ 'foo bar*' -> '"foo" "bar"*' : every word shall be there, quoted so that nothing is taken for FTS5 syntax """
+
+    words = re.findall( r'\w+\*?', text )
+    return ' '.join( f'"{w.rstrip("*")}"' + ('*' if w.endswith('*') else '') for w in words )
+
+
+def search_notes(args):
+    """
+        GET /search?q=<words>&limit=20&offset=0 [&board=<id>&host=<hostname>&current=1] : the best matching notes first ;
+        'current=1' : only the notes that are still there in the latest revision
+    """
+
+    if not (CATALOG and SEARCH):
+        return {}, RETURN_404_NOT_FOUND
+
+    query = search_query( args.get('q', '') )
+    try:
+        limit = min( max(1, int(args.get('limit', 20))), SEARCH_PAGE_MAX )
+        offset = max( 0, int(args.get('offset', 0)) )
+    except ValueError:
+        return {}, RETURN_400_BAD_REQUEST
+
+    if not query:
+        return {}, RETURN_400_BAD_REQUEST
+
+    if not search_ready():
+        return { 'error' : 'the search index is being built, try again later' }, RETURN_503_UNAVAILABLE
+
+    conn = get_catalog()
+
+    sql = ( "SELECT n.*, b.title AS board_title, b.revision AS board_revision, bm25(notes_fts) AS score"
+            "     , snippet(notes_fts, 0, '[', ']', '...', 16) AS snippet"
+            "  FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid"
+            "  LEFT JOIN search_boards b ON b.hostname = n.hostname AND b.board_id = n.board_id"
+            " WHERE notes_fts MATCH ?" )
+    params = [ query ]
+    if args.get('board'):
+        sql += ' AND n.board_id = ?'
+        params.append(args['board'])
+    if args.get('host'):
+        sql += ' AND n.hostname = ?'
+        params.append(args['host'])
+    if args.get('current', '0') not in ('', '0'):
+        sql += ' AND n.until_revision IS NULL'
+    # // the newest note goes first among equally good ones
+    sql += ' ORDER BY score, n.id DESC LIMIT ? OFFSET ?'
+    params += [ limit + 1, offset ]
+
+    rows = conn.execute(sql, params).fetchall()
+
+    results = [ { 'board'      : row['board_id']
+                , 'title'      : row['board_title']
+                , 'host'       : row['hostname']
+                  # // the last revision that had the note
+                , 'revision'   : row['until_revision'] if row['until_revision'] is not None else row['board_revision']
+                , 'since'      : row['since_revision']
+                , 'current'    : row['until_revision'] is None
+                , 'list'       : row['list_title']
+                , 'list_index' : row['list_index']
+                , 'note_index' : row['note_index']
+                , 'text'       : row['text']
+                , 'snippet'    : row['snippet']
+                , 'score'      : round(-row['score'], 3)
+                }
+                for row in rows[:limit] ]
+
+    result = { 'query'   : args.get('q', '')
+             , 'results' : results
+             , 'next'    : offset + limit if len(rows) > limit else None
+             }
+
+    return result, RETURN_200_OK
+
+
+def save_board_data(board_id, request):
+    """
+        attempts to save to a path under cwd )
+        
+        nb(1): 'board_id' is essential, and we expect bool(board_id) to be true )        
+        nb(2): we expect 'board_id' to come from request path, e.g. '/board/<board-id>'
+    """
+
+    _dbg = Dbg(request)
+
+    ## result = '' 
+    ## retcode = RETURN_200_OK
+
+    retcode = RETURN_200_UPDATED
+    # OK, looks like it wants something json-alike in return
+    result = '{}'
+
+    assert request.mimetype == 'application/x-www-form-urlencoded'
+
+    # // unless something has already read the form
+    if stream_board(request.mimetype, request.content_length) and 'form' not in request.__dict__:
+        return save_streamed_board(board_id, request)
+
+    payload = BoardPayload.from_request(board_id, request)
+
+    # // even if we only save it later, a wrong board shall be rejected right away
+    check_board_id( board_id, payload.header() )
+
+    if WRITE_BEHIND and write_behind.put(payload):
+        _dbg( "[write-behind] queued revision %r of board %s", payload.header().get('revision'), board_id )
+        return result, retcode
+
+    store_board(payload, _dbg)
+
+    # return None
+    return result, retcode
+
+
+def save_streamed_board(board_id, request):
+    """ a board save too large to be kept in memory, see StreamedPayload ; never goes through WRITE_BEHIND """
+
+    _dbg = Dbg(request)
+
+    payload = StreamedPayload.from_stream( board_id, get_host_name(request), request.stream )
+    try:
+        check_board_id( board_id, payload.header() )
+        _dbg( "[stream] revision %r of board %s, %d bytes", payload.header().get('revision'), board_id, payload.form.spools['data'].size if 'data' in payload.form.spools else 0 )
+        store_board(payload, _dbg)
+    finally:
+        payload.close()
+
+    return '{}', RETURN_200_UPDATED
+
+
+def store_board(payload, _dbg=None, newer_only=False):
+    """
+        saves a board to 'latest-saved.nbx', 'full/' and 'nbx/', and deletes old revisions ;
+        with 'newer_only' (see WRITE_BEHIND), a revision that is not newer than the one saved last is skipped
+    """
+
+    if _dbg is None:
+        _dbg = Dbg(None)
+
+    # // one save of a board at a time, or the retention could delete what another one has just written
+    with board_lock(payload.hostname, payload.board_id):
+        if newer_only and is_superseded(payload):
+            _dbg( "[write-behind] revision %r of board %s is older than the one saved, skipped", payload.header().get('revision'), payload.board_id )
+            return
+        _store_board(payload, _dbg)
+
+
+def is_superseded(payload):
+    """ a board revision that is not newer than the one saved last -- by a save of this process, or of another worker """
+
+    revision = payload.header().get('revision', None)
+    saved = _saved_revisions.get( (payload.hostname, str(payload.board_id)), None )
+
+    return saved is not None and type(revision) is int and revision <= saved
+
+
+def save_board_batch(request):
+    """ PUT /boards, see store_board_batch() """
+
+    return store_board_batch( get_host_name(request), get_request_data(request) )
+
+
+def batch_payload(item, hostname, t_now):
+    """ a board of a batch => BoardPayload ; ValueError if it is not a board """
+
+    if not isinstance(item, dict):
+        raise ValueError("a board shall be an object with 'self', 'data' and 'meta'")
+
+    # // the same form fields as Nullboard sends, as text -- or as objects, for the clients that would rather not
+    fields = { name : value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+               for name, value in item.items() if name in ('self', 'data', 'meta') }
+
+    payload = BoardPayload(None, hostname, fields, t_now)
+    header = payload.header()
+    if not isinstance(header, dict) or header.get('id', None) is None:
+        raise ValueError("no board in 'data'")
+
+    payload.board_id = str(header['id'])
+    try:
+        check_board_id( item.get('id', payload.board_id), header )
+    except (AssertionError, TypeError):
+        raise ValueError(f"board id {item.get('id')!r} is not the id of the board, {header['id']!r}")
+
+    return payload
+
+
+def store_board_batch(hostname, data):
+    """
+        { "boards" : [ { "self" : ..., "data" : ..., "meta" : ... }, ... ] } -- the same fields as in PUT /board/<id> ;
+        saves them all with a single commit, and returns { "results" : [ { "id", "revision", "status" [, "error"] }, ... ] }
+    """
+
+    items = data.get('boards', None) if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return { 'error' : 'expected { "boards" : [ ... ] }' }, RETURN_400_BAD_REQUEST
+    if len(items) > BATCH_MAX:
+        return { 'error' : f"at most {BATCH_MAX} boards at once" }, RETURN_413_TOO_LARGE
+
+    t_now = localtime()
+
+    results = []
+    payloads = []
+    for item in items:
+        try:
+            payload = batch_payload(item, hostname, t_now)
+        except ValueError as e:
+            results.append( { 'id' : item.get('id') if isinstance(item, dict) else None, 'status' : RETURN_400_BAD_REQUEST, 'error' : str(e) } )
+            continue
+
+        results.append( { 'id' : payload.board_id, 'revision' : payload.header().get('revision'), 'status' : RETURN_200_OK } )
+        if WRITE_BEHIND and write_behind.put(payload):
+            continue
+        payloads.append( (results[-1], payload) )
+
+    # // the same revision of a board more than once : only the last one is saved, and its status goes for all of them
+    last = {}
+    for i, (_, payload) in enumerate(payloads):
+        last[ (payload.board_id, payload.header().get('revision')) ] = i
+    stored = { i : n for n, i in enumerate( sorted( last.values() ) ) }
+
+    errors = store_boards( [ payloads[i][1] for i in stored ] )
+    for result, payload in payloads:
+        n = stored[ last[(payload.board_id, payload.header().get('revision'))] ]
+        if n in errors:
+            result.update( status = RETURN_500_SERVER_ERROR, error = str(errors[n]) )
+
+    return { 'results' : results }, RETURN_200_OK
+
+
+def store_boards(payloads, _dbg=None):
+    """ store_board() for many boards, with a single commit ; returns { index : exception } for those that failed """
+
+    if _dbg is None:
+        _dbg = Dbg(None)
+
+    errors = {}
+    board_keys = sorted( set( (payload.hostname, str(payload.board_id)) for payload in payloads ) )
+    with ExitStack() as locks:
+        # // always in the same order, so that two batches could not wait for each other
+        for hostname, board_id in board_keys:
+            locks.enter_context( board_lock(hostname, board_id) )
+
+        try:
+            with single_commit():
+                commit = pending_commit()
+                for i, payload in enumerate(payloads):
+                    savepoint = commit.savepoint()
+                    try:
+                        _store_board(payload, _dbg)
+                    except Exception as e:
+                        log.exception( "[error] batch: failed to save board %s", payload.board_id )
+                        # // none of its files go into place, and nothing is done for it once the others are
+                        commit.rollback(savepoint)
+                        forget_board_state( (payload.hostname, str(payload.board_id)) )
+                        errors[i] = e
+        except BaseException:
+            # // the revision index has seen files that never went into place
+            for board_key in board_keys:
+                forget_board_state(board_key)
+            raise
+
+    return errors
+
+
+def _store_board(payload, _dbg):
+
+    board_id = payload.board_id
+    hostname = payload.hostname
+    t_now    = payload.t_now
+
+    # // just 'id', 'title' and 'revision' -- the whole board is only parsed if we need it
+    board_data_json = payload.header()
+
+    time_subdir = time_to_subpath(t_now)
+
+    # filename_full   : save everything
+    # filename_board  : save the board / "data" part only
+    # filename_latest : save the most recent board version as "lastest"
+
+    # // '.gz' or '.zst' for the 'full' and 'nbx' files, see COMPRESS
+    compressed = compressed_suffix()
+
+    filename_full   = make_filename( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='full' + compressed )
+    filename_board  = make_filename( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='nbx' + compressed )
+    filename_latest = make_filename( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='latest-saved.nbx', use_rev = False )
+
+    # // see SHARDS
+    root = shard_root(board_id)
+
+    dir_latest = path_join(root, 'boards')
+    dir_full   = path_join(root, 'boards', 'full', hostname, time_subdir)
+    dir_board  = path_join(root, 'boards', 'nbx',  hostname, time_subdir)
+
+    board_text = payload.format_board()
+    full_text = payload.format_full()
+
+    targets = [ (dir_latest, filename_latest, board_text)
+              , (dir_full,   filename_full,   full_text )
+              , (dir_board,  filename_board,  board_text)
+              ]
+    if BOARD_STORAGE == 'delta':
+        # // 'full' and 'nbx' revisions go to the board chain instead
+        targets = targets[:1]
+
+    files = []
+    for directory, filename, text in targets:
+        if text is not None:
+            ensure_directory(directory)
+            # // 'latest-saved.nbx' is what one opens in Nullboard, so it stays as it is
+            if compressed and directory != dir_latest:
+                text = compress_text(text)
+            files.append( (path_join(directory, filename), text) )
+
+    if BOARD_STORAGE == 'dedup':
+        # // with COMPRESS, 'latest-saved.nbx' has no compressed twin to share an object with,
+        # // and its object would be left behind every time it is replaced
+        if compressed:
+            latest = path_join(dir_latest, filename_latest)
+            write_files( [ (fullname, text) for fullname, text in files if fullname == latest ] )
+            files = [ (fullname, text) for fullname, text in files if fullname != latest ]
+
+        objects = store_objects( [ text for _, text in files ], root )
+        for fullname, text in files:
+            object_name, created = objects[text]
+            if link_object(object_name, fullname) or created:
+                _dbg( "[dedup] %r -> %r", fullname, object_name )
+    else:
+        write_files(files)
+
+    revision = board_data_json.get('revision', None)
+    if type(revision) is int and revision >= 0:
+        _saved_revisions[(hostname, str(board_id))] = revision
+
+    if BOARD_STORAGE == 'delta':
+        board = payload.board()
+        if board:
+            extra = { k: payload.field(k) for k in ('self', 'meta') if payload.field(k) is not None }
+            if save_board_delta(board_id, hostname, board, extra, t_now):
+                _dbg( "[delta] saved revision %r of board %s", board.get('revision'), board_id )
+                head = _delta_heads[(hostname, str(board_id))]
+                after_commit( functools.partial( catalog_update, [ catalog_row(hostname, board_id, board, time.time(), 'delta', head['filename']) ] ) )
+                after_commit( functools.partial( cache_saved_board, payload, board, board_text ) )
+                if not payload.replica:
+                    after_commit( functools.partial( replicate, 'delta', hostname, board_id, head['filename'], t_now, board.get('revision') ) )
+        # // chains are compact enough to keep every revision
+        return
+
+    saved = [ (dir_full,  filename_full,  'full' + compressed, full_text )
+            , (dir_board, filename_board, 'nbx' + compressed,  board_text)
+            ]
+    # // the revisions this one pushes out are found right away, while the bucket on disk is still as the index knows it --
+    # // within a batch, all of its files are in place by the time the first callback runs ; they are deleted only then
+    expired = expire_revisions(payload, board_data_json, saved)
+    after_commit( functools.partial( _retire_revisions, payload, board_data_json, saved, expired, _dbg ) )
+
+
+def expire_revisions(payload, board_data_json, saved):
+    """ [ (directory, filename, suffix, text), ... ] being saved => the older revisions out of the KEEP_REVISIONS limit now """
+
+    board_id = payload.board_id
+    hostname = payload.hostname
+    t_now    = payload.t_now
+
+    time_subdir = time_to_subpath(t_now)
+
+    expired = []
+    for directory, filename, suffix, text in saved:
+        if text is None:
+            continue
+
+        parts = make_filename_parts( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix=suffix )
+        ##  parts = (prefix, board_name, board_id, board_rev, timestamp, suffix)
+        ##  parts = [ str(p) for p in parts if p ]
+        parts[-3] = '*'
+        filename_mask = '.'.join(parts)
+        pathname_mask = path_join(directory, filename_mask)
+
+        # keep only last KEEP_REVISIONS revisions in this directory
+        with measure('retention'):
+            expired += register_revision( pathname_mask, path_join(directory, filename), time_subdir, (hostname, str(board_id)) )
+
+    return expired
+
+
+def _retire_revisions(payload, board_data_json, saved, expired, _dbg):
+    """ once the files just saved are in place : deletes the 'expired' revisions, and updates the catalog """
+
+    board_id = payload.board_id
+    hostname = payload.hostname
+    t_now    = payload.t_now
+
+    # // if we are successful -- let us delete old revisions
+    deleted = []
+    with measure('retention'):
+        for fname in expired:
+            try:
+                unlink_revision(fname)
+                _dbg( "[info] deleted old revision %r", fname )
+            except OSError as e:
+                # print(e)
+                log.error( "[error] failed to delete file %r : %s", fname, e )
+            else:
+                deleted.append(fname)
+                pruned_revisions.inc()
+
+    dir_board, filename_board, _, board_text = saved[-1]
+    if board_text is not None:
+        catalog_update( [ catalog_row(hostname, board_id, board_data_json, time.time(), 'file', path_join(dir_board, filename_board)) ]
+                      , deleted )
+        cache_saved_board(payload, board_data_json, board_text)
+
+    dir_full, filename_full, _, full_text = saved[0]
+    if full_text is not None and not payload.replica:
+        # // once the file is in place, for the replicator to read it
+        after_commit( functools.partial( replicate, 'board', hostname, board_id, path_join(dir_full, filename_full), t_now ) )
+
+
+
+# ---------------------------------------------------------------------
+# write-behind buffer, see WRITE_BEHIND
 
-    return hostname
+class WriteBehindBuffer:
+    """
+        keeps the latest unsaved payload for every (hostname, board id),
+        and stores them from a background thread
+    """
 
+    def __init__(self, interval, max_revisions, max_pending, store=None):
+        self.interval      = interval
+        self.max_revisions = max_revisions
+        self.max_pending   = max_pending
+        # // a write-behind save must not replace a newer revision, which could have been saved meanwhile
+        # // by a synchronous save (e.g. while the buffer drains) or by the buffer of another worker
+        self.store         = store or functools.partial(store_board, newer_only = True)
+
+        # (hostname, board_id) => [ payload, number of coalesced revisions, time.monotonic() of the first one ]
+        self.pending = OrderedDict()
+
+        self.condition   = threading.Condition()
+        # // flushes never overlap, so that an older revision cannot overwrite a newer one
+        self.flush_lock  = threading.Lock()
+        self.thread      = None
+        self.stopping    = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, payload):
+        """ returns False if the buffer is full or stopped, and the payload shall be stored right away """
+
+        key = (payload.hostname, str(payload.board_id))
+
+        with self.condition:
+            if self.stopping:
+                return False
+
+            entry = self.pending.get(key, None)
+            if entry is not None:
+                entry[0] = payload
+                entry[1] += 1
+                if entry[1] >= self.max_revisions:
+                    self.condition.notify()
+            elif len(self.pending) >= self.max_pending:
+                return False
+            else:
+                self.pending[key] = [ payload, 1, time.monotonic() ]
 
-def sanitize_filename(filename, _re_filter = RE_SPECIAL):
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+                self.thread.start()
 
-    result = _re_filter.sub('_', filename)
-    return result
+        return True
 
-# // makes a list of essential filename parts from available components (board data, time, string prefix/suffix parts)
-def make_filename_parts( board_id, json_data=None, t_tuple=None, prefix=None, suffix=None, use_rev = True ):
-    """ ( ... , 'data latest nbx'.split() ) => [ hostname, board_name, {datestamp}, data.latest.nbx ] """
+    def _take(self, everything=False):
+        """ pops the entries that are due ; returns ( payloads, seconds until the next one is due ) """
 
-    _dbg = Dbg(request)
+        now = time.monotonic()
+        due = []
+        wait = self.interval
+        for key, (payload, count, since) in list(self.pending.items()):
+            left = since + self.interval - now
+            if everything or left <= 0 or count >= self.max_revisions:
+                due.append(payload)
+                del self.pending[key]
+            else:
+                wait = min(wait, left)
 
-    ## # this is expected to come from a "/board/<id>" route and shall not be None ))
-    ## assert board_id
+        return due, wait
 
-    board_name = None
-    board_rev = None
-    if json_data:
-        if board_id:
-            _board_id = int(board_id)
-            board_id_ = json_data.get('id', -1)
-            ## _dbg(f"[dbg] board_id (path) {board_id!r} ({_board_id!r}) == board_id (data) {board_id_!r} ?")
-            assert _board_id == board_id_
+    def flush(self, everything=True):
 
-        board_name = json_data.get('title', '').strip()
-        board_name = sanitize_filename( board_name )
-        # remove spaces
-        # board_name = '.'.join(board_name.split())
-        board_name = '_'.join(board_name.split())
-        
-        if use_rev:
-            board_rev = json_data.get('revision', None)
-        else:
-            board_rev = ''
+        with self.flush_lock:
+            with self.condition:
+                payloads, wait = self._take(everything)
 
-    timestamp = None
-    if t_tuple is not None:
-        timestamp = time_to_filename( t_tuple )
+            for payload in payloads:
+                try:
+                    self.store(payload)
+                except Exception:
+                    log.exception( "[error] write-behind failed to save board %s from %s", payload.board_id, payload.hostname )
 
-    parts = (prefix, board_name, board_id, board_rev, timestamp, suffix)
-    parts = [ str(p) for p in parts if p ]
+        return wait
 
-    return parts
+    def run(self):
 
+        wait = self.interval
+        while True:
+            with self.condition:
+                if not self.stopping:
+                    # // a second at most, to see 'stopping' set by a SIGTERM, which cannot notify() us
+                    self.condition.wait(timeout = min(wait, 1.0))
+                if self.stopping:
+                    break
 
-def make_filename( board_id, json_data=None, t_tuple=None, prefix=None, suffix=None, use_rev = True ):
-    """ ( ... , 'data latest nbx'.split() ) => hostname.board_name.{datestamp}.data.latest.nbx """
+            wait = self.flush(everything = False)
 
-    parts = make_filename_parts( board_id=board_id, json_data=json_data, t_tuple=t_tuple, prefix=prefix, suffix=suffix, use_rev = use_rev )
+        # // e.g. after a SIGTERM, which only sets 'stopping' ; drain() saves whatever comes after
+        self.flush()
 
-    filename = '.'.join(parts)
-    
-    return filename
+    def drain(self):
+        """ stops the thread and saves everything that is still pending """
 
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
 
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
 
-def save_board_data(board_id, request):
-    """
-        attempts to save to a path under cwd )
-        
-        nb(1): 'board_id' is essential, and we expect bool(board_id) to be true )        
-        nb(2): we expect 'board_id' to come from request path, e.g. '/board/<board-id>'
-    """
+        self.flush()
 
-    _dbg = Dbg(request)
 
-    ## result = '' 
-    ## retcode = RETURN_200_OK
+write_behind = WriteBehindBuffer(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_REVISIONS, WRITE_BEHIND_MAX_PENDING)
 
-    retcode = RETURN_200_UPDATED
-    # OK, looks like it wants something json-alike in return
-    result = '{}'
+Gauge( 'nullboard_write_behind_pending', 'Boards waiting in the write-behind buffer', lambda: len(write_behind) )
+Gauge( 'nullboard_fsync_pending', 'Group commit syncs requested but not finished yet', lambda: group_commit.requested - group_commit.finished )
 
-    full_data_json = get_request_data(request)
-    board_data_json = get_request_board_data(request)
 
-    t_now = localtime()
-    hostname = get_host_name( request )
-    time_subdir = time_to_subpath(t_now)
+_previous_sigterm_handler = None
 
-    # filename_full   : save everything
-    # filename_board  : save the board / "data" part only
-    # filename_latest : save the most recent board version as "lastest"
+def _drain_on_sigterm(signum, frame):
 
-    filename_full   = make_filename( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='full' )
-    filename_board  = make_filename( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='nbx' )
-    filename_latest = make_filename( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='latest-saved.nbx', use_rev = False )
+    # // no drain() here : it takes the buffer lock and joins the flusher thread, and the thread we have interrupted
+    # // could be holding the lock -- the flusher thread saves what is pending, and so does atexit on our way out
+    write_behind.stopping = True
 
-    dir_latest = path_join(BACKUP_DIRECTORY, 'boards')
-    dir_full   = path_join(BACKUP_DIRECTORY, 'boards', 'full', hostname, time_subdir)
-    dir_board  = path_join(BACKUP_DIRECTORY, 'boards', 'nbx',  hostname, time_subdir)
+    if callable(_previous_sigterm_handler):
+        _previous_sigterm_handler(signum, frame)
+    else:
+        sys.exit(0)
 
-    for directory, filename, data in ( (dir_latest, filename_latest, board_data_json)
-                                     , (dir_full,   filename_full,   full_data_json )
-                                     , (dir_board,  filename_board,  board_data_json)
-                                     ):
-        if data is not None:
-            os.makedirs(directory, exist_ok = True)
-            fullname = path_join(directory, filename)
-            with open(fullname, 'wt') as f:
-                f.write(json.dumps(data, indent=4, sort_keys=True, ensure_ascii=False))            
 
+def install_write_behind_handlers():
+    """ makes sure that nothing is left unsaved at exit or on SIGTERM """
 
-    # // if we are successful -- let us delete old revisions
-    # // // TODO : clean this up
-    full_parts   = make_filename_parts( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='full' )
-    board_parts  = make_filename_parts( board_id, json_data=board_data_json, t_tuple=t_now, prefix=hostname, suffix='nbx' )
-    
-    for directory, parts in ( (dir_full,   full_parts,   )
-                            , (dir_board,  board_parts,  )
-                            ):
+    global _previous_sigterm_handler
 
-        ##  parts = (prefix, board_name, board_id, board_rev, timestamp, suffix)
-        ##  parts = [ str(p) for p in parts if p ]
-        parts[-3] = '*'
-        filename_mask = '.'.join(parts)
-        pathname_mask = path_join(directory, filename_mask)
-        # [ https://stackoverflow.com/a/168424 ]
-        files = list(  filter( os.path.isfile, glob.glob(pathname_mask) )  )
-        if files:
-            files.sort(key=lambda x: os.path.getmtime(x))
-            files.reverse()
-            # keep only last 5 revisions in this directory
-            for fname in files[5:]:
-                try:
-                    os.unlink(fname)
-                    _dbg( f"[info] deleted old revision {fname!r}" )
-                except OSError as e:
-                    # print(e)
-                    _dbg( f"[error] failed to delete file {fname!r} : {e}" )
+    atexit.register(write_behind.drain)
 
+    try:
+        _previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, _drain_on_sigterm)
+    except ValueError:
+        # // not the main thread -- we shall rely on atexit
+        pass
 
-    # return None
-    return result, retcode
+
+if WRITE_BEHIND:
+    install_write_behind_handlers()
 
 
 def save_stashed_board(board_id, request):
@@ -436,30 +4884,96 @@ def save_stashed_board(board_id, request):
     ## board_data_json = get_request_board_data(request)
     board_data_json = get_json_data(request)
 
+    stash_board( board_id, get_host_name(request), board_data_json, format_board(request) )
+
+    # return None
+    return result, retcode
+
+
+def stash_board(board_id, hostname, board_data_json, board_text, replica=False):
+    """ saves 'board_text' to 'boards/stashed', and makes it the one to unstash ; 'replica' : see apply_replicated() """
+
     t_now = localtime()
-    hostname = get_host_name( request )
     time_subdir = time_to_subpath(t_now)
 
-    filename_json   = make_filename( board_id, json_data=board_data_json, t_tuple=None, prefix=None, suffix=hostname+'.latest.json' )
+    filename_json   = make_filename( board_id, json_data=board_data_json, t_tuple=None, prefix=None, suffix=hostname+'.latest.json'+compressed_suffix() )
     # filename_yaml   = make_filename( board_id, json_data=board_data_json, t_tuple=None, prefix=None, suffix=hostname+'.latest.yaml' )
 
-    dir_stashed = path_join(BACKUP_DIRECTORY, 'boards/stashed')
+    dir_stashed = path_join(shard_root(board_id), 'boards/stashed')
 
     if board_data_json is not None:
         os.makedirs(dir_stashed, exist_ok = True)
         fullname = path_join(dir_stashed, filename_json)
-        with open(fullname, 'wt') as f:
-            f.write(json.dumps(board_data_json, indent=4, sort_keys=True, ensure_ascii=False))            
+        write_file(fullname, compress_text(board_text) if compressed_suffix() else board_text)
 
-    # return None
-    return result, retcode
+        set_latest_stash(catalog_location(fullname), board_data_json)
+
+        if not replica:
+            replicate( 'stash', hostname, board_id, fullname, t_now )
+
+
+# // the name of the most recently stashed board is kept in 'boards/stashed/LATEST',
+# // so that we do not have to look through all of them on every unstash ; since SHARDS, it is
+# // the pathname as the catalog would have it (see catalog_location()), and before, just the name
+STASH_POINTER_FILENAME = 'LATEST'
+
+# { 'pointer' : (st_mtime_ns, st_size) of the pointer file, 'filename' : ..., 'data' : the parsed board,
+#   'reply' : ( body, etag ) once it has been unstashed }
+_latest_stash = {}
+_latest_stash_lock = threading.RLock()
+
+
+def get_stash_pointer_path():
+
+    return path_join(BACKUP_DIRECTORY, 'boards/stashed', STASH_POINTER_FILENAME)
+
+
+def get_stash_path(latest):
+    """ what the pointer says => the stashed file """
+
+    if os.sep not in latest:
+        return path_join(BACKUP_DIRECTORY, 'boards/stashed', latest)
+
+    return path_join(BACKUP_DIRECTORY, latest)
+
+
+def _pointer_stamp(st):
+
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def set_latest_stash(filename, board_data_json):
+    """ atomically points 'LATEST' at a freshly stashed board, and caches the board itself """
 
+    pointer = get_stash_pointer_path()
+
+    with _latest_stash_lock:
+        write_file(pointer, filename)
+
+        _latest_stash.clear()
+        _latest_stash.update( pointer = _pointer_stamp(os.stat(pointer)), filename = filename, data = board_data_json )
+
+
+def find_latest_stash():
+    """ the slow way, for the stashes saved before we had a pointer -- or moved since, see SHARDS """
+
+    ## dir_stashed = path_join(BACKUP_DIRECTORY, 'boards/stashed')
+    files = []
+    for root in storage_roots():
+        for filename_mask in saved_file_patterns('*.latest.json'):
+            # [ https://stackoverflow.com/a/168424 ]
+            files += list(  filter( os.path.isfile, glob.glob(path_join(root, 'boards/stashed', filename_mask)) )  )
+    if not files:
+        return None
+
+    files.sort(key=lambda x: os.path.getmtime(x))
+    return catalog_location(files[-1])
 
 
 # [ https://flask.palletsprojects.com/en/2.1.x/quickstart/#about-responses ]
 def load_stashed_board():
     """
-        find the most recent board under 'boards/stashed' and return it
+        find the most recent board under 'boards/stashed' and return it, as a ( body, etag ) reply
     """
 
     ## _dbg = Dbg(request)
@@ -467,19 +4981,49 @@ def load_stashed_board():
     result  = {}
     retcode = RETURN_404_NOT_FOUND
 
-    ## dir_stashed = path_join(BACKUP_DIRECTORY, 'boards/stashed')
-    filename_mask = path_join(BACKUP_DIRECTORY, 'boards/stashed', '*.latest.json')
-    # [ https://stackoverflow.com/a/168424 ]
-    files = list(  filter( os.path.isfile, glob.glob(filename_mask) )  )
-    if files:
-        files.sort(key=lambda x: os.path.getmtime(x))
-        latest = files[-1]
+    pointer = get_stash_pointer_path()
+
+    with _latest_stash_lock:
+        try:
+            stamp = _pointer_stamp(os.stat(pointer))
+        except FileNotFoundError:
+            stamp = None
+
+        # // still the same pointer (it could have been updated by another server process)
+        if stamp is not None and _latest_stash.get('pointer') == stamp:
+            read_cache_total.inc('hit')
+            if 'reply' not in _latest_stash:
+                _latest_stash['reply'] = board_reply(_latest_stash['data'])
+            return _latest_stash['reply'], RETURN_200_OK
+
+        read_cache_total.inc('miss')
 
-        with open(latest, 'rt') as f:
-            result = json.loads(f.read())
+        latest = None
+        if stamp is not None:
+            with open(pointer, 'rt', encoding='utf-8') as f:
+                latest = f.read().strip()
+
+            # // e.g. removed by hand
+            if not os.path.isfile(get_stash_path(latest)):
+                latest = stamp = None
+
+        if latest is None:
+            latest = find_latest_stash()
+
+        if latest:
+            board = json.loads( read_text(get_stash_path(latest)) )
             ## result = json.load(f)
+            result = board_reply(board)
             retcode = RETURN_200_OK
 
+            if stamp is not None:
+                _latest_stash.clear()
+                _latest_stash.update( pointer = stamp, filename = latest, data = board, reply = result )
+            else:
+                # // next time we will know
+                set_latest_stash(latest, board)
+                _latest_stash['reply'] = result
+
     ## # // [ https://stackoverflow.com/a/56265574 ]
     ## # [ https://github.com/pallets/flask/issues/478#issuecomment-166723852 ]
     return result, retcode
@@ -493,44 +5037,432 @@ def save_other_data(board_id, dir, request):
         nb(2): we expect 'board_id' to come from request path, e.g. '/board/<board-id>'
     """
 
+    # by default, don't be picky and agree to save empty datasets 
+
+    data = get_request_data(request)
+
+    return store_other_data( board_id, dir, get_host_name(request), data )
+
+
+# // (hostname, dir) => the digest of the last data saved under '{dir}/{hostname}/', see store_other_data() ;
+# // under the same key as board_lock(hostname, dir), which drops it once another process has saved there
+_other_heads = {}
+
+
+def other_digest(data):
+    """ data => ( the text we save, its sha256 ) ; the same data is the same text, whatever order its keys came in """
+
+    text = json.dumps(data, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+    return text, hashlib.sha256( text.encode('utf-8') ).hexdigest()
+
+
+def last_other_data(directory):
+    """ the last file saved under '{dir}/{hostname}/' (i.e. its YYYY-MM-DD/HH/MM subdirectories), or None """
+
+    # // the names sort by time, so it is the last one at every level
+    for level in range(4):
+        try:
+            names = sorted( name for name in os.listdir(directory) if not name.startswith('.') )
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        if level == 3:
+            # // not one a crash has left half-written
+            names = [ name for name in names if not name.endswith('.tmp') and os.path.isfile(path_join(directory, name)) ]
+            return path_join(directory, names[-1]) if names else None
+
+        names = [ name for name in names if os.path.isdir(path_join(directory, name)) ]
+        if not names:
+            return None
+        directory = path_join(directory, names[-1])
+
+
+def store_other_data(board_id, dir, hostname, data, t_now=None, replica=False):
+    """
+        saves 'data' under '{dir}/{hostname}/' -- unless it is the same as what was saved there last ;
+        returns the same as save_other_data() ; 'replica' : see apply_replicated()
+    """
+
     # default return values, could change later if needed
     result = '' 
 
     retcode = RETURN_200_OK
 
-    # by default, don't be picky and agree to save empty datasets 
-
-    data = get_request_data(request)
-
     if data is not None:
 
         # 2021-12-31 18:12 -> 2021-12-31/18/10
-        t_now = localtime()
+        if t_now is None:
+            t_now = localtime()
 
         #
-        # save everything we've been sent
+        # save only what has changed since the last time
         #
 
-        hostname = get_host_name( request )
-        time_subdir = time_to_subpath(t_now)
+        text, digest = other_digest(data)
+        head_key = (hostname, dir)
 
-        directory = path_join(BACKUP_DIRECTORY, dir, hostname, time_subdir)
-        os.makedirs(directory, exist_ok = True)
+        with board_lock(hostname, dir):
+            last = _other_heads.get(head_key, None)
+            if last is None:
+                fullname = last_other_data( path_join(BACKUP_DIRECTORY, dir, hostname) )
+                try:
+                    last = other_digest( json.loads(read_text(fullname)) )[1] if fullname else ''
+                except (OSError, ValueError) as e:
+                    log.warning( "[warning] %s: cannot read %r, saving anyway : %s", dir, fullname, e )
+                    last = ''
 
-        filename = make_filename( board_id, json_data=data, t_tuple=t_now, prefix=None, suffix='data' )
-        fullname = path_join(directory, filename)
+            if digest == last:
+                other_saves_total.inc( dir, 'unchanged' )
+            else:
+                time_subdir = time_to_subpath(t_now)
 
-        with open( fullname, 'wt' ) as f:
-            # [ https://stackoverflow.com/questions/14853694/python-jsonify-dictionary-in-utf-8/39561607 ]
-            f.write(json.dumps(data, indent=4, sort_keys=True, ensure_ascii=False))
+                directory = path_join(BACKUP_DIRECTORY, dir, hostname, time_subdir)
+                os.makedirs(directory, exist_ok = True)
+
+                filename = make_filename( board_id, json_data=data, t_tuple=t_now, prefix=None, suffix='data' + compressed_suffix() )
+                fullname = path_join(directory, filename)
+
+                write_file( fullname, compress_text(text) )
+                other_saves_total.inc( dir, 'saved' )
+
+                if not replica:
+                    replicate( 'other', hostname, board_id, fullname, t_now )
+
+            _other_heads[head_key] = digest
 
-            # return something json-alike 
-            result = '{}'
+        # return something json-alike 
+        result = '{}'
 
     # return None
     return result, retcode
 
 
+# ---------------------------------------------------------------------
+# replication to another server, see REPLICATE_TO
+
+# // every save is noted in an outbox (boards/outbox.sqlite) once it is on disk, and a background thread sends
+# // the outbox in batches to PUT /replicate of the peer ; only what the saves wrote is noted, and read back
+# // when it is sent -- so the outbox stays small, and what the retention has deleted meanwhile is not sent at all
+
+OUTBOX_FILENAME = 'outbox.sqlite'
+
+OUTBOX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox
+        ( id       INTEGER PRIMARY KEY AUTOINCREMENT
+        , kind     TEXT    NOT NULL
+        , hostname TEXT    NOT NULL
+        , board_id TEXT
+        , revision INTEGER
+        , t_now    REAL    NOT NULL
+        , saved    REAL    NOT NULL
+        , location TEXT    NOT NULL
+        );
+    CREATE TABLE IF NOT EXISTS origin ( id TEXT NOT NULL )
+"""
+
+_outbox_local = threading.local()
+
+_replicator_thread = None
+_replicator_thread_lock = threading.Lock()
+# // set by every save, so that it is sent right away rather than on the next retry
+_replicator_wakeup = threading.Event()
+
+
+def get_outbox():
+    """ this thread's connection to the outbox """
+
+    path = path_join(BACKUP_DIRECTORY, 'boards', OUTBOX_FILENAME)
+    cached = getattr(_outbox_local, 'outbox', None)
+    if cached is not None and cached[0] == path:
+        return cached[1]
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    conn = sqlite3.connect(path, timeout = 60, isolation_level = None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.row_factory = sqlite3.Row
+
+    with catalog_transaction(conn):
+        execute_script(conn, OUTBOX_SCHEMA)
+        # // who we are to the peer, which remembers how far it has got with us
+        if conn.execute('SELECT id FROM origin').fetchone() is None:
+            conn.execute( 'INSERT INTO origin (id) VALUES (?)', ( hashlib.sha256(os.urandom(32)).hexdigest()[:32], ) )
+
+    _outbox_local.outbox = (path, conn)
+    return conn
+
+
+def replicate(kind, hostname, board_id, fullname, t_now, revision=None):
+    """
+        notes a save in the outbox : 'board' (its 'full' file), 'delta' (a revision of a chain), 'stash' or 'other' ;
+        't_now' is the time of the save, which the peer saves it with -- 'saved' when it was noted, for the lag
+    """
+
+    if not REPLICATE_TO:
+        return
+
+    try:
+        get_outbox().execute( 'INSERT INTO outbox (kind, hostname, board_id, revision, t_now, saved, location) VALUES (?, ?, ?, ?, ?, ?, ?)'
+                            , ( kind, hostname, None if board_id is None else str(board_id), revision, time.mktime(t_now), time.time(), catalog_location(fullname) ) )
+    except sqlite3.Error as e:
+        # // the save itself is done, and the peer will have the next one
+        log.error( "[error] replication: could not note %r in the outbox : %s", fullname, e )
+        return
+
+    start_replicator()
+    _replicator_wakeup.set()
+
+
+def outbox_item(row):
+    """ an outbox row => what PUT /replicate takes, or None if it is gone since """
+
+    fullname = path_join(BACKUP_DIRECTORY, row['location'])
+    item = { 'id' : row['id'], 'kind' : row['kind'], 'hostname' : row['hostname'], 'board_id' : row['board_id'], 't_now' : row['t_now'] }
+
+    try:
+        if row['kind'] == 'delta':
+            record, _ = read_delta_chain(fullname, row['revision'])
+            if record is None or record.get('revision') != row['revision']:
+                return None
+            item['kind'] = 'board'
+            item['fields'] = dict( { k : record[k] for k in ('self', 'meta') if k in record }
+                                 , data = json.dumps(record['board'], ensure_ascii=False) )
+        elif row['kind'] == 'other':
+            item['dir'] = row['location'].split(os.sep)[0]
+            item['text'] = read_text(fullname)
+        else:
+            # // a 'full' file is the form as it was sent, a stash the board
+            item['text'] = read_text(fullname)
+    except FileNotFoundError:
+        # // deleted by the retention meanwhile
+        return None
+
+    return item
+
+
+def send_batch():
+    """ sends the oldest saves in the outbox, and forgets them ; returns how many, or raises if the peer would not take them """
+
+    conn = get_outbox()
+    rows = conn.execute('SELECT * FROM outbox ORDER BY id LIMIT ?', ( REPLICATE_BATCH, )).fetchall()
+    if not rows:
+        return 0
+
+    # // a batch as large as the peer would take, if it is set up like us -- and at least one save
+    items, size = [], 0
+    for row in rows:
+        item = outbox_item(row)
+        if item is not None:
+            size += len( item.get('text', '') ) + sum( len(value or '') for value in item.get('fields', {}).values() )
+            if items and size > MAX_CONTENT_LENGTH // 2:
+                break
+            items.append(item)
+        last = row['id']
+
+    if items:
+        body = gzip.compress( json.dumps( { 'origin' : conn.execute('SELECT id FROM origin').fetchone()[0], 'items' : items } ).encode('utf-8'), 1 )
+        headers = { 'Content-Type' : 'application/json', 'Content-Encoding' : 'gzip' }
+        if REPLICATE_TOKEN:
+            headers['X-Access-Token'] = REPLICATE_TOKEN
+
+        try:
+            with urllib.request.urlopen( urllib.request.Request(REPLICATE_TO + '/replicate', data = body, headers = headers, method = 'PUT')
+                                       , timeout = REPLICATE_TIMEOUT ) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != RETURN_413_TOO_LARGE or len(items) > 1:
+                raise
+            # // it will never take this one, and the rest shall not wait for it
+            log.error( "[error] replication: %s does not take %s of board %s from %s, too large", REPLICATE_TO, items[0]['kind'], items[0]['board_id'], items[0]['hostname'] )
+
+    conn.execute('DELETE FROM outbox WHERE id <= ?', ( last, ))
+    replicated_total.inc( 'sent', amount = len(items) )
+
+    return len(rows)
+
+
+def run_replicator():
+
+    failures = 0
+    while True:
+        if failures:
+            # // with a bit of jitter, so that a peer back from an outage is not hit by everyone at once
+            delay = min( REPLICATE_BACKOFF_MAX, REPLICATE_RETRY * 2 ** min(failures - 1, 30) ) * random.uniform(0.75, 1)
+        else:
+            delay = REPLICATE_RETRY
+        _replicator_wakeup.wait(delay)
+        _replicator_wakeup.clear()
+
+        lock_name = path_join(BACKUP_DIRECTORY, 'boards', 'locks', 'replicate.lock')
+        try:
+            os.makedirs(os.path.dirname(lock_name), exist_ok = True)
+            with open(lock_name, 'a+') as lock:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        # // another process is sending
+                        continue
+
+                # // a full batch, and there may be more
+                while send_batch() >= REPLICATE_BATCH:
+                    pass
+            failures = 0
+
+        except Exception as e:
+            failures += 1
+            replication_failures.inc()
+            log.warning( "[warning] replication to %s failed (%d in a row) : %s", REPLICATE_TO, failures, e )
+
+
+def start_replicator():
+    """ starts the replication thread of this process, if REPLICATE_TO says so ; cheap to call again """
+
+    global _replicator_thread
+
+    if _replicator_thread is not None or not REPLICATE_TO:
+        return
+
+    with _replicator_thread_lock:
+        if _replicator_thread is None:
+            _replicator_thread = threading.Thread(target=run_replicator, name='replicator', daemon=True)
+            _replicator_thread.start()
+
+
+def start_background(worker=None):
+    """
+        starts the background threads of a server process (see CATALOG, SEARCH, RETENTION and REPLICATE_TO) as it starts, rather than
+        on its first request ; 'worker' : the gunicorn worker, when called as its post_worker_init hook
+    """
+
+    start_catalog()
+    start_search()
+    start_retention()
+    start_replicator()
+    start_metrics_sharer()
+
+
+def replication_lag():
+    """ ( saves waiting in the outbox, seconds the oldest of them has been waiting ) """
+
+    if not REPLICATE_TO:
+        return 0, 0.0
+
+    count, oldest = get_outbox().execute('SELECT count(*), min(saved) FROM outbox').fetchone()
+    return count, ( time.time() - oldest if oldest is not None else 0.0 )
+
+
+Gauge( 'nullboard_replication_pending', 'Saves in the outbox, not sent to REPLICATE_TO yet', lambda: replication_lag()[0] )
+Gauge( 'nullboard_replication_lag_seconds', 'How long the oldest save in the outbox has been waiting', lambda: replication_lag()[1] )
+
+
+RE_REPLICA_NAME = re.compile(r'[\w.:-]+')
+
+def replica_name(value):
+    """ a hostname, board id or origin that is safe to use in a pathname """
+
+    value = str(value)
+    if not RE_REPLICA_NAME.fullmatch(value) or value in ('.', '..'):
+        raise ValueError(f"bad name {value!r}")
+
+    return value
+
+
+def mark_replicated(marker, payloads, applied):
+    """
+        saves the boards of a batch that have been put off so far, and then notes 'applied' as the last id of the batch
+        that is done ; raises if a board could not be saved -- and then the batch comes again from the last id noted
+    """
+
+    errors = store_boards(payloads)
+    if errors:
+        raise next(iter(errors.values()))
+
+    write_file( marker, str(applied) )
+
+
+def apply_replicated(data):
+    """
+        PUT /replicate : { "origin" : ..., "items" : [ ... ] } from the outbox of another server => { "applied" : the last id } ;
+        the items are applied in order, and those applied before are skipped, so that a batch can be sent again
+    """
+
+    try:
+        origin = replica_name( data['origin'] )
+        items = sorted( data['items'], key = lambda item: item['id'] )
+    except (KeyError, TypeError, ValueError) as e:
+        return { 'error' : 'expected { "origin" : ..., "items" : [ ... ] } : %s' % e }, RETURN_400_BAD_REQUEST
+
+    marker = path_join(BACKUP_DIRECTORY, 'boards', 'replicas', origin)
+    os.makedirs(os.path.dirname(marker), exist_ok = True)
+
+    # // one batch of an origin at a time : the same one may come again while it is still being applied
+    with open(marker + '.lock', 'a+') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        try:
+            with open(marker, 'rt') as f:
+                applied = int( f.read().strip() or 0 )
+        except FileNotFoundError:
+            applied = 0
+
+        fresh = [ item for item in items if item['id'] > applied ]
+
+        payloads = []
+        for item in fresh:
+            if item.get('kind') != 'board' and payloads:
+                # // the boards before it are saved first, see below
+                mark_replicated( marker, payloads, applied )
+                payloads = []
+            try:
+                # // PUT /config comes without one
+                hostname = replica_name(item['hostname'])
+                board_id = replica_name(item['board_id']) if item['board_id'] is not None or item['kind'] != 'other' else None
+                t_now = localtime(item['t_now'])
+                if item['kind'] == 'board':
+                    payload = BoardPayload( board_id, hostname, item['fields'] if 'fields' in item else json.loads(item['text']), t_now )
+                    payload.replica = True
+                    payloads.append(payload)
+                elif item['kind'] == 'stash':
+                    stash_board( board_id, hostname, json.loads(item['text']), item['text'], replica = True )
+                elif item['kind'] == 'other' and item.get('dir') == 'config':
+                    store_other_data( board_id, item['dir'], hostname, json.loads(item['text']), t_now, replica = True )
+                else:
+                    raise ValueError(f"unknown kind {item['kind']!r}")
+            except (KeyError, TypeError, ValueError) as e:
+                # // it will not get any better if it is sent again
+                log.error( "[error] replication: skipping item %r from %s : %s", item.get('id'), origin, e )
+
+            applied = item['id']
+            if item.get('kind') != 'board':
+                # // a stash or a config is not applied again when the batch comes again
+                write_file( marker, str(applied) )
+
+        if fresh:
+            mark_replicated( marker, payloads, applied )
+
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    replicated_total.inc( 'received', amount = len(fresh) )
+    return { 'applied' : applied }, RETURN_200_OK
+
+
+def replication_status():
+    """ GET /replicate : how far behind we are with REPLICATE_TO, and how far other servers are with us """
+
+    pending, lag = replication_lag()
+
+    replicas = {}
+    for fullname in glob.glob(path_join(BACKUP_DIRECTORY, 'boards', 'replicas', '*')):
+        if not fullname.endswith('.lock'):
+            with open(fullname, 'rt') as f:
+                replicas[os.path.basename(fullname)] = { 'applied' : int( f.read().strip() or 0 ), 'time' : int(os.path.getmtime(fullname)) }
+
+    return { 'peer' : REPLICATE_TO or None, 'pending' : pending, 'lag' : round(lag, 3), 'replicas' : replicas }, RETURN_200_OK
+
+
 
 # ---------------------------------------------------------------------
 # handlers
@@ -540,10 +5472,15 @@ def save_other_data(board_id, dir, request):
 RETURN_200_OK = RETURN_200_UPDATED = 200
 RETURN_201_CREATED                 = 201
 RETURN_204_NO_CONTENT              = 204
+RETURN_304_NOT_MODIFIED            = 304
 
+RETURN_400_BAD_REQUEST             = 400
 RETURN_403_FORBIDDEN               = 403
 RETURN_404_NOT_FOUND               = 404
+RETURN_413_TOO_LARGE               = 413
 RETURN_418_I_AM_A_TEAPOT           = 418
+RETURN_500_SERVER_ERROR            = 500
+RETURN_503_UNAVAILABLE             = 503
 
 RETURN_501_NOT_IMPLEMENTED         = 403
 
@@ -595,7 +5532,7 @@ def handle_board_request(request, board_id):
             result, retcode = save_board_data(board_id, request)
         elif request.method == 'DELETE':
             ## os.system( f"mv ${dir}/${id} ${dir}/${id}.deleted")
-            _dbg( f"[delete] ignoring delete request for board {board_id}" )
+            _dbg( "[delete] ignoring delete request for board %s", board_id )
             result, retcode = handle_dummy_request(request)
         else:
             result, retcode = handle_dummy_request(request)
@@ -616,7 +5553,7 @@ def handle_other_requests(request, case='config', board_id=None):
         result, retcode = save_other_data(board_id, case, request)
     elif request.method == 'DELETE':
         ## os.system( f"mv ${dir}/${id} ${dir}/${id}.deleted")
-        _dbg( f"[other] ignoring delete request for case {case!r} and board_id={board_id}" )
+        _dbg( "[other] ignoring delete request for case %r and board_id=%s", case, board_id )
         pass
     else:
         result, retcode = handle_dummy_request(request)
@@ -624,7 +5561,7 @@ def handle_other_requests(request, case='config', board_id=None):
     return (result, retcode)
 
 
-def handle_any_request(case='board', board_id=None):
+def handle_any_request(case='board', board_id=None, revision=None):
 
     _dbg = Dbg(request)
     _dbg.out('\n')
@@ -641,7 +5578,7 @@ def handle_any_request(case='board', board_id=None):
     if BACKUP_VERIFY_TOKEN:
         access_token = request.headers.get('X-Access-Token', None)
         if access_token != BACKUP_VERIFY_TOKEN:
-            _dbg.out(f"[warning] => got access token {access_token!r} different from what we expected!\n")
+            log.warning("[warning] => got access token %r different from what we expected!", access_token)
             abort(RETURN_403_FORBIDDEN)
             
 
@@ -658,14 +5595,14 @@ def handle_any_request(case='board', board_id=None):
 
     retcode = RETURN_200_OK
 
-    request_data = get_request_data(request)
-
     # debug
-    if request_data is not None:
-        text_data = json.dumps(request_data, indent=0)
-        _dbg( f"[data] {text_data[:150]}..." )
-    else:
-        _dbg( f"[data] -" )
+    if _dbg.enabled():
+        request_data = get_request_data(request)
+        if request_data is not None:
+            text_data = json.dumps(request_data, indent=0)
+            _dbg( "[data] %s...", text_data[:150] )
+        else:
+            _dbg( "[data] -" )
 
 
     #
@@ -688,7 +5625,52 @@ def handle_any_request(case='board', board_id=None):
 
         elif 'unstash' == case: 
             if request.method == 'GET':
-                result, retcode = load_stashed_board()                
+                result, retcode = board_response( *load_stashed_board() )
+            else:
+                result, retcode = handle_dummy_request(request)
+
+        elif 'search' == case:
+            if request.method == 'GET':
+                result, retcode = catalog_request(search_notes, request.args)
+            else:
+                result, retcode = handle_dummy_request(request)
+
+        elif 'batch' == case:
+            if request.method == 'PUT':
+                result, retcode = save_board_batch(request)
+            else:
+                result, retcode = handle_dummy_request(request)
+
+        elif 'profile' == case:
+            if request.method == 'GET':
+                result, retcode = read_profile(request.args)
+                result = make_response(result, retcode)
+                result.mimetype = 'text/plain'
+            elif request.method == 'PUT':
+                result, retcode = configure_profile( get_request_data(request) )
+            else:
+                result, retcode = reset_profile()
+
+        elif 'replicate' == case:
+            if request.method == 'PUT':
+                result, retcode = apply_replicated( get_request_data(request) )
+            elif request.method == 'GET':
+                result, retcode = replication_status()
+            else:
+                result, retcode = handle_dummy_request(request)
+
+        elif 'merge' == case:
+            if request.method == 'GET':
+                result, retcode = catalog_request(merge_board_revisions, board_id, request.args)
+            else:
+                result, retcode = handle_dummy_request(request)
+
+        elif 'revisions' == case:
+            if request.method == 'GET':
+                if revision is None:
+                    result, retcode = catalog_request(list_board_revisions, board_id, request.args)
+                else:
+                    result, retcode = board_response( *catalog_request(load_board_revision, board_id, revision, request.args) )
             else:
                 result, retcode = handle_dummy_request(request)
 
@@ -736,13 +5718,26 @@ def after(response):
             print( f" <= data: {response.get_data()}")
         return response
 
-    _debug( f" <= status: {response.status}" )
-    _debug( f" <= headers: {response.headers!r}")
-    _debug( f" <= data: {response.get_data()}")
+    if Dbg.enabled():
+        _debug( " <= status: %s", response.status )
+        _debug( " <= headers: %r", response.headers )
+        _debug( " <= data: %s", response.get_data() )
+
+    if METRICS and 'started' in g:
+        count_request( request.url_rule.rule if request.url_rule else 'unknown', request.method
+                     , response.status_code, time.perf_counter() - g.started, request.content_length )
 
     return response
 
 
+def count_request(route, method, status, seconds, length):
+
+    requests_total.inc( route, method, str(status) )
+    request_seconds.observe( seconds, route )
+    if length:
+        request_bytes.inc( route, amount = length )
+
+
 @app.before_request
 def before():
     # todo with request
@@ -755,16 +5750,42 @@ def before():
             print( f" => mimetype: {request.mimetype!r}")
             print( f" => content-length: {request.content_length}")
 
+    if METRICS:
+        g.started = time.perf_counter()
+
+    # // in the worker process, not in the gunicorn master ; see also start_background()
+    if RETENTION_TIERS:
+        start_retention()
+    if REPLICATE_TO:
+        start_replicator()
+
+    # // a single comparison when profiling is off, see PROFILE
+    if profiler.rate and request.url_rule is not None and request.url_rule.rule not in PROFILE_SKIP and profiler.sampled():
+        g.profiled = True
+        profiler.start( request.url_rule.rule )
+
+    # // sample the requests we debug, see DEBUG_SAMPLE
+    if log.isEnabledFor(logging.DEBUG):
+        g.debug = ( next(_request_counter) % DEBUG_SAMPLE == 0 )
+
     # e.g. print request.headers
-    _debug( f"\n-----" )
-    _debug( f" => headers: {request.headers!r}" )
-    _debug( f" => content-type: {request.content_type!r}" )
-    _debug( f" => mimetype: {request.mimetype!r}" )
-    _debug( f" => content-length: {request.content_length}" )
+    if Dbg.enabled():
+        _debug( "\n-----" )
+        _debug( " => headers: %r", request.headers )
+        _debug( " => content-type: %r", request.content_type )
+        _debug( " => mimetype: %r", request.mimetype )
+        _debug( " => content-length: %s", request.content_length )
 
     pass
 
 
+@app.teardown_request
+def teardown(exc):
+
+    if g.get('profiled', False):
+        profiler.stop()
+
+
 ## @app.route('/board/<id>', methods=['DELETE', 'GET','POST'])
 # // [ https://flask.palletsprojects.com/en/1.1.x/api/#flask.Flask.add_url_rule ]
 ## @app.route('/board/<id>', methods=['PUT', 'DELETE', 'OPTIONS', 'GET', 'POST'], provide_automatic_options=True)
@@ -773,6 +5794,10 @@ def before():
 def board_handler(id=None):
     return handle_any_request(case = 'board', board_id = id)
 
+@app.route('/boards', methods=['PUT', 'OPTIONS'], provide_automatic_options=True)
+def batch_handler(id=None):
+    return handle_any_request(case = 'batch', board_id = id)
+
 @app.route('/stash-board/<id>', methods=['PUT', 'DELETE', 'OPTIONS'], provide_automatic_options=True)
 def stash_request_handler(id=None):
     # print("stash_request_handler()", file=sys.stderr)
@@ -786,6 +5811,51 @@ def unstash_request_handler(id=None):
     return handle_any_request(case = 'unstash', board_id = id)
 
 
+@app.route('/board/<id>/revisions', methods=['GET', 'OPTIONS'], provide_automatic_options=True)
+def revisions_handler(id=None):
+    return handle_any_request(case = 'revisions', board_id = id)
+
+@app.route('/board/<id>/revisions/<revision>', methods=['GET', 'OPTIONS'], provide_automatic_options=True)
+def revision_handler(id=None, revision=None):
+    return handle_any_request(case = 'revisions', board_id = id, revision = revision)
+
+
+@app.route('/board/<id>/merge', methods=['GET', 'OPTIONS'], provide_automatic_options=True)
+def merge_handler(id=None):
+    return handle_any_request(case = 'merge', board_id = id)
+
+
+@app.route('/search', methods=['GET', 'OPTIONS'], provide_automatic_options=True)
+def search_handler(id=None):
+    return handle_any_request(case = 'search', board_id = id)
+
+
+@app.route('/replicate', methods=['PUT', 'GET', 'OPTIONS'], provide_automatic_options=True)
+def replicate_handler(id=None):
+    return handle_any_request(case = 'replicate', board_id = id)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    if not METRICS:
+        abort(RETURN_404_NOT_FOUND)
+
+    # // the same checks as in handle_any_request()
+    ip_filter = app.config.get('ip_filter', lambda _ : True)
+    if not ip_filter( request.remote_addr ):
+        abort(RETURN_403_FORBIDDEN)
+    if not access_token_accepted( request.headers.get('X-Access-Token', None), request.headers.get('Authorization', None) ):
+        log.warning("[warning] => /metrics without the access token")
+        abort(RETURN_403_FORBIDDEN)
+
+    return render_metrics(), RETURN_200_OK, { 'Content-Type' : 'text/plain; version=0.0.4; charset=utf-8' }
+
+
+@app.route('/profile', methods=['GET', 'PUT', 'DELETE', 'OPTIONS'], provide_automatic_options=True)
+def profile_handler(id=None):
+    return handle_any_request(case = 'profile', board_id = id)
+
+
 @app.route('/config', methods=['PUT', 'DELETE', 'OPTIONS'], provide_automatic_options=True)
 def config_handler(id=None):
     return handle_any_request(case = 'config', board_id = id)
@@ -794,5 +5864,53 @@ def config_handler(id=None):
 # ---------------------------------------------------------------------
 # main
 
+def run_production_server(host=SERVER_LISTEN_ON_ALL_INTERFACES, port=SERVER_PORT):
+    """ runs the app under gunicorn ; returns False if gunicorn is not installed """
+
+    try:
+        # [ https://docs.gunicorn.org/en/stable/custom.html ]
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        log.error("# nb: gunicorn is not installed ('pip3 install gunicorn'), falling back to the development server")
+        return False
+
+    options = { 'bind'                     : f"{host}:{port}"
+              , 'workers'                  : WORKERS
+              , 'threads'                  : THREADS
+              , 'worker_class'             : 'gthread'
+              , 'keepalive'                : KEEPALIVE
+              , 'timeout'                  : 60
+              , 'graceful_timeout'         : 30
+              , 'limit_request_line'       : 8190
+              , 'limit_request_fields'     : 100
+              , 'limit_request_field_size' : 8190
+              , 'loglevel'                 : 'debug' if _DEBUG else 'info'
+              # // e.g. an outbox left from before a restart is sent without waiting for a save
+              , 'post_worker_init'         : start_background
+              }
+
+    if WORKERS > 1:
+        # // in the gunicorn master, so that every worker shares its metrics ; and none from an earlier run
+        global _metrics_shared
+        _metrics_shared = True
+        shutil.rmtree( get_metrics_dir(), ignore_errors = True )
+
+    class BackupServerApplication(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    BackupServerApplication().run()
+    return True
+
+
 if __name__ == '__main__':
-    app.run(debug=_DEBUG, host='0.0.0.0', port='20002') 
\ No newline at end of file
+    if SERVER != 'gunicorn' or not run_production_server():
+        # // with the reloader (DEBUG), in the process that serves, not in the one that watches the files
+        if not _DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background()
+        app.run(debug=_DEBUG, host=SERVER_LISTEN_ON_ALL_INTERFACES, port=SERVER_PORT)
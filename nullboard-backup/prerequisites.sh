@@ -8,3 +8,12 @@ sudo pip3 install flask-cors
 # convenience
 sudo pip3 install netifaces
 
+
+# optional, for SERVER=gunicorn
+sudo pip3 install gunicorn
+
+# optional, for nullboard_backup_asgi.py
+sudo pip3 install uvicorn
+
+# optional, for COMPRESS=zstd before python 3.14
+sudo pip3 install zstandard
@@ -5,11 +5,20 @@ savedir='nullboard-backups'
 mkdir -p $savedir
 
 port=20002
-debug=1
+
+# 'dev' for the Flask development server, 'gunicorn' for production
+server=${SERVER:-dev}
+
+# debug output (and the Flask debugger) by default only with the development server
+if [ "$server" = "gunicorn" ]; then
+    debug=${DEBUG:-0}
+else
+    debug=${DEBUG:-1}
+fi
 
 # Change here if you want a token, default is NULL
 #token='token'
-#DEBUG=$debug BACKUP_DIR="$savedir" ACCESS_TOKEN="$token" python3 $app
+#SERVER=$server PORT=$port DEBUG=$debug BACKUP_DIR="$savedir" ACCESS_TOKEN="$token" python3 $app
 
-DEBUG=$debug BACKUP_DIR="$savedir" python3 $app
+SERVER=$server PORT=$port DEBUG=$debug BACKUP_DIR="$savedir" python3 $app
 
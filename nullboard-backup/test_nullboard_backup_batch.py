@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+"""
+    PUT /boards, and the single commit it saves the boards with
+
+        python3 -m unittest test_nullboard_backup_batch
+"""
+
+import os
+import json
+import glob
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+def make_item(board_id, revision, title='batch'):
+    """ a board of PUT /boards, as the form of PUT /board/<id> """
+
+    board = { 'format' : 20190412, 'id' : board_id, 'revision' : revision, 'title' : title, 'lists' : [] }
+    return { 'self' : '', 'data' : json.dumps(board), 'meta' : json.dumps( { 'title' : title } ) }
+
+
+class BatchTest(unittest.TestCase):
+
+    board_id = 1660000000000
+
+    def setUp(self):
+        type(self).board_id += 1
+        self.directory = srv.BACKUP_DIRECTORY = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+        self.client = srv.app.test_client()
+
+    def put(self, items):
+        response = self.client.put( '/boards', json = { 'boards' : items } )
+        self.assertEqual( response.status_code, 200 )
+        return response.get_json()['results']
+
+    def saved(self, tree, board_id=None):
+        """ the revisions of a board left under boards/<tree>/, oldest first """
+
+        board_id = str(board_id or self.board_id)
+        pattern = os.path.join(self.directory, 'boards', tree, '**', f"*.{board_id}.*")
+        # // <host>.<title>.<board id>.<revision>.<date>..., and the host is an address with dots
+        parts = [ os.path.basename(f).split('.') for f in glob.glob(pattern, recursive=True) ]
+        return sorted( int( p[p.index(board_id) + 1] ) for p in parts )
+
+    def leftovers(self):
+
+        return glob.glob( os.path.join(self.directory, '**', '*.tmp'), recursive=True )
+
+    def test_more_revisions_than_kept(self):
+        """ a batch with more revisions of a board than KEEP_REVISIONS keeps the latest ones """
+
+        for count in ( srv.KEEP_REVISIONS + 1, srv.KEEP_REVISIONS + 3 ):
+            with self.subTest(count=count):
+                self.setUp()
+                results = self.put( [ make_item(self.board_id, revision) for revision in range(1, count + 1) ] )
+
+                self.assertEqual( [ r['status'] for r in results ], [ 200 ] * count )
+                expected = list( range(count - srv.KEEP_REVISIONS + 1, count + 1) )
+                self.assertEqual( self.saved('full'), expected )
+                self.assertEqual( self.saved('nbx'), expected )
+                self.assertEqual( self.leftovers(), [] )
+
+    def test_repeated_revision(self):
+        """ the same revision twice in a batch is saved once, the last one """
+
+        items = [ make_item(self.board_id, 1), make_item(self.board_id, 2, 'first'), make_item(self.board_id, 2, 'second') ]
+        with self.assertNoLogs(srv.log, level='ERROR'):
+            results = self.put(items)
+
+        self.assertEqual( [ r['status'] for r in results ], [ 200, 200, 200 ] )
+        self.assertEqual( self.saved('nbx'), [ 1, 2 ] )
+        # // the title is in the file names
+        for tree in ('full', 'nbx'):
+            pattern = os.path.join(self.directory, 'boards', tree, '**', f"*.{{}}.{self.board_id}.2.*")
+            self.assertEqual( len( glob.glob(pattern.format('second'), recursive=True) ), 1 )
+            self.assertEqual( glob.glob(pattern.format('first'), recursive=True), [] )
+
+    def test_failed_board(self):
+        """ a board that fails half-way leaves nothing behind, and the others are saved """
+
+        other = self.board_id + 1000
+        expire_revisions = srv.expire_revisions
+
+        def failing(payload, *args):
+            if payload.board_id == str(other):
+                raise OSError('disk on fire')
+            return expire_revisions(payload, *args)
+
+        self.put( [ make_item(other, 1) ] )
+        with mock.patch.object(srv, 'expire_revisions', failing), self.assertLogs(srv.log, level='ERROR'):
+            results = self.put( [ make_item(self.board_id, 1), make_item(other, 2), make_item(self.board_id, 2) ] )
+
+        self.assertEqual( [ r['status'] for r in results ], [ 200, 500, 200 ] )
+        self.assertEqual( self.saved('nbx'), [ 1, 2 ] )
+        self.assertEqual( self.saved('nbx', other), [ 1 ] )
+        self.assertEqual( self.leftovers(), [] )
+
+        # // and its next save goes through
+        self.put( [ make_item(other, 3) ] )
+        self.assertEqual( self.saved('nbx', other), [ 1, 3 ] )
+
+
+class PendingCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_rollback(self):
+        """ back to the savepoint : a file written again since then keeps what it had, the new ones and callbacks are gone """
+
+        done = []
+        with srv.single_commit():
+            commit = srv.pending_commit()
+            srv.write_file( self.path('a'), 'a1' )
+            srv.after_commit( lambda: done.append('a') )
+
+            savepoint = commit.savepoint()
+            srv.write_file( self.path('a'), 'a2' )
+            srv.write_file( self.path('b'), 'b1' )
+            srv.after_commit( lambda: done.append('b') )
+            commit.rollback(savepoint)
+
+            # // nothing is in place before the commit
+            self.assertFalse( os.path.exists(self.path('a')) )
+
+        self.assertEqual( sorted(os.listdir(self.directory)), [ 'a' ] )
+        self.assertEqual( self.read('a'), 'a1' )
+        self.assertEqual( done, [ 'a' ] )
+
+    def test_written_twice(self):
+        """ the last content wins, and the superseded temporary file is gone """
+
+        with srv.single_commit():
+            srv.write_file( self.path('a'), 'a1' )
+            srv.write_file( self.path('a'), 'a2' )
+
+        self.assertEqual( os.listdir(self.directory), [ 'a' ] )
+        self.assertEqual( self.read('a'), 'a2' )
+
+
+def tearDownModule():
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+
+"""
+    crash-safe writes : single_commit(), after_commit(), GroupCommit, and every DURABILITY
+
+        python3 -m unittest test_nullboard_backup_commit
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+class CommitTest(unittest.TestCase):
+    """ what happens on the way, in order : ('sync', [ pathnames ]), ('fsync', fd), ('replace', fullname), ('callback', name) """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+        self.events = []
+        self.in_round = False
+
+        replace, sync_paths, fsync = os.replace, srv.sync_paths, os.fsync
+
+        def replacing(src, dst):
+            self.events.append( ('replace', dst) )
+            return replace(src, dst)
+
+        def syncing(pathnames):
+            self.events.append( ('sync', list(pathnames)) )
+            self.in_round = True
+            try:
+                return sync_paths(pathnames)
+            finally:
+                self.in_round = False
+
+        def fsyncing(fd):
+            # // those of a group commit round are in its 'sync'
+            if not self.in_round:
+                self.events.append( ('fsync', fd) )
+            return fsync(fd)
+
+        for patcher in ( mock.patch.object(srv.os, 'replace', replacing)
+                       , mock.patch.object(srv.os, 'fsync', fsyncing)
+                       , mock.patch.object(srv, 'sync_paths', syncing)
+                       ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def names(self, kind):
+        return [ value for event, value in self.events if event == kind ]
+
+    def callback(self, name):
+        """ a callback that notes when it runs, and that every file is in place by then """
+
+        def callback():
+            self.events.append( ('callback', name) )
+            self.assertEqual( self.leftovers(), [] )
+        return callback
+
+    def leftovers(self):
+
+        return [ name for _, _, files in os.walk(self.directory) for name in files if name.endswith('.tmp') ]
+
+    def write_three(self):
+        """ three files in two directories, a callback after each """
+
+        os.makedirs( self.path('sub'), exist_ok = True )
+        for name in ( 'a', os.path.join('sub', 'b'), 'c' ):
+            srv.write_file( self.path(name), name )
+            srv.after_commit( self.callback(name) )
+
+    def test_rename_order(self):
+        """ nothing is in place before the end, then every file in the order it was written, and the callbacks after them """
+
+        with srv.single_commit():
+            self.write_three()
+            self.assertEqual( self.names('replace'), [] )
+            self.assertEqual( self.names('callback'), [] )
+            self.assertFalse( os.path.exists(self.path('a')) )
+
+        self.assertEqual( self.names('replace'), [ self.path('a'), self.path('sub', 'b'), self.path('c') ] )
+        self.assertEqual( self.names('callback'), [ 'a', os.path.join('sub', 'b'), 'c' ] )
+        last_rename = max( i for i, (event, _) in enumerate(self.events) if event == 'replace' )
+        first_callback = min( i for i, (event, _) in enumerate(self.events) if event == 'callback' )
+        self.assertLess( last_rename, first_callback )
+
+        with open(self.path('sub', 'b')) as f:
+            self.assertEqual( f.read(), os.path.join('sub', 'b') )
+        self.assertEqual( self.leftovers(), [] )
+
+    def test_after_commit_outside(self):
+        """ with no commit pending, a callback runs right away """
+
+        srv.write_file( self.path('a'), 'a' )
+        srv.after_commit( self.callback('a') )
+
+        self.assertEqual( [ event for event, _ in self.events if event in ('replace', 'callback') ], [ 'replace', 'callback' ] )
+
+    def test_nested(self):
+        """ an inner single_commit() is a part of the outer one """
+
+        with srv.single_commit():
+            with srv.single_commit():
+                srv.write_file( self.path('a'), 'a' )
+                srv.after_commit( self.callback('a') )
+            self.assertEqual( self.names('callback'), [] )
+            self.assertFalse( os.path.exists(self.path('a')) )
+
+        self.assertEqual( self.names('callback'), [ 'a' ] )
+
+    def test_failed(self):
+        """ an exception inside : no file goes into place, no callback runs, no temporary file is left """
+
+        with self.assertRaises(RuntimeError), srv.single_commit():
+            self.write_three()
+            srv.write_file( self.path('a'), 'again' )
+            raise RuntimeError('failed half-way')
+
+        self.assertEqual( os.listdir(self.directory), [ 'sub' ] )
+        self.assertEqual( os.listdir(self.path('sub')), [] )
+        self.assertEqual( self.names('callback'), [] )
+        self.assertIsNone( srv.pending_commit() )
+
+    def test_durability_batch(self):
+        """ the temporary files are synced before the renames, and their directories after """
+
+        for commit in ( srv.single_commit, None ):
+            with self.subTest(single_commit = commit is not None), mock.patch.object(srv, 'DURABILITY', 'batch'):
+                self.events.clear()
+                if commit is None:
+                    srv.write_files( [ (self.path('a'), 'a'), (self.path('sub', 'b'), 'b') ] )
+                else:
+                    with commit():
+                        self.write_three()
+
+                kinds = [ event for event, _ in self.events if event != 'callback' ]
+                self.assertEqual( kinds[0], 'sync' )
+                self.assertEqual( kinds[-1], 'sync' )
+                self.assertEqual( set(kinds[1:-1]), { 'replace' } )
+
+                files, directories = self.names('sync')
+                self.assertTrue( all( name.endswith('.tmp') for name in files ) )
+                self.assertEqual( len(files), len(self.names('replace')) )
+                self.assertEqual( sorted(directories), sorted([ self.directory, self.path('sub') ]) )
+                self.assertEqual( self.names('fsync'), [] )
+
+    def test_durability_always(self):
+        """ every file is fsync()-ed as it is written, and every directory after the renames ; no group commit """
+
+        for commit in ( srv.single_commit, None ):
+            with self.subTest(single_commit = commit is not None), mock.patch.object(srv, 'DURABILITY', 'always'):
+                self.events.clear()
+                if commit is None:
+                    srv.write_files( [ (self.path('a'), 'a'), (self.path('sub', 'b'), 'b') ] )
+                    files = 2
+                else:
+                    with commit():
+                        self.write_three()
+                    files = 3
+
+                kinds = [ event for event, _ in self.events if event != 'callback' ]
+                self.assertEqual( kinds, [ 'fsync' ] * files + [ 'replace' ] * files + [ 'fsync' ] * 2 )
+                self.assertEqual( self.names('sync'), [] )
+
+    def test_durability_none(self):
+
+        for commit in ( srv.single_commit, None ):
+            with self.subTest(single_commit = commit is not None), mock.patch.object(srv, 'DURABILITY', 'none'):
+                self.events.clear()
+                if commit is None:
+                    srv.write_files( [ (self.path('a'), 'a'), (self.path('sub', 'b'), 'b') ] )
+                else:
+                    with commit():
+                        self.write_three()
+
+                self.assertEqual( set( event for event, _ in self.events if event != 'callback' ), { 'replace' } )
+                self.assertEqual( self.leftovers(), [] )
+
+
+class GroupCommitTest(unittest.TestCase):
+
+    def test_rounds(self):
+        """ writers that come while a round is on wait for the next one, and share it """
+
+        batches = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def syncing(pathnames):
+            batches.append( list(pathnames) )
+            started.set()
+            release.wait(5)
+            return {}
+
+        group = srv.GroupCommit()
+        with mock.patch.object(srv, 'sync_paths', syncing):
+            leader = threading.Thread( target = group.wait, args = ( [ 'leader' ], ) )
+            leader.start()
+            self.assertTrue( started.wait(5) )
+
+            # // these queue up behind the round of the leader
+            followers = [ threading.Thread( target = group.wait, args = ( [ f"follower {i}" ], ) ) for i in range(8) ]
+            for thread in followers:
+                thread.start()
+            while len(group.queued) < len(followers):
+                time.sleep(0.01)
+
+            release.set()
+            for thread in [ leader ] + followers:
+                thread.join(5)
+                self.assertFalse( thread.is_alive() )
+
+        self.assertEqual( batches[0], [ 'leader' ] )
+        self.assertEqual( sorted(batches[1]), sorted( f"follower {i}" for i in range(8) ) )
+        self.assertEqual( len(batches), 2 )
+        self.assertEqual( (group.requested, group.finished), (2, 2) )
+
+    def test_failure(self):
+        """ only the writer whose file could not be synced gets the error """
+
+        group = srv.GroupCommit()
+        error = OSError(5, 'I/O error')
+        with mock.patch.object(srv, 'sync_paths', lambda pathnames: { 'bad' : error }):
+            group.wait( [ 'good' ] )
+            with self.assertRaises(OSError) as raised:
+                group.wait( [ 'good', 'bad' ] )
+
+        self.assertIs( raised.exception, error )
+
+    def test_nothing_to_sync(self):
+
+        group = srv.GroupCommit()
+        with mock.patch.object(srv, 'sync_paths', side_effect = AssertionError('no round for nothing')):
+            group.wait( [] )
+
+        self.assertEqual( group.finished, 0 )
+
+
+def tearDownModule():
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+"""
+    request bodies sent with 'Content-Encoding: gzip' or 'deflate' : BodyDecoder, and the DecompressRequest middleware
+
+        python3 -m unittest test_nullboard_backup_decompress
+"""
+
+import os
+import json
+import glob
+import gzip
+import zlib
+import shutil
+import tempfile
+import unittest
+from urllib.parse import urlencode
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+def deflate(data, wbits):
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+# // Content-Encoding => compress()
+ENCODINGS = { 'gzip'         : gzip.compress
+            , 'deflate'      : zlib.compress
+            , 'raw deflate'  : lambda data: deflate(data, -zlib.MAX_WBITS)
+            }
+
+def content_encoding(encoding):
+    return encoding.split()[-1]
+
+
+class BodyDecoderTest(unittest.TestCase):
+
+    body = json.dumps( { 'lists' : [ { 'title' : f"list {i}", 'notes' : [ { 'text' : 'ü' * i } ] } for i in range(200) ] } ).encode('utf-8')
+
+    def decode(self, compressed, encoding, size=None, limit=srv.MAX_CONTENT_LENGTH):
+        """ fed 'size' bytes at a time ; => the decompressed chunks """
+
+        decoder = srv.BodyDecoder(encoding, limit)
+        size = size or max(1, len(compressed))
+        chunks = []
+        for start in range(0, len(compressed), size):
+            chunks += decoder.feed( compressed[start:start + size] )
+        decoder.close()
+
+        return chunks
+
+    def test_decompress(self):
+
+        for encoding, compress in ENCODINGS.items():
+            compressed = compress(self.body)
+            for size in ( None, 1, 7, 4096 ):
+                with self.subTest(encoding=encoding, size=size):
+                    self.assertEqual( b''.join( self.decode(compressed, content_encoding(encoding), size) ), self.body )
+
+            self.assertEqual( srv.decompress_body(compressed, content_encoding(encoding)), self.body )
+
+    def test_chunk_size(self):
+        """ a small body that decompresses to a lot comes out STREAM_CHUNK bytes at a time """
+
+        body = b'0' * (5 * srv.STREAM_CHUNK + 1)
+        chunks = self.decode( gzip.compress(body), 'gzip' )
+
+        self.assertEqual( b''.join(chunks), body )
+        self.assertLessEqual( max( len(chunk) for chunk in chunks ), srv.STREAM_CHUNK )
+
+    def test_truncated(self):
+
+        for encoding, compress in ENCODINGS.items():
+            compressed = compress(self.body)
+            for cut in ( 1, len(compressed) // 2, len(compressed) - 1 ):
+                with self.subTest(encoding=encoding, cut=cut), self.assertRaises(srv.BadRequest):
+                    self.decode( compressed[:cut], content_encoding(encoding) )
+
+        with self.assertRaises(srv.BadRequest):
+            self.decode( b'', 'gzip' )
+
+    def test_corrupt(self):
+
+        with self.assertRaises(srv.BadRequest):
+            self.decode( b'\x1f\x8b' + b'not a gzip stream' * 10, 'gzip' )
+
+    def test_too_large(self):
+
+        for encoding, compress in ENCODINGS.items():
+            with self.subTest(encoding=encoding):
+                compressed = compress(self.body)
+                self.assertEqual( b''.join( self.decode(compressed, content_encoding(encoding), limit=len(self.body)) ), self.body )
+                with self.assertRaises(srv.RequestEntityTooLarge):
+                    self.decode( compressed, content_encoding(encoding), limit=len(self.body) - 1 )
+
+    def test_unsupported(self):
+
+        with self.assertRaises(srv.UnsupportedMediaType):
+            srv.BodyDecoder('br')
+
+
+class DecompressRequestTest(unittest.TestCase):
+
+    board_id = 1660000000000
+
+    def setUp(self):
+        type(self).board_id += 1
+        self.directory = srv.BACKUP_DIRECTORY = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+        self.client = srv.app.test_client()
+
+    def form(self, revision=1):
+
+        board = { 'format' : 20190412, 'id' : self.board_id, 'revision' : revision, 'title' : 'gz', 'lists' : [] }
+        return urlencode( { 'self' : '', 'data' : json.dumps(board), 'meta' : '{}' } ).encode('ascii')
+
+    def put(self, body, encoding):
+
+        return self.client.put( f"/board/{self.board_id}", data = body
+                              , headers = { 'Content-Type' : 'application/x-www-form-urlencoded', 'Content-Encoding' : encoding } )
+
+    def saved(self):
+
+        return glob.glob( os.path.join(self.directory, 'boards', 'nbx', '**', f"*.{self.board_id}.*"), recursive=True )
+
+    def test_board(self):
+
+        for revision, (encoding, compress) in enumerate(ENCODINGS.items(), 1):
+            with self.subTest(encoding=encoding):
+                response = self.put( compress( self.form(revision) ), content_encoding(encoding) )
+                self.assertEqual( response.status_code, srv.RETURN_200_UPDATED )
+                self.assertEqual( len(self.saved()), revision )
+
+    def test_truncated(self):
+
+        compressed = gzip.compress( self.form() )
+        self.assertEqual( self.put( compressed[:-8], 'gzip' ).status_code, srv.RETURN_400_BAD_REQUEST )
+        self.assertEqual( self.saved(), [] )
+
+    def test_too_large(self):
+        """ MAX_CONTENT_LENGTH goes for the decompressed body as well """
+
+        body = self.form() + b'&padding=' + b'0' * srv.MAX_CONTENT_LENGTH
+        compressed = gzip.compress(body)
+        self.assertLess( len(compressed), srv.MAX_CONTENT_LENGTH )
+
+        self.assertEqual( self.put( compressed, 'gzip' ).status_code, srv.RETURN_413_TOO_LARGE )
+        self.assertEqual( self.saved(), [] )
+
+    def test_unsupported(self):
+
+        self.assertEqual( self.put( self.form(), 'br' ).status_code, 415 )
+
+
+def tearDownModule():
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
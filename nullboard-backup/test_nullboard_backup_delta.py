@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+"""
+    delta chains (BOARD_STORAGE=delta) : a board read back is the board that was saved
+
+        python3 -m unittest test_nullboard_backup_delta
+"""
+
+import os
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+LIST_KEYS = [ 'title', 'notes', 'id', 'min', 'color', 'del' ]
+NOTE_KEYS = [ 'text', 'raw', 'min', 'id' ]
+
+
+def random_value(rng):
+
+    return rng.choice([ None, True, False, 0, 1, 'x', 'y', [], { 'a' : 1 } ])
+
+
+def random_note(rng):
+
+    return { key : random_value(rng) for key in rng.sample(NOTE_KEYS, rng.randint(0, len(NOTE_KEYS))) }
+
+
+def random_list(rng):
+
+    board_list = { key : random_value(rng) for key in rng.sample(LIST_KEYS, rng.randint(0, 4)) }
+    if 'notes' in board_list or rng.random() < 0.7:
+        board_list['notes'] = [ random_note(rng) for _ in range(rng.randint(0, 4)) ]
+
+    return board_list
+
+
+def random_board(rng):
+
+    board = { key : random_value(rng) for key in rng.sample([ 'format', 'id', 'revision', 'title', 'extra' ], rng.randint(0, 5)) }
+    if rng.random() < 0.9:
+        board['lists'] = [ random_list(rng) for _ in range(rng.randint(0, 4)) ]
+
+    return board
+
+
+def edit_board(rng, board):
+    """ a few random edits : list keys changed or removed, lists added, board keys changed or removed """
+
+    board = copy.deepcopy(board)
+    for _ in range(rng.randint(1, 4)):
+        lists = board.get('lists')
+        roll = rng.random()
+        if lists and roll < 0.6:
+            board_list = rng.choice(lists)
+            key = rng.choice(LIST_KEYS)
+            if rng.random() < 0.5:
+                board_list.pop(key, None)
+            else:
+                board_list[key] = [ random_note(rng) ] if key == 'notes' else random_value(rng)
+        elif roll < 0.8:
+            board.setdefault('lists', []).append( random_list(rng) )
+        else:
+            key = rng.choice([ 'title', 'lists', 'extra' ])
+            if rng.random() < 0.5:
+                board.pop(key, None)
+            else:
+                board[key] = [] if key == 'lists' else random_value(rng)
+
+    return board
+
+
+class DeltaTest(unittest.TestCase):
+
+    def assertRoundTrip(self, old, new):
+        self.assertEqual( srv.apply_board_delta(old, srv.make_board_delta(old, new)), new )
+
+    def test_list_key_removed(self):
+
+        old = { 'revision' : 1, 'lists' : [ { 'title' : 'todo', 'min' : True, 'notes' : [ { 'text' : 'a' } ] } ] }
+        new = { 'revision' : 2, 'lists' : [ { 'title' : 'todo', 'notes' : [ { 'text' : 'a' }, { 'text' : 'b' } ] } ] }
+        self.assertRoundTrip(old, new)
+
+    def test_notes_removed(self):
+
+        old = { 'lists' : [ { 'title' : 'todo', 'notes' : [] } ] }
+        new = { 'lists' : [ { 'title' : 'done' } ] }
+        self.assertRoundTrip(old, new)
+        self.assertRoundTrip(new, old)
+
+    def test_new_key_set_to_null(self):
+
+        self.assertRoundTrip( { 'lists' : [ { 'title' : 'a' } ] }, { 'title' : None, 'lists' : [ { 'title' : 'a', 'min' : None } ] } )
+
+    def test_lists_removed(self):
+
+        self.assertRoundTrip( { 'title' : 'a', 'lists' : [ { 'title' : 'a' } ] }, { 'title' : 'a' } )
+
+    def test_older_chains(self):
+        """ list deltas as they were written before : "notes" in every one, and no "del" """
+
+        old = { 'lists' : [ { 'title' : 'todo', 'notes' : [ { 'text' : 'a' } ] } ] }
+        delta = { 'lists' : [ [ '~', { 'title' : 'done', 'notes' : [ [ '=', 1 ], [ '+', [ { 'text' : 'b' } ] ] ] } ] ] }
+        self.assertEqual( srv.apply_board_delta(old, delta), { 'lists' : [ { 'title' : 'done', 'notes' : [ { 'text' : 'a' }, { 'text' : 'b' } ] } ] } )
+
+    def test_random_boards(self):
+
+        rng = random.Random(20190412)
+        for _ in range(3000):
+            old = random_board(rng)
+            new = edit_board(rng, old) if rng.random() < 0.8 else random_board(rng)
+            self.assertRoundTrip(old, new)
+
+
+class ChainTest(unittest.TestCase):
+
+    def setUp(self):
+        srv.BACKUP_DIRECTORY = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+        srv._delta_heads.clear()
+
+    def test_replay(self):
+        """ every revision saved to a chain is read back as it was saved """
+
+        rng = random.Random(1660000000000)
+        board_id = '1660000000000'
+        board = random_board(rng)
+        saved = []
+        for revision in range(1, 200):
+            board = dict( edit_board(rng, board), id = board_id, revision = revision )
+            if srv.save_board_delta(board_id, '127.0.0.1', board):
+                saved.append(board)
+
+        replayed = []
+        for _, _, fullname in srv.list_delta_chains( srv.get_delta_dir('127.0.0.1', board_id) ):
+            replayed += [ record['board'] for record in srv.replay_delta_chain(fullname) ]
+
+        self.assertEqual( replayed, saved )
+        for board in saved[::20]:
+            self.assertEqual( srv.load_delta_revision('127.0.0.1', board_id, board['revision'])['board'], board )
+
+
+def tearDownModule():
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
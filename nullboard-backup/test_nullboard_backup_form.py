@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+"""
+    FormSpooler : a form body parsed chunk by chunk is the form parsed at once, wherever the chunks are cut
+
+        python3 -m unittest test_nullboard_backup_form
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from urllib.parse import urlencode
+
+from werkzeug.wrappers import Request
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+def parse_at_once(body):
+    """ what request.form.to_dict() gives : the first value of every field """
+
+    return Request.from_values( data = body, content_type = 'application/x-www-form-urlencoded', method = 'PUT' ).form.to_dict()
+
+
+def cut(body, *positions):
+
+    bounds = [ 0, *positions, len(body) ]
+    return [ body[start:end] for start, end in zip(bounds, bounds[1:]) ]
+
+
+class FormSpoolerTest(unittest.TestCase):
+
+    def setUp(self):
+        srv.BACKUP_DIRECTORY = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+
+    def parse(self, chunks):
+        """ => ( every field as text, the spooler ) """
+
+        form = srv.FormSpooler()
+        for chunk in chunks:
+            form.feed(chunk)
+        form.close()
+        self.addCleanup(form.remove)
+
+        fields = dict(form.fields)
+        for name, spool in form.spools.items():
+            fields[name] = ''.join( spool.text_chunks() )
+
+        return fields, form
+
+    def assertEveryCut(self, body, expected=None):
+        """ the body in two chunks, cut at every byte ; and one byte at a time """
+
+        if expected is None:
+            expected = parse_at_once(body)
+
+        for position in range(1, len(body)):
+            chunks = cut(body, position)
+            self.assertEqual( self.parse(chunks)[0], expected, chunks )
+
+        chunks = [ body[i:i + 1] for i in range(len(body)) ]
+        self.assertEqual( self.parse(chunks)[0], expected, chunks )
+
+    def test_escapes(self):
+        """ a chunk ends after the '%', or after its first digit """
+
+        self.assertEveryCut( b'self=%41%42&data=%7B%22x%22%3A1%7D&meta=%7b%7d&other=100%25' )
+
+    def test_multibyte(self):
+        """ a chunk ends inside the escapes of a character, or inside the raw UTF-8 bytes of one """
+
+        text = 'Zürich € \U0001f4cb'
+        self.assertEveryCut( urlencode( { 'data' : text, 'meta' : text, 'self' : text } ).encode('ascii') )
+        self.assertEveryCut( b'data=' + text.encode('utf-8') + b'&self=' + text.encode('utf-8') )
+
+    def test_names_and_values(self):
+        """ '+', escaped names, empty values, names with no '=', repeated names, a stray '%' """
+
+        self.assertEveryCut( b'a+b=c+d&%64ata=x&&empty=&=nameless&alone&data=second&pct=50%&half=%4&bad=%zz' )
+
+    def test_invalid_utf8(self):
+        """ replaced with U+FFFD, where request.form drops the whole form """
+
+        self.assertEveryCut( b'data=%E2%82&self=%FF%FEok&meta=\xc3&ok=%C3%BC', { 'data' : '\ufffd', 'self' : '\ufffd\ufffdok', 'meta' : '\ufffd', 'ok' : '\xfc' } )
+
+    def test_data_ends(self):
+        """ the start and the end of 'data' are kept for scan_board_header() """
+
+        board = { 'id' : 1660000000000, 'revision' : 7, 'title' : 'für', 'lists' : [ { 'title' : 'x' * 100 } ] }
+        data = json.dumps(board, ensure_ascii=False)
+        body = urlencode( { 'data' : data } ).encode('ascii')
+
+        for position in ( 1, 7, 8, 9, len(body) - 4, len(body) - 2, len(body) - 1 ):
+            fields, form = self.parse( cut(body, position) )
+            self.assertEqual( fields['data'], data )
+            self.assertEqual( form.head, data )
+            self.assertEqual( form.tail, data[-16:] )
+
+
+def tearDownModule():
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+"""
+    GET /board/<id>/merge, with boards as upstream Nullboard saves them -- lists and notes without ids
+
+        python3 -m unittest test_nullboard_backup_merge
+"""
+
+import os
+import copy
+import json
+import shutil
+import tempfile
+import unittest
+from urllib.parse import urlencode
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, CATALOG = '1', DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+def make_board(board_id, revision, lists):
+    """ { list title : [ note texts ] } => a board as Nullboard saves it """
+
+    return { 'format' : 20190412, 'id' : board_id, 'revision' : revision, 'title' : 'merge'
+           , 'lists' : [ { 'title' : title, 'notes' : [ { 'text' : text, 'raw' : False, 'min' : False } for text in notes ] }
+                         for title, notes in lists.items() ] }
+
+
+def board_lists(board):
+
+    return { board_list['title'] : [ note['text'] for note in board_list['notes'] ] for board_list in board['lists'] }
+
+
+class MergeTest(unittest.TestCase):
+
+    board_id = 1660000000000
+
+    def setUp(self):
+        type(self).board_id += 1
+        self.client = srv.app.test_client()
+
+    def save(self, board, host):
+        form = { 'self' : '', 'data' : json.dumps(board), 'meta' : json.dumps( { 'title' : board['title'] } ) }
+        response = self.client.put( f"/board/{board['id']}", data = form, environ_base = { 'REMOTE_ADDR' : host } )
+        self.assertEqual( response.status_code, 200 )
+
+    def merge(self, a, host_a, b, host_b):
+        query = urlencode( { 'a' : a, 'host_a' : host_a, 'b' : b, 'host_b' : host_b } )
+        response = self.client.get( f"/board/{self.board_id}/merge?{query}" )
+        self.assertEqual( response.status_code, 200 )
+        return response.get_json()
+
+    def test_revisions_skipped_by_one_host(self):
+        """ what one host saved while the other was offline is not a common ancestor """
+
+        lists = { 'todo' : [ 'one' ] }
+        for revision in range(1, 6):
+            self.save( make_board(self.board_id, revision, lists), '10.0.0.1' )
+        self.save( make_board(self.board_id, 5, lists), '10.0.0.2' )
+
+        # // 10.0.0.1 goes on with 6, 7, 8 ; 10.0.0.2 only saves an 8 of its own
+        for revision, text in ( (6, 'six'), (7, 'seven'), (8, 'eight') ):
+            lists = dict( lists, todo = lists['todo'] + [ text ] )
+            self.save( make_board(self.board_id, revision, lists), '10.0.0.1' )
+        self.save( make_board(self.board_id, 8, { 'todo' : [ 'one' ], 'done' : [ 'two' ] }), '10.0.0.2' )
+
+        result = self.merge( 8, '10.0.0.1', 8, '10.0.0.2' )
+
+        self.assertEqual( result['base']['revision'], 5 )
+        self.assertEqual( board_lists(result['board']), { 'todo' : [ 'one', 'six', 'seven', 'eight' ], 'done' : [ 'two' ] } )
+        self.assertEqual( result['conflicts'], [] )
+
+    def test_unstashed_on_one_host(self):
+        """ a board one host has never saved before it went apart goes back to the other host's revisions """
+
+        lists = { 'todo' : [ 'one' ] }
+        for revision in range(1, 4):
+            self.save( make_board(self.board_id, revision, lists), '10.0.0.1' )
+        self.save( make_board(self.board_id, 4, { 'todo' : [ 'one', 'a' ] }), '10.0.0.1' )
+        self.save( make_board(self.board_id, 4, { 'todo' : [ 'one', 'b' ] }), '10.0.0.2' )
+
+        result = self.merge( 4, '10.0.0.1', 4, '10.0.0.2' )
+
+        self.assertEqual( result['base']['revision'], 3 )
+        self.assertEqual( board_lists(result['board']), { 'todo' : [ 'one', 'a', 'b' ] } )
+
+    def test_note_edited_on_both_sides(self):
+
+        base = { 'todo' : [ 'call the plumber', 'milk' ] }
+        self.save( make_board(self.board_id, 1, base), '10.0.0.1' )
+        self.save( make_board(self.board_id, 1, base), '10.0.0.2' )
+        self.save( make_board(self.board_id, 2, { 'todo' : [ 'call the plumber today', 'milk' ] }), '10.0.0.1' )
+        self.save( make_board(self.board_id, 2, { 'todo' : [ 'call the plumber on monday', 'milk' ] }), '10.0.0.2' )
+
+        result = self.merge( 2, '10.0.0.1', 2, '10.0.0.2' )
+
+        self.assertEqual( board_lists(result['board']), { 'todo' : [ 'call the plumber today', 'milk' ] } )
+        self.assertEqual( [ ( conflict['kind'], conflict['type'], conflict['field'], conflict['a'], conflict['b'] ) for conflict in result['conflicts'] ]
+                        , [ ( 'edit', 'note', 'text', 'call the plumber today', 'call the plumber on monday' ) ] )
+
+    def test_list_renamed_on_one_side(self):
+
+        base = { 'todo' : [ 'milk' ], 'done' : [] }
+        self.save( make_board(self.board_id, 1, base), '10.0.0.1' )
+        self.save( make_board(self.board_id, 1, base), '10.0.0.2' )
+        self.save( make_board(self.board_id, 2, { 'to do' : [ 'milk' ], 'done' : [] }), '10.0.0.1' )
+        self.save( make_board(self.board_id, 2, { 'todo' : [ 'milk', 'eggs' ], 'done' : [] }), '10.0.0.2' )
+
+        result = self.merge( 2, '10.0.0.1', 2, '10.0.0.2' )
+
+        self.assertEqual( board_lists(result['board']), { 'to do' : [ 'milk', 'eggs' ], 'done' : [] } )
+        self.assertEqual( result['conflicts'], [] )
+
+
+_saved_settings = {}
+
+
+def setUpModule():
+    # // in case another test module has imported the server first
+    _saved_settings.update( BACKUP_DIRECTORY = srv.BACKUP_DIRECTORY, CATALOG = srv.CATALOG )
+    srv.BACKUP_DIRECTORY, srv.CATALOG = _SCRATCH_ROOT, True
+    srv.build_catalog()
+
+
+def tearDownModule():
+    for name, value in _saved_settings.items():
+        setattr(srv, name, value)
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
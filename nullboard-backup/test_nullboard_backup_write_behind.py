@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+"""
+    WRITE_BEHIND : a revision saved from the buffer never replaces a newer one
+
+        python3 -m unittest test_nullboard_backup_write_behind
+"""
+
+import os
+import json
+import glob
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# // the server reads its settings at import time
+_SCRATCH_ROOT = tempfile.mkdtemp(prefix='nullboard-test-')
+os.environ.update( BACKUP_DIR = _SCRATCH_ROOT, DEBUG = '0' )
+
+import nullboard_backup_srv as srv
+
+
+HOSTNAME = '127.0.0.1'
+
+
+def make_payload(board_id, revision):
+
+    board = { 'format' : 20190412, 'id' : board_id, 'revision' : revision, 'title' : 'behind', 'lists' : [] }
+    return srv.BoardPayload( str(board_id), HOSTNAME, { 'self' : '', 'data' : json.dumps(board), 'meta' : '{}' } )
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    board_id = 1660000000000
+
+    def setUp(self):
+        type(self).board_id += 1
+        self.directory = srv.BACKUP_DIRECTORY = tempfile.mkdtemp(dir=_SCRATCH_ROOT)
+        # // nothing is due before drain() or flush()
+        self.buffer = srv.WriteBehindBuffer(3600, 1000, 1000)
+
+    def tearDown(self):
+        self.buffer.drain()
+
+    def saved(self):
+        """ the revisions of the board under boards/nbx/, oldest first """
+
+        board_id = str(self.board_id)
+        parts = [ os.path.basename(f).split('.') for f in glob.glob( os.path.join(self.directory, 'boards', 'nbx', '**', f"*.{board_id}.*"), recursive=True ) ]
+        return sorted( int( p[p.index(board_id) + 1] ) for p in parts )
+
+    def latest(self):
+        """ the revision in latest-saved.nbx """
+
+        latest, = glob.glob( os.path.join(self.directory, 'boards', f"*.{self.board_id}.*latest-saved.nbx") )
+        with open(latest) as f:
+            return json.load(f)['revision']
+
+    def forget(self):
+        """ as if the board has been saved by another worker : nothing about it in memory, only in its lock file """
+
+        srv._board_stamps.clear()
+        srv._saved_revisions.clear()
+
+    def test_newer_saved_meanwhile(self):
+        """ e.g. while the buffer drains, a save goes through synchronously """
+
+        self.assertTrue( self.buffer.put( make_payload(self.board_id, 1) ) )
+        srv.store_board( make_payload(self.board_id, 2) )
+        self.buffer.drain()
+
+        self.assertEqual( self.saved(), [ 2 ] )
+        self.assertEqual( self.latest(), 2 )
+
+        # // and once stopped, the buffer takes nothing
+        self.assertFalse( self.buffer.put( make_payload(self.board_id, 3) ) )
+
+    def test_newer_saved_by_another_worker(self):
+
+        srv.store_board( make_payload(self.board_id, 5) )
+        self.forget()
+        self.buffer.put( make_payload(self.board_id, 4) )
+        self.buffer.flush()
+
+        self.assertEqual( self.saved(), [ 5 ] )
+        self.assertEqual( self.latest(), 5 )
+
+    def test_newer_from_the_buffer(self):
+
+        srv.store_board( make_payload(self.board_id, 1) )
+        self.forget()
+        self.buffer.put( make_payload(self.board_id, 2) )
+        self.buffer.put( make_payload(self.board_id, 3) )
+        self.buffer.flush()
+
+        self.assertEqual( self.saved(), [ 1, 3 ] )
+        self.assertEqual( self.latest(), 3 )
+
+    def test_sigterm(self):
+        """ the handler does not wait for the buffer, even if the thread it has interrupted holds its lock ; the flusher thread saves it """
+
+        self.buffer.put( make_payload(self.board_id, 1) )
+        handled = threading.Event()
+
+        def interrupted():
+            with self.buffer.condition:
+                with mock.patch.object(srv, '_previous_sigterm_handler', lambda signum, frame: handled.set()):
+                    srv._drain_on_sigterm(15, None)
+
+        with mock.patch.object(srv, 'write_behind', self.buffer):
+            thread = threading.Thread(target=interrupted, daemon=True)
+            thread.start()
+            thread.join(5)
+
+        self.assertTrue( handled.is_set() )
+        self.buffer.thread.join(5)
+        self.assertFalse( self.buffer.thread.is_alive() )
+        self.assertEqual( self.saved(), [ 1 ] )
+        self.assertEqual( len(self.buffer), 0 )
+
+
+def tearDownModule():
+    shutil.rmtree(_SCRATCH_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()